@@ -11,6 +11,8 @@ from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.blinkenlights.latency import start_latency_recorder
+from vumi.utils import gather_deferred_dict
 
 
 SESSION_NEW = TransportUserMessage.SESSION_NEW
@@ -53,10 +55,15 @@ class ApplicationWorker(Worker):
     By default :attr:`SEND_TO_TAGS` is empty and all calls to
     :meth:`send_to` will fail (this is to make it easy to identify
     which tags an application requires `send_to` configuration for).
+
+    Inbound messages and events are processed one at a time unless the
+    ``max_in_flight`` config option is set, in which case up to that many
+    of each may be processed concurrently.
     """
 
     transport_name = None
     start_message_consumer = True
+    latency_recorder = None
 
     SEND_TO_TAGS = frozenset([])
 
@@ -68,6 +75,7 @@ class ApplicationWorker(Worker):
         self._validate_config()
         self.transport_name = self.config['transport_name']
         self.send_to_options = self.config.get('send_to', {})
+        self.max_in_flight = self.config.get('max_in_flight')
 
         self._event_handlers = {
             'ack': self.consume_ack,
@@ -78,15 +86,13 @@ class ApplicationWorker(Worker):
             SESSION_CLOSE: self.close_session,
             }
 
-        yield self._setup_transport_publisher()
-
-        yield self.setup_middleware()
-
-        yield self.setup_application()
+        yield self.run_startup_phase('publishers',
+                                     self._setup_transport_publisher)
+        yield self.run_startup_phase('middleware', self.setup_middleware)
+        yield self.run_startup_phase('application', self.setup_application)
 
         if self.start_message_consumer:
-            yield self._setup_transport_consumer()
-            yield self._setup_event_consumer()
+            yield self.run_startup_phase('consumers', self._setup_consumers)
 
     @inlineCallbacks
     def stopWorker(self):
@@ -94,6 +100,10 @@ class ApplicationWorker(Worker):
             consumer = self._consumers.pop()
             yield consumer.stop()
         yield self.teardown_application()
+        if getattr(self, '_middlewares', None) is not None:
+            yield self._middlewares.teardown()
+        if self.latency_recorder is not None:
+            self.latency_recorder.stop()
 
     def _validate_config(self):
         if 'transport_name' not in self.config:
@@ -140,8 +150,10 @@ class ApplicationWorker(Worker):
         Subclasses should not override this unless they need to do nonstandard
         middleware setup.
         """
+        self.latency_recorder = yield start_latency_recorder(
+            self, self.transport_name)
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        self._middlewares = MiddlewareStack(middlewares, self.latency_recorder)
 
     def _dispatch_event_raw(self, event):
         event_type = event.get('event_type')
@@ -227,12 +239,21 @@ class ApplicationWorker(Worker):
         self.transport_publisher = yield self.publish_to(
             '%(transport_name)s.outbound' % self.config)
 
+    @inlineCallbacks
+    def _setup_consumers(self):
+        # start both consumers before waiting for either
+        yield gather_deferred_dict({
+            'transport': self._setup_transport_consumer(),
+            'event': self._setup_event_consumer(),
+            })
+
     @inlineCallbacks
     def _setup_transport_consumer(self):
         self.transport_consumer = yield self.consume(
             '%(transport_name)s.inbound' % self.config,
             self.dispatch_user_message,
-            message_class=TransportUserMessage)
+            message_class=TransportUserMessage,
+            max_in_flight=self.max_in_flight)
         self._consumers.append(self.transport_consumer)
 
     @inlineCallbacks
@@ -240,5 +261,6 @@ class ApplicationWorker(Worker):
         self.transport_event_consumer = yield self.consume(
             '%(transport_name)s.event' % self.config,
             self.dispatch_event,
-            message_class=TransportEvent)
+            message_class=TransportEvent,
+            max_in_flight=self.max_in_flight)
         self._consumers.append(self.transport_event_consumer)
@@ -0,0 +1,113 @@
+# -*- test-case-name: vumi.blinkenlights.tests.test_latency -*-
+
+"""Opt-in latency metrics for middleware, routers and transports.
+
+Workers that have ``latency_metrics`` set in their config publish a
+count and a latency timer for every instrumented handler. Metric names
+look like::
+
+  vumi.latency.<worker name>.middleware.<middleware name>.<kind>.<direction>
+  vumi.latency.<worker name>.router.dispatch_inbound_message
+  vumi.latency.<worker name>.transport.handle_outbound_message
+
+each followed by ``.count`` or ``.latency``. Latencies are in seconds and
+are aggregated as an average, minimum and maximum.
+
+The following config options are used:
+
+* ``latency_metrics`` -- Set to ``true`` to record latency metrics.
+  Defaults to ``false``, in which case nothing is wrapped and there is
+  no overhead.
+* ``latency_metrics_prefix`` -- Prefix for metric names. Defaults to
+  ``vumi.latency.<worker name>.``.
+* ``latency_metrics_interval`` -- How often to publish metrics, in
+  seconds. Defaults to 5.
+"""
+
+import time
+import functools
+
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+
+from vumi.blinkenlights.metrics import (MetricManager, Count, Timer,
+                                        AVG, MIN, MAX)
+
+
+class LatencyRecorder(object):
+    """Records call counts and latencies on a :class:`MetricManager`.
+
+    :type metric_manager: :class:`vumi.blinkenlights.metrics.MetricManager`
+    :param metric_manager:
+        Manager to register metrics with.
+    """
+
+    LATENCY_AGGREGATORS = [AVG, MIN, MAX]
+
+    def __init__(self, metric_manager):
+        self.metric_manager = metric_manager
+        self._metrics = {}
+
+    def get_metrics(self, name):
+        """Return the `(count, latency)` metrics for `name`."""
+        metrics = self._metrics.get(name)
+        if metrics is None:
+            count = self.metric_manager.register(Count('%s.count' % (name,)))
+            latency = self.metric_manager.register(
+                Timer('%s.latency' % (name,), self.LATENCY_AGGREGATORS))
+            metrics = self._metrics[name] = (count, latency)
+        return metrics
+
+    def wrap(self, name, func):
+        """
+        Return a wrapper for `func` that records its latency as `name`.
+
+        If `func` returns a Deferred, the latency is recorded when it
+        fires.
+        """
+        count, latency = self.get_metrics(name)
+
+        def _record(result, start):
+            count.inc()
+            latency.set(time.time() - start)
+            return result
+
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            start = time.time()
+            try:
+                result = func(*args, **kw)
+            except:
+                _record(None, start)
+                raise
+            if isinstance(result, Deferred):
+                return result.addBoth(_record, start)
+            return _record(result, start)
+
+        return wrapper
+
+    def instrument(self, obj, method_name, name):
+        """Replace `obj.method_name` with a wrapper that records `name`."""
+        setattr(obj, method_name, self.wrap(name, getattr(obj, method_name)))
+
+    def stop(self):
+        self.metric_manager.stop()
+
+
+@inlineCallbacks
+def start_latency_recorder(worker, worker_name):
+    """
+    Start a :class:`LatencyRecorder` for `worker` if ``latency_metrics``
+    is set in its config.
+
+    Returns a Deferred that fires with the recorder, or with ``None`` if
+    latency metrics are disabled.
+    """
+    config = worker.config
+    if not config.get('latency_metrics', False):
+        returnValue(None)
+    prefix = config.get('latency_metrics_prefix',
+                        'vumi.latency.%s.' % (worker_name,))
+    interval = config.get('latency_metrics_interval', 5)
+    metric_manager = yield worker.start_publisher(MetricManager, prefix,
+                                                  interval)
+    returnValue(LatencyRecorder(metric_manager))
@@ -0,0 +1,89 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, Deferred
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.blinkenlights.latency import (LatencyRecorder,
+                                        start_latency_recorder)
+from vumi.service import Worker
+from vumi.tests.utils import get_stubbed_worker
+
+
+class LatencyRecorderTestCase(TestCase):
+
+    def setUp(self):
+        self.mm = MetricManager('vumi.test.')
+        self.recorder = LatencyRecorder(self.mm)
+
+    def assert_recorded(self, name, count):
+        self.assertEqual([v for _, v in self.mm[name + '.count'].poll()],
+                         [1.0] * count)
+        latencies = self.mm[name + '.latency'].poll()
+        self.assertEqual(len(latencies), count)
+        self.assertTrue(all(v >= 0 for _, v in latencies))
+
+    def test_metrics_registered(self):
+        count, latency = self.recorder.get_metrics('foo')
+        self.assertEqual(count.name, 'vumi.test.foo.count')
+        self.assertEqual(latency.name, 'vumi.test.foo.latency')
+        self.assertEqual(latency.aggs, ('avg', 'max', 'min'))
+        self.assertEqual(self.recorder.get_metrics('foo'), (count, latency))
+
+    def test_wrap_sync(self):
+        wrapped = self.recorder.wrap('foo', lambda x: x + 1)
+        self.assertEqual(wrapped(1), 2)
+        self.assert_recorded('foo', 1)
+
+    def test_wrap_deferred(self):
+        d = Deferred()
+        wrapped = self.recorder.wrap('foo', lambda: d)
+        result = wrapped()
+        self.assert_recorded('foo', 0)
+        d.callback('done')
+        self.assertEqual(self.successResultOf(result), 'done')
+        self.assert_recorded('foo', 1)
+
+    def test_wrap_exception(self):
+        def fail():
+            raise ValueError("Failed.")
+        wrapped = self.recorder.wrap('foo', fail)
+        self.assertRaises(ValueError, wrapped)
+        self.assert_recorded('foo', 1)
+
+    def test_instrument(self):
+        class Handler(object):
+            def handle(self, x):
+                return x * 2
+
+        handler = Handler()
+        self.recorder.instrument(handler, 'handle', 'handler.handle')
+        self.assertEqual(handler.handle(3), 6)
+        self.assert_recorded('handler.handle', 1)
+
+
+class StartLatencyRecorderTestCase(TestCase):
+
+    @inlineCallbacks
+    def test_disabled(self):
+        worker = get_stubbed_worker(Worker, {})
+        recorder = yield start_latency_recorder(worker, 'foo')
+        self.assertEqual(recorder, None)
+
+    @inlineCallbacks
+    def test_enabled(self):
+        worker = get_stubbed_worker(Worker, {
+            'latency_metrics': True,
+            'latency_metrics_interval': 60,
+        })
+        recorder = yield start_latency_recorder(worker, 'foo')
+        self.assertEqual(recorder.metric_manager.prefix, 'vumi.latency.foo.')
+        recorder.stop()
+
+    @inlineCallbacks
+    def test_prefix(self):
+        worker = get_stubbed_worker(Worker, {
+            'latency_metrics': True,
+            'latency_metrics_prefix': 'custom.',
+        })
+        recorder = yield start_latency_recorder(worker, 'foo')
+        self.assertEqual(recorder.metric_manager.prefix, 'custom.')
+        recorder.stop()
@@ -4,15 +4,21 @@
 
 import re
 import functools
+import sre_parse
+import sre_constants
 import redis
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, maybeDeferred
 
 from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.utils import load_class_by_string, get_first_word
+from vumi.utils import (load_class_by_string, get_first_word,
+                        gather_deferred_dict, async_redis_from_config,
+                        LRUCache)
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.blinkenlights.latency import start_latency_recorder
+from vumi.dispatchers.endpoint_index import MessageEndpointIndex
 from vumi import log
 
 
@@ -21,75 +27,123 @@ class BaseDispatchWorker(Worker):
 
     """
 
+    latency_recorder = None
+
     @inlineCallbacks
     def startWorker(self):
         log.msg('Starting a %s dispatcher with config: %s'
                 % (self.__class__.__name__, self.config))
 
-        yield self.setup_endpoints()
-        yield self.setup_middleware()
-        yield self.setup_router()
-        yield self.setup_transport_publishers()
-        yield self.setup_exposed_publishers()
-        yield self.setup_transport_consumers()
-        yield self.setup_exposed_consumers()
+        yield self.run_startup_phase('endpoints', self.setup_endpoints)
+        yield self.run_startup_phase('middleware', self.setup_middleware)
+        yield self.run_startup_phase('router', self.setup_router)
+        if self.latency_recorder is not None:
+            for method_name in ['dispatch_inbound_message',
+                                'dispatch_inbound_event',
+                                'dispatch_outbound_message']:
+                self.latency_recorder.instrument(
+                    self._router, method_name, 'router.%s' % (method_name,))
+        # Publishers need to exist before any consumers start, because
+        # consumed messages get routed straight to them.
+        yield self.run_startup_phase('publishers', self.setup_publishers)
+        yield self.run_startup_phase('consumers', self.setup_consumers)
 
     def setup_endpoints(self):
         self._transport_names = self.config.get('transport_names', [])
         self._exposed_names = self.config.get('exposed_names', [])
+        # Most routers only look at a few fields, so we only decode
+        # messages when they're needed and republish them without
+        # re-encoding them if they're unchanged.
+        self._lazy_decode = self.config.get('lazy_decode', True)
+
+    @inlineCallbacks
+    def stopWorker(self):
+        if getattr(self, '_router', None) is not None:
+            yield self._router.teardown_routing()
+        if getattr(self, '_middlewares', None) is not None:
+            yield self._middlewares.teardown()
+        if self.latency_recorder is not None:
+            self.latency_recorder.stop()
 
     @inlineCallbacks
     def setup_middleware(self):
+        self.latency_recorder = yield start_latency_recorder(
+            self, self.config.get('dispatcher_name', type(self).__name__))
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        self._middlewares = MiddlewareStack(middlewares, self.latency_recorder)
 
     def setup_router(self):
         router_cls = load_class_by_string(self.config['router_class'])
         self._router = router_cls(self, self.config)
 
+    @inlineCallbacks
+    def setup_publishers(self):
+        # start both sets before waiting for either
+        yield gather_deferred_dict({
+            'transport': maybeDeferred(self.setup_transport_publishers),
+            'exposed': maybeDeferred(self.setup_exposed_publishers),
+            })
+
+    @inlineCallbacks
+    def setup_consumers(self):
+        # start both sets before waiting for either
+        yield gather_deferred_dict({
+            'transport': maybeDeferred(self.setup_transport_consumers),
+            'exposed': maybeDeferred(self.setup_exposed_consumers),
+            })
+
     @inlineCallbacks
     def setup_transport_publishers(self):
-        self.transport_publisher = {}
-        for transport_name in self._transport_names:
-            self.transport_publisher[transport_name] = yield self.publish_to(
-                '%s.outbound' % (transport_name,))
+        self.transport_publisher = yield gather_deferred_dict(dict(
+            (name, self.publish_to('%s.outbound' % (name,)))
+            for name in self._transport_names))
 
     @inlineCallbacks
     def setup_transport_consumers(self):
-        self.transport_consumer = {}
-        self.transport_event_consumer = {}
+        inbound, events = {}, {}
         for transport_name in self._transport_names:
-            self.transport_consumer[transport_name] = yield self.consume(
+            inbound[transport_name] = self.consume(
                 '%s.inbound' % (transport_name,),
                 functools.partial(self.dispatch_inbound_message,
                                   transport_name),
-                message_class=TransportUserMessage)
-        for transport_name in self._transport_names:
-            self.transport_event_consumer[transport_name] = yield self.consume(
+                message_class=TransportUserMessage,
+                lazy_decode=self._lazy_decode)
+            events[transport_name] = self.consume(
                 '%s.event' % (transport_name,),
                 functools.partial(self.dispatch_inbound_event, transport_name),
-                message_class=TransportEvent)
+                message_class=TransportEvent, lazy_decode=self._lazy_decode)
+        consumers = yield gather_deferred_dict({
+            'inbound': gather_deferred_dict(inbound),
+            'events': gather_deferred_dict(events),
+            })
+        self.transport_consumer = consumers['inbound']
+        self.transport_event_consumer = consumers['events']
 
     @inlineCallbacks
     def setup_exposed_publishers(self):
-        self.exposed_publisher = {}
-        self.exposed_event_publisher = {}
+        inbound, events = {}, {}
         for exposed_name in self._exposed_names:
-            self.exposed_publisher[exposed_name] = yield self.publish_to(
+            inbound[exposed_name] = self.publish_to(
                 '%s.inbound' % (exposed_name,))
-        for exposed_name in self._exposed_names:
-            self.exposed_event_publisher[exposed_name] = yield self.publish_to(
+            events[exposed_name] = self.publish_to(
                 '%s.event' % (exposed_name,))
+        publishers = yield gather_deferred_dict({
+            'inbound': gather_deferred_dict(inbound),
+            'events': gather_deferred_dict(events),
+            })
+        self.exposed_publisher = publishers['inbound']
+        self.exposed_event_publisher = publishers['events']
 
     @inlineCallbacks
     def setup_exposed_consumers(self):
-        self.exposed_consumer = {}
-        for exposed_name in self._exposed_names:
-            self.exposed_consumer[exposed_name] = yield self.consume(
+        self.exposed_consumer = yield gather_deferred_dict(dict(
+            (exposed_name, self.consume(
                 '%s.outbound' % (exposed_name,),
                 functools.partial(self.dispatch_outbound_message,
                                   exposed_name),
-                message_class=TransportUserMessage)
+                message_class=TransportUserMessage,
+                lazy_decode=self._lazy_decode))
+            for exposed_name in self._exposed_names))
 
     def dispatch_inbound_message(self, endpoint, msg):
         d = self._middlewares.apply_consume("inbound", msg, endpoint)
@@ -152,6 +206,13 @@ class BaseDispatchRouter(object):
         """Perform setup required for routing messages."""
         pass
 
+    def teardown_routing(self):
+        """Perform teardown required when the dispatcher stops.
+
+        May return a Deferred.
+        """
+        pass
+
     def dispatch_inbound_message(self, msg):
         """Dispatch an inbound user message to a publisher.
 
@@ -255,6 +316,59 @@ class TransportToTransportRouter(BaseDispatchRouter):
         pass
 
 
+class RegexPrefixIndex(object):
+    """Finds all the regular expressions in a list that match a string.
+
+    Each regular expression is filed under the literal text it starts
+    with, so :meth:`match` only tries the ones whose literal prefix the
+    string starts with. Lookups cost one dictionary lookup per distinct
+    prefix length plus one match per candidate, however many regular
+    expressions there are.
+
+    :param list patterns:
+        List of `(name, pattern)` pairs.
+    """
+
+    def __init__(self, patterns):
+        self._by_prefix = {}
+        for position, (name, pattern) in enumerate(patterns):
+            regex = re.compile(pattern)
+            prefix = self.literal_prefix(regex)
+            self._by_prefix.setdefault(prefix, []).append(
+                (position, name, regex))
+        self._lengths = sorted(set(len(prefix) for prefix in self._by_prefix))
+
+    @staticmethod
+    def literal_prefix(regex):
+        """Return the literal text every match of `regex` starts with."""
+        if regex.flags & re.IGNORECASE:
+            return ''
+        to_char = unichr if isinstance(regex.pattern, unicode) else chr
+        prefix = []
+        for op, arg in sre_parse.parse(regex.pattern, regex.flags):
+            if (op == sre_constants.AT and not prefix and
+                arg in (sre_constants.AT_BEGINNING,
+                        sre_constants.AT_BEGINNING_STRING)):
+                # A leading ^ or \A matches where match() starts anyway.
+                continue
+            if op != sre_constants.LITERAL:
+                break
+            prefix.append(to_char(arg))
+        return ''.join(prefix)
+
+    def match(self, value):
+        """Return the names of the patterns that match the start of
+        `value`, in the order they were given."""
+        candidates = []
+        for length in self._lengths:
+            if length > len(value):
+                break
+            candidates.extend(self._by_prefix.get(value[:length], ()))
+        candidates.sort()
+        return [name for _position, name, regex in candidates
+                if regex.match(value)]
+
+
 class ToAddrRouter(SimpleDispatchRouter):
     """Router that dispatches based on msg to_addr.
 
@@ -264,29 +378,92 @@ class ToAddrRouter(SimpleDispatchRouter):
         expressions. If a message's to_addr matches the given
         regular expression the message is sent to the applications
         listening on the given transport name.
+    :param int toaddr_cache_size:
+        Number of to_addrs to remember the matching applications for.
+        Default is 10000. Set to 0 to disable the cache.
+
+    If `redis_config` is set, events are routed back to the endpoint each
+    outbound message was sent from, using a
+    :class:`vumi.dispatchers.endpoint_index.MessageEndpointIndex` stored
+    in that Redis server. Otherwise events are dropped. The index can be
+    configured with these options:
+
+    :param int message_index_ttl:
+        Seconds to remember outbound message ids for. Default is seven
+        days.
+    :param int message_index_cache_size:
+        Number of outbound message ids to keep in memory. Default is
+        10000.
+    :param int message_index_batch_size:
+        Maximum number of Redis writes or lookups to send at once.
+        Default is 100.
+    :param float message_index_flush_interval:
+        Seconds to wait for more Redis writes or lookups before sending
+        them. Default is 0 (the next time the reactor runs).
     """
 
+    DEFAULT_TOADDR_CACHE_SIZE = 10000
+
     def setup_routing(self):
         self.mappings = []
         for name, toaddr_pattern in self.config['toaddr_mappings'].items():
             self.mappings.append((name, re.compile(toaddr_pattern)))
             # TODO: assert that name is in list of publishers.
+        self.toaddr_index = RegexPrefixIndex(
+            [(name, regex.pattern) for name, regex in self.mappings])
+        self.toaddr_cache = LRUCache(self.config.get(
+            'toaddr_cache_size', self.DEFAULT_TOADDR_CACHE_SIZE))
+        self.r_server = None
+        self.message_index = None
+        redis_config = self.config.get('redis_config')
+        if redis_config is not None:
+            self.r_server = async_redis_from_config(redis_config)
+            self.message_index = MessageEndpointIndex.from_config(
+                self.r_server,
+                self.config.get('dispatcher_name', type(self).__name__),
+                self.config)
+
+    def teardown_routing(self):
+        if self.message_index is not None:
+            return self.message_index.stop()
+
+    def get_matching_names(self, toaddr):
+        """Return the names of the applications matching `toaddr`."""
+        names = self.toaddr_cache.get(toaddr)
+        if names is None:
+            names = self.toaddr_index.match(toaddr)
+            self.toaddr_cache[toaddr] = names
+        return names
 
     def dispatch_inbound_message(self, msg):
-        toaddr = msg['to_addr']
-        for name, regex in self.mappings:
-            if regex.match(toaddr):
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.dispatcher.publish_inbound_message(name, msg.copy())
+        for name in self.get_matching_names(msg['to_addr']):
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.dispatcher.publish_inbound_message(name, msg.copy())
 
     def dispatch_inbound_event(self, msg):
-        pass
-        # TODO:
-        #   Use msg['user_message_id'] to look up where original message
-        #   was dispatched to and dispatch this message there
-        #   Perhaps there should be a message on the base class to support
-        #   this.
+        if self.message_index is None:
+            return
+        d = self.message_index.get(msg['user_message_id'])
+        d.addCallbacks(self._dispatch_inbound_event, self._lookup_failed,
+                       callbackArgs=(msg,), errbackArgs=(msg,))
+        return d
+
+    def _dispatch_inbound_event(self, name, msg):
+        if name is None:
+            log.error("No endpoint found for message %s while dispatching"
+                      " transport event" % (msg['user_message_id'],))
+            return
+        self.dispatcher.publish_inbound_event(name, msg)
+
+    def _lookup_failed(self, failure, msg):
+        log.error(failure, "Failed to look up endpoint for message %s while"
+                  " dispatching transport event" % (msg['user_message_id'],))
+
+    def dispatch_outbound_message(self, msg):
+        if self.message_index is not None:
+            self.message_index.set(msg['message_id'], msg['transport_name'])
+        super(ToAddrRouter, self).dispatch_outbound_message(msg)
 
 
 class FromAddrMultiplexRouter(BaseDispatchRouter):
@@ -434,14 +611,23 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    Outbound message ids are stored using a
+    :class:`vumi.dispatchers.endpoint_index.MessageEndpointIndex` in the
+    Redis server given by `redis_config`. The `message_index_cache_size`,
+    `message_index_batch_size` and `message_index_flush_interval` options
+    described in :class:`ToAddrRouter` can be used to tune it.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
 
+    # Key for rules that match any to_addr in :attr:`rule_index`.
+    ANY_TO_ADDR = object()
+
     def setup_routing(self):
-        self.r_config = self.config.get('redis_config', {})
         self.r_prefix = self.config['dispatcher_name']
-        self.r_server = redis.Redis(**self.r_config)
+        self.r_server = async_redis_from_config(
+            self.config.get('redis_config', {}))
         self.rules = []
         for rule in self.config.get('rules', []):
             if 'keyword' not in rule or 'app' not in rule:
@@ -454,10 +640,17 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         for transport_name, keyword in keyword_mappings.items():
             self.rules.append({'app': transport_name,
                                'keyword': keyword.lower()})
+        self.rule_index = self.build_rule_index(self.rules)
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
             'expire_routing_memory', self.DEFAULT_ROUTING_TIMEOUT))
+        self.message_index = MessageEndpointIndex.from_config(
+            self.r_server, self.r_prefix, self.config,
+            default_ttl=self.expire_routing_timeout)
+
+    def teardown_routing(self):
+        return self.message_index.stop()
 
     def get_message_key(self, message):
         return self.r_key('message', message)
@@ -481,15 +674,47 @@ class ContentKeywordRouter(SimpleDispatchRouter):
                     (not 'prefix' in rule) or
                     (msg['from_addr'].startswith(rule['prefix']))])
 
+    def build_rule_index(self, rules):
+        """Index `rules` by keyword and then by `to_addr`.
+
+        Rules without a `to_addr` are stored under :attr:`ANY_TO_ADDR`.
+        Each rule is stored with its position in `rules` so that
+        matching rules can be returned in their original order.
+        """
+        index = {}
+        for position, rule in enumerate(rules):
+            to_addrs = index.setdefault(rule['keyword'], {})
+            to_addr = rule.get('to_addr', self.ANY_TO_ADDR)
+            to_addrs.setdefault(to_addr, []).append((position, rule))
+        return index
+
+    def get_matching_rules(self, keyword, msg):
+        """Return the rules matching `msg`, in the order they were
+        configured. This is the same as checking every rule with
+        :meth:`is_msg_matching_routing_rules`, but only looks at the
+        rules for `keyword` and the message's `to_addr`."""
+        to_addrs = self.rule_index.get(keyword)
+        if to_addrs is None:
+            return []
+        candidates = to_addrs.get(msg['to_addr'], [])
+        any_to_addr = to_addrs.get(self.ANY_TO_ADDR)
+        if any_to_addr and candidates:
+            candidates = sorted(candidates + any_to_addr)
+        elif any_to_addr:
+            candidates = any_to_addr
+        from_addr = msg['from_addr']
+        return [rule for _position, rule in candidates
+                if 'prefix' not in rule or
+                from_addr.startswith(rule['prefix'])]
+
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
         matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
+        for rule in self.get_matching_rules(keyword, msg):
+            matched = True
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
         if not matched:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
@@ -497,26 +722,32 @@ class ContentKeywordRouter(SimpleDispatchRouter):
                 log.error('Message could not be routed: %r' % (msg,))
 
     def dispatch_inbound_event(self, msg):
-        message_key = self.get_message_key(msg['user_message_id'])
-        name = self.r_server.get(message_key)
+        d = self.message_index.get(msg['user_message_id'])
+        d.addCallbacks(self._dispatch_inbound_event, self._lookup_failed,
+                       callbackArgs=(msg,), errbackArgs=(msg,))
+        return d
+
+    def _dispatch_inbound_event(self, name, msg):
         if not name:
             log.error("No transport_name for return route found in Redis"
                       " while dispatching transport event for message %s"
                       % (msg['user_message_id'],))
+            return
         try:
             self.publish_exposed_event(name, msg)
         except:
             log.error("No publishing route for %s" % (name,))
 
-    @inlineCallbacks
+    def _lookup_failed(self, failure, msg):
+        log.error(failure, "Failed to look up transport_name for message %s"
+                  " while dispatching transport event"
+                  % (msg['user_message_id'],))
+
     def dispatch_outbound_message(self, msg):
         transport_name = self.transport_mappings.get(msg['from_addr'])
         if transport_name is not None:
             self.publish_transport(transport_name, msg)
-            message_key = self.get_message_key(msg['message_id'])
-            self.r_server.set(message_key, msg['transport_name'])
-            yield self.r_server.expire(message_key,
-                                       self.expire_routing_timeout)
+            self.message_index.set(msg['message_id'], msg['transport_name'])
         else:
             log.error("No transport for %s" % (msg['from_addr'],))
 
@@ -0,0 +1,168 @@
+# -*- test-case-name: vumi.dispatchers.tests.test_endpoint_index -*-
+
+"""Remembers which endpoint outbound messages were sent from."""
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed, gatherResults
+
+from vumi.utils import LRUCache
+from vumi import log
+
+
+class MessageEndpointIndex(object):
+    """Index of outbound message ids to the endpoints they came from.
+
+    Routers use this to send events for a message back to the endpoint
+    that sent it. Recently stored endpoints are kept in a local LRU
+    cache. All of them are written to Redis with ``SETEX`` so that they
+    survive restarts and are shared between processes.
+
+    Writes and cache misses are batched. Writes are sent as a single
+    pipeline and misses are looked up with a single ``MGET``, either
+    `flush_interval` seconds after the first one or as soon as
+    `batch_size` of them are waiting, whichever comes first. A burst of
+    delivery reports therefore costs one Redis round trip rather than
+    one per event, and none of them block the reactor.
+
+    :type r_server: vumi.persist.async_redis.AsyncRedis
+    :param r_server:
+        Redis client whose commands return Deferreds.
+    :param str key_prefix:
+        Prefix for Redis keys. Keys look like
+        ``<key_prefix>:message:<message_id>``.
+    :param int ttl:
+        Seconds to keep message ids in Redis for.
+    :param int cache_size:
+        Number of message ids to keep in the local cache.
+    :param int batch_size:
+        Maximum number of writes or lookups to send at once.
+    :param float flush_interval:
+        Seconds to wait for more writes or lookups before sending them.
+    """
+
+    def __init__(self, r_server, key_prefix, ttl, cache_size=10000,
+                 batch_size=100, flush_interval=0, clock=None):
+        self.r_server = r_server
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self._cache = LRUCache(cache_size)
+        self._writes = {}  # message_id -> endpoint
+        self._writing = {}  # message_id -> endpoint, for writes in flight
+        self._lookups = {}  # message_id -> [Deferred, ...]
+        self._timer = None
+
+    @classmethod
+    def from_config(cls, r_server, key_prefix, config,
+                    default_ttl=60 * 60 * 24 * 7):
+        """Create an index from the ``message_index_*`` options in
+        a router's `config`. `default_ttl` is used if
+        ``message_index_ttl`` isn't set."""
+        return cls(r_server, key_prefix,
+                   ttl=int(config.get('message_index_ttl', default_ttl)),
+                   cache_size=config.get('message_index_cache_size', 10000),
+                   batch_size=config.get('message_index_batch_size', 100),
+                   flush_interval=config.get('message_index_flush_interval',
+                                             0))
+
+    def message_key(self, message_id):
+        return ':'.join([self.key_prefix, 'message', str(message_id)])
+
+    def set(self, message_id, endpoint):
+        """Remember that `message_id` was sent from `endpoint`."""
+        self._cache[message_id] = endpoint
+        self._writes[message_id] = endpoint
+        self._schedule(len(self._writes))
+
+    def get(self, message_id):
+        """Return a Deferred that fires with the endpoint for
+        `message_id`, or ``None`` if it isn't known."""
+        endpoint = self._cache.get(message_id)
+        if endpoint is None:
+            endpoint = (self._writes.get(message_id) or
+                        self._writing.get(message_id))
+        if endpoint is not None:
+            return succeed(endpoint)
+        d = Deferred()
+        self._lookups.setdefault(message_id, []).append(d)
+        self._schedule(len(self._lookups))
+        return d
+
+    def get_many(self, message_ids):
+        """Return a Deferred that fires with a dict of message ids to
+        endpoints (or ``None``) for all of `message_ids`."""
+        message_ids = list(message_ids)
+        d = gatherResults([self.get(message_id)
+                           for message_id in message_ids])
+        d.addCallback(lambda endpoints: dict(zip(message_ids, endpoints)))
+        return d
+
+    def _schedule(self, waiting):
+        if waiting >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.flush_interval,
+                                               self.flush)
+
+    def flush(self):
+        """Send all waiting writes and lookups to Redis.
+
+        Returns a Deferred that fires when they're done.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        return gatherResults([self._flush_writes(), self._flush_lookups()])
+
+    def _flush_writes(self):
+        writes, self._writes = self._writes, {}
+        if not writes:
+            return succeed(None)
+        # Lookups mustn't miss these before they reach Redis.
+        self._writing.update(writes)
+        pipe = self.r_server.pipeline()
+        for message_id, endpoint in writes.iteritems():
+            pipe.setex(name=self.message_key(message_id), value=endpoint,
+                       time=self.ttl)
+        d = pipe.execute()
+        d.addErrback(log.err)
+        d.addCallback(self._writes_done, writes)
+        return d
+
+    def _writes_done(self, _result, writes):
+        for message_id, endpoint in writes.iteritems():
+            if self._writing.get(message_id) == endpoint:
+                del self._writing[message_id]
+
+    def _flush_lookups(self):
+        lookups, self._lookups = self._lookups, {}
+        if not lookups:
+            return succeed(None)
+        message_ids = lookups.keys()
+        d = self.r_server.mget([self.message_key(message_id)
+                                for message_id in message_ids])
+        d.addCallbacks(self._lookups_done, self._lookups_failed,
+                       callbackArgs=(message_ids, lookups),
+                       errbackArgs=(lookups,))
+        return d
+
+    def _lookups_done(self, endpoints, message_ids, lookups):
+        for message_id, endpoint in zip(message_ids, endpoints):
+            if endpoint is not None:
+                self._cache[message_id] = endpoint
+            for d in lookups[message_id]:
+                d.callback(endpoint)
+
+    def _lookups_failed(self, failure, lookups):
+        for deferreds in lookups.itervalues():
+            for d in deferreds:
+                d.errback(failure)
+
+    def stop(self):
+        """Send anything still waiting. Returns a Deferred."""
+        return self.flush()
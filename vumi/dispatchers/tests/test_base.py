@@ -1,12 +1,13 @@
+import re
 from datetime import datetime
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, fail
 
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.errors import ConfigError
 from vumi.dispatchers.base import (BaseDispatchWorker, ToAddrRouter,
-                                   FromAddrMultiplexRouter)
+                                   FromAddrMultiplexRouter, RegexPrefixIndex)
 from vumi.middleware import MiddlewareStack
 from vumi.tests.utils import get_stubbed_worker, FakeRedis, LogCatcher
 from vumi.tests.fake_amqp import FakeAMQPBroker
@@ -333,6 +334,26 @@ class TestBaseDispatchWorker(TestCase, MessageMakerMixIn):
         self.assert_messages(apps, 'transport2.outbound', msgs)
         self.assert_no_messages('transport1.outbound', 'transport3.outbound')
 
+    def test_setup_publishers_failure(self):
+        def fail_setup():
+            raise ValueError("Oops")
+        self.worker.setup_transport_publishers = fail_setup
+        self.worker.setup_exposed_publishers = fail_setup
+        # Both failures are handled, not just the first.
+        return self.assertFailure(self.worker.setup_publishers(), ValueError)
+
+    @inlineCallbacks
+    def test_latency_metrics(self):
+        yield self.get_worker(dispatcher_name='sphex', latency_metrics=True)
+        mm = self.worker.latency_recorder.metric_manager
+        self.assertEqual(mm.prefix, 'vumi.latency.sphex.')
+        yield self.dispatch(self.mkmsg_in('transport1'), 'transport1.inbound')
+        for name in ['router.dispatch_inbound_message',
+                     'middleware.mw1.inbound.consume',
+                     'middleware.mw2.inbound.publish']:
+            self.assertEqual(len(mm[name + '.count'].poll()), 1)
+            self.assertEqual(len(mm[name + '.latency'].poll()), 1)
+
 
 class DummyDispatcher(BaseDispatchWorker):
 
@@ -371,6 +392,16 @@ class TestToAddrRouter(TestCase, MessageMakerMixIn):
         self.dispatcher = DummyDispatcher(self.config)
         self.router = ToAddrRouter(self.dispatcher, self.config)
 
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.router.teardown_routing()
+        if self.router.r_server is not None:
+            self.router.r_server.teardown()
+
+    def enable_message_index(self):
+        self.config['redis_config'] = 'FAKE_REDIS'
+        self.router.setup_routing()
+
     def test_dispatch_inbound_message(self):
         msg = self.mkmsg_in(to_addr='to:foo:1', transport_name='transport1')
         self.router.dispatch_inbound_message(msg)
@@ -378,6 +409,94 @@ class TestToAddrRouter(TestCase, MessageMakerMixIn):
         self.assertEqual(publishers['app1'].msgs, [msg])
         self.assertEqual(publishers['app2'].msgs, [])
 
+    @inlineCallbacks
+    def test_dispatch_inbound_event(self):
+        self.enable_message_index()
+        msg = self.mkmsg_out(transport_name='app2')
+        self.config['transport_mappings'] = {'app2': 'transport1'}
+        self.router.dispatch_outbound_message(msg)
+        yield self.router.message_index.flush()
+        self.assertEqual(self.router.r_server.sync.get(
+            'ToAddrRouter:message:%s' % (msg['message_id'],)), 'app2')
+
+        ack = self.mkmsg_ack(transport_name='transport1',
+                             user_message_id=msg['message_id'])
+        yield self.router.dispatch_inbound_event(ack)
+        publishers = self.dispatcher.exposed_event_publisher
+        self.assertEqual(publishers['app1'].msgs, [])
+        self.assertEqual(publishers['app2'].msgs, [ack])
+
+    @inlineCallbacks
+    def test_dispatch_inbound_event_unknown_message(self):
+        self.enable_message_index()
+        ack = self.mkmsg_ack(transport_name='transport1',
+                             user_message_id='unknown')
+        with LogCatcher() as log:
+            yield self.router.dispatch_inbound_event(ack)
+            [error] = log.errors
+        self.assertTrue('No endpoint found for message unknown'
+                        in error['message'][0])
+        publishers = self.dispatcher.exposed_event_publisher
+        self.assertEqual(publishers['app1'].msgs, [])
+        self.assertEqual(publishers['app2'].msgs, [])
+
+    @inlineCallbacks
+    def test_dispatch_inbound_event_lookup_failure(self):
+        self.enable_message_index()
+        self.router.message_index.get = lambda message_id: fail(
+            ValueError("Redis is down."))
+        ack = self.mkmsg_ack(transport_name='transport1',
+                             user_message_id='1')
+        yield self.router.dispatch_inbound_event(ack)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        publishers = self.dispatcher.exposed_event_publisher
+        self.assertEqual(publishers['app1'].msgs, [])
+        self.assertEqual(publishers['app2'].msgs, [])
+
+    def test_dispatch_inbound_event_without_message_index(self):
+        self.assertEqual(self.router.message_index, None)
+        msg = self.mkmsg_out(transport_name='transport1')
+        self.router.dispatch_outbound_message(msg)
+        ack = self.mkmsg_ack(transport_name='transport1',
+                             user_message_id=msg['message_id'])
+        self.router.dispatch_inbound_event(ack)
+        publishers = self.dispatcher.exposed_event_publisher
+        self.assertEqual(publishers['app1'].msgs, [])
+        self.assertEqual(publishers['app2'].msgs, [])
+
+    def test_dispatch_inbound_message_multiple_matches(self):
+        self.config['toaddr_mappings']['app2'] = 'to:foo'
+        self.router.setup_routing()
+        msg = self.mkmsg_in(to_addr='to:foo:1', transport_name='transport1')
+        self.router.dispatch_inbound_message(msg)
+        publishers = self.dispatcher.exposed_publisher
+        self.assertEqual(publishers['app1'].msgs, [msg])
+        self.assertEqual(publishers['app2'].msgs, [msg])
+
+    def test_matching_names_cached(self):
+        self.assertEqual(self.router.get_matching_names('to:foo:1'), ['app1'])
+        self.assertEqual(self.router.toaddr_cache.get('to:foo:1'), ['app1'])
+        self.router.toaddr_cache['to:foo:1'] = ['app2']
+        self.assertEqual(self.router.get_matching_names('to:foo:1'), ['app2'])
+
+    def test_matching_names_cache_disabled(self):
+        self.config['toaddr_cache_size'] = 0
+        self.router.setup_routing()
+        self.assertEqual(self.router.get_matching_names('to:app2'), ['app2'])
+        self.assertEqual(len(self.router.toaddr_cache), 0)
+
+    def test_anchored_mappings(self):
+        self.config['toaddr_mappings'] = {
+            'app1': '^to:.*:1',
+            'app2': '^to:app2',
+            }
+        self.router.setup_routing()
+        self.assertEqual(sorted(self.router.toaddr_index._by_prefix),
+                         ['to:', 'to:app2'])
+        self.assertEqual(self.router.get_matching_names('to:foo:1'), ['app1'])
+        self.assertEqual(self.router.get_matching_names('to:app2'), ['app2'])
+        self.assertEqual(self.router.get_matching_names('xto:app2'), [])
+
     def test_dispatch_outbound_message(self):
         msg = self.mkmsg_out(transport_name='transport1')
         self.router.dispatch_outbound_message(msg)
@@ -395,6 +514,44 @@ class TestToAddrRouter(TestCase, MessageMakerMixIn):
         self.assertEqual(publishers['transport1'].msgs, [msg])
 
 
+class TestRegexPrefixIndex(TestCase):
+
+    def test_literal_prefix(self):
+        def prefix(pattern):
+            return RegexPrefixIndex.literal_prefix(re.compile(pattern))
+        self.assertEqual(prefix('to:.*:1'), 'to:')
+        self.assertEqual(prefix('8181$'), '8181')
+        self.assertEqual(prefix(r'\+2783\d+'), '+2783')
+        self.assertEqual(prefix('12?3'), '1')
+        self.assertEqual(prefix('(12)3'), '')
+        self.assertEqual(prefix('1|2'), '')
+        self.assertEqual(prefix('(?i)abc'), '')
+        self.assertEqual(prefix('^8181'), '8181')
+        self.assertEqual(prefix(r'\A8181'), '8181')
+        self.assertEqual(prefix('^^12'), '12')
+        self.assertEqual(prefix('1^2'), '1')
+
+    def test_match_anchored(self):
+        patterns = [('a', '^12'), ('b', r'^\+27'), ('c', '^1$')]
+        index = RegexPrefixIndex(patterns)
+        self.assertEqual(index._lengths, [1, 2, 3])
+        for value in ['123', '+2782', '1', '2']:
+            self.assertEqual(
+                index.match(value),
+                [name for name, pattern in patterns
+                 if re.match(pattern, value)])
+
+    def test_match(self):
+        patterns = [('a', '1234'), ('b', '12'), ('c', '.*4$'), ('d', '2'),
+                    ('e', '123[45]')]
+        index = RegexPrefixIndex(patterns)
+        for value in ['1234', '1235', '12', '2', '1', '4', '']:
+            self.assertEqual(
+                index.match(value),
+                [name for name, pattern in patterns
+                 if re.match(pattern, value)])
+
+
 class TestTransportToTransportRouter(TestCase, MessageMakerMixIn):
 
     @inlineCallbacks
@@ -629,9 +786,9 @@ class TestContentKeywordRouter(DispatcherTestCase):
             'expire_routing_memory': '3',
             }
         self.fake_redis = FakeRedis()
+        self.config['redis_config'] = self.fake_redis
         self.dispatcher = yield self.get_dispatcher(self.config)
         self.router = self.dispatcher._router
-        self.router.r_server = self.fake_redis
 
     def tearDown(self):
         self.fake_redis.teardown()
@@ -705,12 +862,35 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                         direction='inbound')
         self.assertEqual(app1_inbound_msg, [msg])
 
+    def test_get_matching_rules(self):
+        rules = [
+            {'app': 'app1', 'keyword': 'a', 'to_addr': '8181'},
+            {'app': 'app2', 'keyword': 'a'},
+            {'app': 'app3', 'keyword': 'a', 'to_addr': '8181',
+             'prefix': '+256'},
+            {'app': 'app1', 'keyword': 'a', 'prefix': '+27'},
+            {'app': 'app2', 'keyword': 'b', 'to_addr': '8282'},
+            {'app': 'app2', 'keyword': 'a', 'to_addr': '8181'},
+            ]
+        self.router.rules = rules
+        self.router.rule_index = self.router.build_rule_index(rules)
+        for keyword in ['a', 'b', 'c']:
+            for to_addr in ['8181', '8282']:
+                for from_addr in ['+256788601462', '+27831234567']:
+                    msg = self.mkmsg_in(to_addr=to_addr, from_addr=from_addr)
+                    expected = [
+                        rule for rule in rules
+                        if self.router.is_msg_matching_routing_rules(
+                            keyword, msg, rule)]
+                    self.assertEqual(
+                        self.router.get_matching_rules(keyword, msg),
+                        expected)
+
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
         msg = self.mkmsg_ack(user_message_id='1',
                              transport_name='transport1')
-        self.router.r_server.set('keyword_dispatcher:message:1',
-                                 'app2')
+        self.fake_redis.set('keyword_dispatcher:message:1', 'app2')
 
         yield self.dispatch(msg,
                             transport_name='transport1',
@@ -770,8 +950,43 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                        direction='outbound')
         self.assertEqual(transport2_msgs, [])
 
+        yield self.router.message_index.flush()
         app2_route = self.fake_redis.get('keyword_dispatcher:message:1')
         self.assertEqual(app2_route, 'app2')
+        self.assertTrue('keyword_dispatcher:message:1'
+                        in self.fake_redis._expiries)
+        self.assertEqual(self.router.message_index.ttl, 3)
+
+    @inlineCallbacks
+    def test_outbound_then_event_routing(self):
+        msg = self.mkmsg_out(content="KEYWORD1 rest of msg",
+                             from_addr='shortcode1',
+                             transport_name='app2')
+        yield self.dispatch(msg, transport_name='app2',
+                            direction='outbound')
+        ack = self.mkmsg_ack(user_message_id=msg['message_id'],
+                             transport_name='transport1')
+        # The endpoint is found in the index's cache before it's written.
+        self.assertEqual(self.fake_redis.get('keyword_dispatcher:message:1'),
+                         None)
+        yield self.dispatch(ack, transport_name='transport1',
+                            direction='event')
+        self.assertEqual(self.get_dispatched_messages('app2',
+                                                      direction='event'),
+                         [ack])
+
+    @inlineCallbacks
+    def test_inbound_event_routing_lookup_failure(self):
+        self.router.message_index.get = lambda message_id: fail(
+            ValueError("Redis is down."))
+        msg = self.mkmsg_ack(user_message_id='1',
+                             transport_name='transport1')
+        yield self.dispatch(msg, transport_name='transport1',
+                            direction='event')
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.get_dispatched_messages('app2',
+                                                      direction='event'),
+                         [])
 
 
 class TestRedirectOutboundRouter(DispatcherTestCase):
@@ -811,6 +1026,14 @@ class TestRedirectOutboundRouter(DispatcherTestCase):
         self.assertEqual(outbound1, msgt1)
         self.assertEqual(outbound2, msgt2)
 
+    @inlineCallbacks
+    def test_outbound_redirect_passes_body_through(self):
+        msg = self.mkmsg_out(transport_name='app1')
+        yield self.dispatch(msg, transport_name='app1', direction='outbound')
+        [consumed] = self._amqp.get_dispatched('vumi', 'app1.outbound')
+        [published] = self._amqp.get_dispatched('vumi', 'transport1.outbound')
+        self.assertTrue(consumed.body is published.body)
+
     @inlineCallbacks
     def test_error_logging_for_bad_app(self):
         msgt1 = self.mkmsg_out(transport_name='app3')  # Does not exist
@@ -0,0 +1,119 @@
+"""Tests for vumi.dispatchers.endpoint_index."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, fail
+from twisted.internet.task import Clock
+
+from vumi.dispatchers.endpoint_index import MessageEndpointIndex
+from vumi.tests.utils import FakeAsyncRedis
+
+
+class CountingFakeAsyncRedis(FakeAsyncRedis):
+    """Counts pipelines and MGETs sent to a FakeAsyncRedis."""
+
+    def __init__(self):
+        super(CountingFakeAsyncRedis, self).__init__()
+        self.pipelines = 0
+        self.mgets = 0
+
+    def pipeline(self, transaction=True):
+        self.pipelines += 1
+        return super(CountingFakeAsyncRedis, self).pipeline(transaction)
+
+    def mget(self, keys, *args):
+        self.mgets += 1
+        return super(CountingFakeAsyncRedis, self).mget(keys, *args)
+
+
+class TestMessageEndpointIndex(TestCase):
+
+    def setUp(self):
+        self.r_server = CountingFakeAsyncRedis()
+        self.clock = Clock()
+
+    def tearDown(self):
+        self.r_server.teardown()
+
+    def make_index(self, **kw):
+        kw.setdefault('flush_interval', 1)
+        kw.setdefault('clock', self.clock)
+        return MessageEndpointIndex(self.r_server, 'prefix', 60, **kw)
+
+    def set_stored(self, message_id, endpoint):
+        self.r_server.sync.set('prefix:message:%s' % (message_id,), endpoint)
+
+    def get_stored(self, message_id):
+        return self.r_server.sync.get('prefix:message:%s' % (message_id,))
+
+    def test_writes_pipelined(self):
+        index = self.make_index()
+        index.set('msg1', 'app1')
+        index.set('msg2', 'app2')
+        self.assertEqual(self.get_stored('msg1'), None)
+        self.clock.advance(1)
+        self.assertEqual(self.r_server.pipelines, 1)
+        self.assertEqual(self.get_stored('msg1'), 'app1')
+        self.assertEqual(self.get_stored('msg2'), 'app2')
+        self.assertTrue('prefix:message:msg1' in self.r_server.sync._expiries)
+
+    def test_writes_flushed_at_batch_size(self):
+        index = self.make_index(batch_size=2)
+        index.set('msg1', 'app1')
+        self.assertEqual(self.r_server.pipelines, 0)
+        index.set('msg2', 'app2')
+        self.assertEqual(self.r_server.pipelines, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_get_cached(self):
+        index = self.make_index()
+        index.set('msg1', 'app1')
+        d = index.get('msg1')
+        self.assertEqual(self.successResultOf(d), 'app1')
+        self.assertEqual(self.r_server.mgets, 0)
+
+    def test_get_pending_write_without_cache(self):
+        index = self.make_index(cache_size=0)
+        index.set('msg1', 'app1')
+        self.assertEqual(self.successResultOf(index.get('msg1')), 'app1')
+
+    def test_lookups_batched(self):
+        self.set_stored('msg1', 'app1')
+        self.set_stored('msg2', 'app2')
+        index = self.make_index()
+        d1 = index.get('msg1')
+        d2 = index.get('msg2')
+        d3 = index.get('msg1')
+        d4 = index.get('unknown')
+        self.assertFalse(d1.called)
+        self.clock.advance(1)
+        self.assertEqual(self.r_server.mgets, 1)
+        self.assertEqual([self.successResultOf(d) for d in [d1, d2, d3, d4]],
+                         ['app1', 'app2', 'app1', None])
+        # Found endpoints are cached.
+        self.assertEqual(self.successResultOf(index.get('msg2')), 'app2')
+        self.assertEqual(self.r_server.mgets, 1)
+
+    def test_get_many(self):
+        self.set_stored('msg1', 'app1')
+        index = self.make_index()
+        index.set('msg2', 'app2')
+        d = index.get_many(['msg1', 'msg2', 'unknown'])
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), {
+            'msg1': 'app1', 'msg2': 'app2', 'unknown': None})
+        self.assertEqual(self.r_server.mgets, 1)
+
+    def test_lookup_failure(self):
+        index = self.make_index()
+        self.r_server.mget = lambda keys: fail(ValueError("Oops"))
+        d = index.get('msg1')
+        self.clock.advance(1)
+        self.failureResultOf(d).trap(ValueError)
+
+    @inlineCallbacks
+    def test_stop(self):
+        index = self.make_index()
+        index.set('msg1', 'app1')
+        yield index.stop()
+        self.assertEqual(self.get_stored('msg1'), 'app1')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
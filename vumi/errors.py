@@ -18,5 +18,17 @@ class InvalidMessageField(InvalidMessage):
     pass
 
 
+class MessageCodecError(VumiError):
+    pass
+
+
+class RoutingKeyError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
 class ConfigError(VumiError):
     pass
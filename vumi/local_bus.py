@@ -0,0 +1,342 @@
+# -*- test-case-name: vumi.tests.test_local_bus -*-
+
+"""An in-process message bus for workers that run in the same process.
+
+Publishing to the local bus hands :class:`vumi.message.Message` objects
+straight to consumers in the same process, without serialising them or
+sending them through the AMQP broker. Queues deliver messages in order,
+consumers only process as many messages at once as their
+``max_in_flight`` allows, and messages are only removed from their queue
+once they've been acked. Messages that weren't acked (because processing
+them failed or returned ``False``) are requeued when their consumer stops,
+as they would be when an AMQP channel closes.
+
+As with AMQP, messages are delivered from the reactor rather than from
+inside the call that published them, so a publisher never runs its
+consumers' code on its own stack.
+
+Unlike a durable AMQP queue, messages on the local bus are lost if the
+process exits.
+
+Workers use the local bus for the routing keys and exchanges listed in
+their ``local_routing_keys`` and ``local_exchanges`` config options. Every
+worker publishing to or consuming from those routing keys should be in
+the same process and have the same settings, which is easiest to arrange
+with the ``defaults`` section of a :class:`vumi.multiworker.MultiWorker`
+config.
+"""
+
+from itertools import count
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import (DeferredList, succeed, fail,
+                                    maybeDeferred)
+
+from vumi.message import Message
+from vumi.errors import RoutingKeyError
+from vumi import log
+
+
+def topic_matches(binding, routing_key):
+    """
+    Check whether `routing_key` matches an AMQP topic `binding`.
+
+    ``*`` matches exactly one word and ``#`` matches zero or more words.
+    """
+    return _words_match(binding.split('.'), routing_key.split('.'))
+
+
+def _words_match(pattern, words):
+    if not pattern:
+        return not words
+    first, rest = pattern[0], pattern[1:]
+    if first == '#':
+        return any(_words_match(rest, words[i:])
+                   for i in range(len(words) + 1))
+    if not words:
+        return False
+    if first != '*' and first != words[0]:
+        return False
+    return _words_match(rest, words[1:])
+
+
+class LocalQueue(object):
+    """A queue of messages waiting for local consumers."""
+
+    def __init__(self, name, clock=None):
+        self.name = name
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.messages = deque()
+        self.consumers = []
+        self._delivery_call = None
+
+    def put(self, message):
+        self.messages.append(message)
+        self.deliver()
+
+    def requeue(self, messages):
+        """
+        Put unacked messages back at the front of the queue, in order.
+        """
+        self.messages.extendleft(reversed(messages))
+        self.deliver()
+
+    def deliver(self):
+        """
+        Deliver waiting messages to ready consumers the next time the
+        reactor runs.
+        """
+        if self._delivery_call is None:
+            self._delivery_call = self.clock.callLater(0, self._deliver)
+
+    def _deliver(self):
+        # Consumers often publish (or finish processing) while we're
+        # delivering to them. The loop below picks up anything that changes,
+        # so we don't schedule another delivery until it's done.
+        try:
+            while self.messages:
+                consumer = self._next_ready_consumer()
+                if consumer is None:
+                    return
+                consumer.deliver(self.messages.popleft())
+        finally:
+            self._delivery_call = None
+
+    def _next_ready_consumer(self):
+        # Consumers take turns, like they do on an AMQP queue.
+        for i, consumer in enumerate(self.consumers):
+            if consumer.ready():
+                self.consumers.append(self.consumers.pop(i))
+                return consumer
+        return None
+
+
+class LocalExchange(object):
+    """An exchange that routes messages to local queues."""
+
+    def __init__(self, name, exchange_type):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.bindings = {}
+
+    def bind(self, routing_key, queue):
+        self.bindings.setdefault(routing_key, set()).add(queue)
+
+    def route(self, routing_key):
+        if self.exchange_type == 'topic':
+            queues = set()
+            for binding, bound_queues in self.bindings.iteritems():
+                if topic_matches(binding, routing_key):
+                    queues.update(bound_queues)
+            return queues
+        return self.bindings.get(routing_key, set())
+
+
+class LocalMessageBus(object):
+    """Exchanges and queues shared by the workers in a process."""
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.exchanges = {}
+        self.queues = {}
+
+    def exchange_declare(self, name, exchange_type):
+        if name not in self.exchanges:
+            self.exchanges[name] = LocalExchange(name, exchange_type)
+        return self.exchanges[name]
+
+    def queue_declare(self, name):
+        if name not in self.queues:
+            self.queues[name] = LocalQueue(name, self.clock)
+        return self.queues[name]
+
+    def queue_bind(self, queue_name, exchange_name, routing_key):
+        self.exchanges[exchange_name].bind(
+            routing_key, self.queue_declare(queue_name))
+
+    def publish(self, exchange_name, routing_key, message, require_bind=True):
+        """
+        Route a message to the queues bound to `routing_key`.
+
+        Each queue gets its own copy of the message. Vumi workers consume
+        from queues named after their routing keys, so messages published
+        to a direct exchange before anything has bound the routing key are
+        held in a queue of that name.
+        """
+        exchange = self.exchanges[exchange_name]
+        queues = exchange.route(routing_key)
+        if not queues and exchange.exchange_type == 'direct':
+            self.queue_bind(routing_key, exchange_name, routing_key)
+            queues = exchange.route(routing_key)
+        if not queues:
+            if require_bind:
+                raise RoutingKeyError("The routing_key: %s is not bound to "
+                                      "any local queues on exchange %s" % (
+                                          routing_key, exchange_name))
+            return
+        for queue in queues:
+            queue.put(message.copy())
+
+
+class LocalChannel(object):
+    """
+    The parts of an AMQP channel that workers use on their consumers.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+
+    def basic_qos(self, prefetch_size, prefetch_count, global_):
+        self.consumer.prefetch_count = prefetch_count
+        self.consumer.queue.deliver()
+        return succeed(None)
+
+
+class LocalConsumer(object):
+    """Consumes messages from a local queue.
+
+    :attr:`max_in_flight` limits how many messages are processed at once
+    and :attr:`prefetch_count` (if set) limits how many messages may be
+    unacked at once, as it does for an AMQP channel.
+    """
+
+    def __init__(self, bus, queue, callback, message_class=None,
+                 max_in_flight=None, start_paused=False):
+        self.bus = bus
+        self.queue = queue
+        self.callback = callback
+        self.message_class = message_class or Message
+        self.max_in_flight = max_in_flight or 1
+        self.prefetch_count = 0
+        self.paused = start_paused
+        self.keep_consuming = True
+        self.channel = LocalChannel(self)
+        self._in_flight = set()
+        self._delivery_tags = count(1)
+        self._unacked = OrderedDict()  # delivery tag -> message
+
+    def start(self):
+        self.queue.consumers.append(self)
+        self.queue.deliver()
+
+    def ready(self):
+        if self.paused or not self.keep_consuming:
+            return False
+        if len(self._in_flight) >= self.max_in_flight:
+            return False
+        if self.prefetch_count and len(self._unacked) >= self.prefetch_count:
+            return False
+        return True
+
+    def deliver(self, message):
+        delivery_tag = next(self._delivery_tags)
+        self._unacked[delivery_tag] = message
+        d = maybeDeferred(self.consume_message, self._convert(message))
+        d.addCallbacks(self._processed, self._failed,
+                       callbackArgs=(delivery_tag,))
+        if not d.called:
+            self._in_flight.add(d)
+            d.addBoth(self._release, d)
+
+    def _processed(self, result, delivery_tag):
+        if result is False:
+            log.msg('Received %s as a return value consume_message. '
+                    'Not acknowledging local message' % (result,))
+        else:
+            self.ack(delivery_tag)
+
+    def _failed(self, failure):
+        # The message isn't acked, so it will be redelivered after this
+        # consumer stops.
+        log.err(failure)
+
+    def _release(self, result, d):
+        self._in_flight.discard(d)
+        self.queue.deliver()
+        return result
+
+    def _convert(self, message):
+        if type(message) is self.message_class:
+            return message
+        return self.message_class(_process_fields=False,
+                                  **message.copy().payload)
+
+    def ack(self, delivery_tag):
+        self._unacked.pop(delivery_tag, None)
+
+    def consume_message(self, message):
+        return self.callback(message)
+
+    def pause(self):
+        self.paused = True
+        return succeed(None)
+
+    def unpause(self):
+        self.paused = False
+        self.queue.deliver()
+        return succeed(None)
+
+    def stop(self):
+        self.keep_consuming = False
+        if self in self.queue.consumers:
+            self.queue.consumers.remove(self)
+        d = DeferredList(list(self._in_flight))
+        d.addCallback(lambda _: self._requeue_unacked())
+        return d
+
+    def _requeue_unacked(self):
+        unacked, self._unacked = self._unacked, OrderedDict()
+        if unacked:
+            self.queue.requeue(unacked.values())
+        return self.keep_consuming
+
+
+class LocalPublisher(object):
+    """Publishes messages to the local bus."""
+
+    def __init__(self, bus, exchange_name, routing_key, require_bind=True):
+        self.bus = bus
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.require_bind = require_bind
+
+    def publish_message(self, message, routing_key=None, **kwargs):
+        routing_key = routing_key or self.routing_key
+        exchange_name = kwargs.get('exchange_name', self.exchange_name)
+        try:
+            self.bus.publish(exchange_name, routing_key, message,
+                             kwargs.get('require_bind', self.require_bind))
+        except RoutingKeyError:
+            return fail()
+        return succeed(message)
+
+    def publish_batch(self, messages, **kwargs):
+        ds = [self.publish_message(message, **kwargs) for message in messages]
+        d = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda r: messages)
+        return d
+
+    def publish_raw(self, data, **kwargs):
+        return self.publish_message(Message.from_json(data), **kwargs)
+
+    def publish_json(self, data, **kwargs):
+        return self.publish_message(Message(**data), **kwargs)
+
+    def flush(self):
+        return succeed(None)
+
+
+_local_bus = None
+
+
+def get_local_bus():
+    """
+    Return the local message bus for this process.
+    """
+    global _local_bus
+    if _local_bus is None:
+        _local_bus = LocalMessageBus()
+    return _local_bus
@@ -1,30 +1,126 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
+import re
 import json
+from copy import deepcopy
 from uuid import uuid4
 from datetime import datetime
 
-from errors import MissingMessageField, InvalidMessageField
+from errors import (MissingMessageField, InvalidMessageField,
+                    MessageCodecError)
 
 from vumi.utils import to_kwargs
 
+try:
+    import simplejson as fast_json
+except ImportError:
+    fast_json = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# Matches exactly the strings that datetime.strptime() accepts for
+# VUMI_DATE_FORMAT.
+VUMI_DATE_RE = re.compile(
+    r"^(\d{4})-(\d{1,2})-(\d{1,2})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})"
+    r"\.(\d{1,6})\Z")
+
+# Matches the start of anything in a JSON document that could decode to a
+# string matching VUMI_DATE_RE.
+VUMI_DATE_HINT_RE = re.compile(r'"\d{4}-\d{1,2}-\d{1,2}\s')
+
+
+def parse_vumi_date(value):
+    """Parse a string in `VUMI_DATE_FORMAT`.
+
+    Returns a :class:`datetime` or `None` if `value` isn't a valid date
+    string. This is equivalent to (but considerably cheaper than) calling
+    `datetime.strptime(value, VUMI_DATE_FORMAT)` and catching errors.
+    """
+    if not isinstance(value, basestring):
+        return None
+    match = VUMI_DATE_RE.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime(int(year), int(month), int(day), int(hour),
+                        int(minute), int(second), int(fraction.ljust(6, '0')))
+    except ValueError:
+        return None
+
+
+def format_vumi_date(dt):
+    """Format a :class:`datetime` in `VUMI_DATE_FORMAT`."""
+    return "%04d-%02d-%02d %02d:%02d:%02d.%06d" % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+        dt.microsecond)
+
 
 def date_time_decoder(json_object):
     for key, value in json_object.items():
-        try:
-            json_object[key] = datetime.strptime(value,
-                    VUMI_DATE_FORMAT)
-        except ValueError:
-            continue
-        except TypeError:
-            continue
+        dt = parse_vumi_date(value)
+        if dt is not None:
+            json_object[key] = dt
     return json_object
 
 
+def _decode_date_times(obj):
+    """Apply `date_time_decoder` to every object nested in `obj`.
+
+    This produces the same result as passing `date_time_decoder` as the
+    `object_hook` when decoding.
+    """
+    if isinstance(obj, dict):
+        for value in obj.itervalues():
+            if isinstance(value, (dict, list)):
+                _decode_date_times(value)
+        date_time_decoder(obj)
+    elif isinstance(obj, list):
+        for value in obj:
+            if isinstance(value, (dict, list)):
+                _decode_date_times(value)
+    return obj
+
+
+# Values that can be shared between copies of a payload.
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None), datetime)
+
+
+def copy_payload(value):
+    """Copy a message payload.
+
+    Dicts and lists are copied recursively and immutable values are
+    shared, which is much cheaper than a round trip through JSON. Other
+    values are deep copied.
+    """
+    if isinstance(value, dict):
+        copied = {}
+        for k, v in value.iteritems():
+            if not isinstance(v, _IMMUTABLE_TYPES):
+                v = copy_payload(v)
+            copied[k] = v
+        return copied
+    if isinstance(value, list):
+        return [v if isinstance(v, _IMMUTABLE_TYPES) else copy_payload(v)
+                for v in value]
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return value
+    return deepcopy(value)
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return format_vumi_date(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
 class JSONMessageEncoder(json.JSONEncoder):
     """A JSON encoder that is able to serialize datetime"""
     def default(self, obj):
@@ -33,12 +129,106 @@ class JSONMessageEncoder(json.JSONEncoder):
         return super(JSONMessageEncoder, self).default(obj)
 
 
+class JSONMessageCodec(object):
+    """Encodes and decodes message payloads as JSON.
+
+    The wire format is identical to encoding with :class:`JSONMessageEncoder`
+    and decoding with :func:`date_time_decoder` as the `object_hook`, but
+    decoding avoids trying to parse every value in the document as a date.
+
+    Fields listed in `timestamp_fields` are decoded directly. The rest of
+    the document is only searched for dates if the raw JSON contains more
+    date-like strings than the timestamp fields account for.
+
+    `simplejson` is used for encoding when it is available. Decoding always
+    uses the standard library `json` module because `simplejson` returns
+    `str` rather than `unicode` for ASCII strings.
+    """
+
+    content_type = 'application/json'
+
+    def __init__(self, json_module=None):
+        self.json = json_module or json
+        encoder_module = json_module or fast_json
+        self.encoder = encoder_module.JSONEncoder(default=_json_default)
+
+    def encode(self, payload):
+        return self.encoder.encode(payload)
+
+    def decode(self, data, timestamp_fields=()):
+        obj = self.json.loads(data)
+        hints = len(VUMI_DATE_HINT_RE.findall(data))
+        if not hints:
+            return obj
+        if timestamp_fields and isinstance(obj, dict):
+            for field in timestamp_fields:
+                dt = parse_vumi_date(obj.get(field))
+                if dt is not None:
+                    obj[field] = dt
+                    hints -= 1
+            if not hints:
+                return obj
+        return _decode_date_times(obj)
+
+
+class MsgpackMessageCodec(object):
+    """Encodes and decodes message payloads as msgpack.
+
+    Dates are sent as strings in `VUMI_DATE_FORMAT` and decoded with
+    :func:`date_time_decoder`, so decoded payloads are the same as those
+    from :class:`JSONMessageCodec`. As with JSON, `str` and `unicode` are
+    both sent as UTF-8 strings and always decode to `unicode`.
+
+    Requires the `msgpack` package.
+    """
+
+    content_type = 'application/x-msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise MessageCodecError(
+                "The msgpack package is required for %r messages."
+                % (self.content_type,))
+
+    def encode(self, payload):
+        return msgpack.packb(payload, default=_json_default,
+                             use_bin_type=False)
+
+    def decode(self, data, timestamp_fields=()):
+        return msgpack.unpackb(data, object_hook=date_time_decoder,
+                               raw=False)
+
+
+MESSAGE_CODECS = {
+    JSONMessageCodec.content_type: JSONMessageCodec,
+    MsgpackMessageCodec.content_type: MsgpackMessageCodec,
+    }
+
+default_codec = JSONMessageCodec()
+_codecs = {None: default_codec, default_codec.content_type: default_codec}
+
+
+def get_codec(content_type=None):
+    """Return the codec for `content_type`.
+
+    Message bodies without a content type are JSON. Raises
+    :class:`MessageCodecError` for unknown content types.
+    """
+    codec = _codecs.get(content_type)
+    if codec is None:
+        if content_type not in MESSAGE_CODECS:
+            raise MessageCodecError(
+                "Unsupported message content type %r." % (content_type,))
+        codec = _codecs[content_type] = MESSAGE_CODECS[content_type]()
+    return codec
+
+
 def from_json(json_string):
-    return json.loads(json_string, object_hook=date_time_decoder)
+    return default_codec.decode(json_string)
 
 
 def to_json(obj):
-    return json.dumps(obj, cls=JSONMessageEncoder)
+    return default_codec.encode(obj)
 
 
 class Message(object):
@@ -51,12 +241,60 @@ class Message(object):
 
     """
 
+    # fields that always hold a datetime (used to speed up decoding)
+    TIMESTAMP_FIELDS = ()
+
+    # (data, codec) for messages that haven't been modified since they
+    # were decoded.
+    _raw = None
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
-        self.payload = kwargs
+        self._payload = kwargs
         self.validate_fields()
 
+    @classmethod
+    def _from_raw(cls, data, codec):
+        msg = cls.__new__(cls)
+        msg._raw = (data, codec)
+        msg._payload = None
+        return msg
+
+    def _get_payload(self):
+        if self._payload is None:
+            raw = self._raw
+            data, codec = raw
+            payload = codec.decode(data, self.TIMESTAMP_FIELDS)
+            # validate_fields() reads the payload through self, so it has
+            # to be in place while we validate. If validation fails, go
+            # back to the raw data so that every access fails the same way.
+            self._payload = to_kwargs(payload)
+            try:
+                self.validate_fields()
+            except Exception:
+                self._payload, self._raw = None, raw
+                raise
+        return self._payload
+
+    def _get_value(self, value):
+        # Callers may modify mutable values, so we can't reuse the raw
+        # data after handing one out.
+        if self._raw is not None and not isinstance(value, _IMMUTABLE_TYPES):
+            self._raw = None
+        return value
+
+    @property
+    def payload(self):
+        payload = self._get_payload()
+        self._raw = None
+        return payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self._raw = None
+
     def process_fields(self, fields):
         return fields
 
@@ -64,50 +302,84 @@ class Message(object):
         pass
 
     def assert_field_present(self, *fields):
+        payload = self._get_payload()
         for field in fields:
-            if field not in self.payload:
+            if field not in payload:
                 raise MissingMessageField(field)
 
     def assert_field_value(self, field, *values):
         self.assert_field_present(field)
-        if self.payload[field] not in values:
+        if self._get_payload()[field] not in values:
             raise InvalidMessageField(field)
 
     def to_json(self):
-        return to_json(self.payload)
+        return self.encode()
 
     @classmethod
     def from_json(cls, json_string):
-        return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        return cls.decode(json_string)
+
+    def encode(self, content_type=None):
+        """Encode the message using the codec for `content_type`.
+
+        Unmodified messages decoded with the same codec return the data they
+        were decoded from.
+        """
+        codec = get_codec(content_type)
+        if self._raw is not None and self._raw[1] is codec:
+            return self._raw[0]
+        return codec.encode(self._get_payload())
+
+    @classmethod
+    def decode(cls, data, content_type=None, lazy=False):
+        """Decode a message encoded with the codec for `content_type`.
+
+        If `lazy` is true, decoding and validation are put off until the
+        message's fields are first accessed. Until then, or for as long as
+        only immutable field values are read, :meth:`encode` returns `data`
+        without re-encoding it.
+        """
+        codec = get_codec(content_type)
+        if lazy:
+            return cls._from_raw(data, codec)
+        payload = codec.decode(data, cls.TIMESTAMP_FIELDS)
+        msg = cls(_process_fields=False, **to_kwargs(payload))
+        msg._raw = (data, codec)
+        return msg
 
     def __str__(self):
-        return u"<Message payload=\"%s\">" % repr(self.payload)
+        return u"<Message payload=\"%s\">" % repr(self._get_payload())
 
     def __repr__(self):
         return str(self)
 
     def __eq__(self, other):
         if isinstance(other, Message):
-            return self.payload == other.payload
+            return self._get_payload() == other._get_payload()
         return False
 
     def __contains__(self, key):
-        return key in self.payload
+        return key in self._get_payload()
 
     def __getitem__(self, key):
-        return self.payload[key]
+        return self._get_value(self._get_payload()[key])
 
     def __setitem__(self, key, value):
-        self.payload[key] = value
+        self._get_payload()[key] = value
+        self._raw = None
 
     def get(self, key, default=None):
-        return self.payload.get(key, default)
+        return self._get_value(self._get_payload().get(key, default))
 
     def items(self):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        if self._payload is None:
+            # Not decoded yet, so the copy can decode it if it needs to.
+            return self._from_raw(*self._raw)
+        return self.__class__(_process_fields=False,
+                              **copy_payload(self._get_payload()))
 
 
 class TransportMessage(Message):
@@ -116,6 +388,7 @@ class TransportMessage(Message):
     # sub-classes should set the message type
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
+    TIMESTAMP_FIELDS = ('timestamp',)
 
     @staticmethod
     def generate_id():
@@ -197,7 +470,8 @@ class TransportUserMessage(TransportMessage):
     def validate_fields(self):
         super(TransportUserMessage, self).validate_fields()
         # We might get older message versions without the `group` field.
-        self.payload.setdefault('group', None)
+        if 'group' not in self:
+            self['group'] = None
         self.assert_field_present(
             'message_id',
             'to_addr',
@@ -308,7 +582,7 @@ class TransportEvent(TransportMessage):
             'event_id',
             'event_type',
             )
-        event_type = self.payload['event_type']
+        event_type = self['event_type']
         if event_type not in self.EVENT_TYPES:
             raise InvalidMessageField("Unknown event_type %r" % (event_type,))
         for extra_field, check in self.EVENT_TYPES[event_type].items():
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (inlineCallbacks, returnValue, Deferred,
+                                    succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
@@ -47,6 +48,18 @@ class BaseMiddleware(object):
         """
         pass
 
+    def teardown_middleware(self):
+        """Any custom teardown may be done here.
+
+        This is called when the worker stops, after its consumers have
+        stopped.
+
+        :rtype: Deferred or None
+        :returns: May return a deferred that is called when teardown is
+                  complete.
+        """
+        pass
+
     def handle_inbound(self, message, endpoint):
         """Called when an inbound transport user message is published
         or consumed.
@@ -99,29 +112,109 @@ class ApplicationMiddleware(BaseMiddleware):
 
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    The handlers for each kind of message and direction are looked up
+    once, the first time they are needed, and handlers that a middleware
+    inherits unchanged from :class:`BaseMiddleware` are left out. Handlers
+    that return plain values are called one after the other without
+    wrapping their results in Deferreds. If a handler returns a Deferred,
+    the rest of the stack is run when it fires.
+
+    If a `recorder` (see :class:`vumi.blinkenlights.latency.LatencyRecorder`)
+    is given, each handler is wrapped to record its latency.
     """
 
-    def __init__(self, middlewares):
+    def __init__(self, middlewares, recorder=None):
+        self.recorder = recorder
         self.middlewares = middlewares
 
-    @inlineCallbacks
-    def _handle(self, middlewares, handler_name, message, endpoint):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, endpoint)
-            if message is None:
-                raise MiddlewareError('Returned value of %s.%s should never ' \
-                                'be None' % (middleware, method_name,))
-        returnValue(message)
+    @property
+    def middlewares(self):
+        return self._middlewares
+
+    @middlewares.setter
+    def middlewares(self, middlewares):
+        self._middlewares = middlewares
+        self._pipelines = {}
+
+    def _is_passthrough(self, middleware, method_name):
+        if method_name in vars(middleware):
+            return False
+        handler = getattr(type(middleware), method_name, None)
+        default = getattr(BaseMiddleware, method_name)
+        return getattr(handler, 'im_func', None) is default.im_func
+
+    def _pipeline(self, handler_name, reverse):
+        key = (handler_name, reverse)
+        pipeline = self._pipelines.get(key)
+        if pipeline is None:
+            method_name = 'handle_%s' % (handler_name,)
+            middlewares = self._middlewares
+            if reverse:
+                middlewares = reversed(middlewares)
+            pipeline = tuple(
+                (middleware, self._get_handler(middleware, handler_name,
+                                               reverse))
+                for middleware in middlewares
+                if not self._is_passthrough(middleware, method_name))
+            self._pipelines[key] = pipeline
+        return pipeline
+
+    def _get_handler(self, middleware, handler_name, reverse):
+        handler = getattr(middleware, 'handle_%s' % (handler_name,))
+        if self.recorder is None:
+            return handler
+        name = getattr(middleware, 'name', type(middleware).__name__)
+        direction = 'publish' if reverse else 'consume'
+        return self.recorder.wrap('middleware.%s.%s.%s' % (
+            name, handler_name, direction), handler)
+
+    def _check_result(self, message, middleware, handler_name):
+        if message is None:
+            raise MiddlewareError('Returned value of %s.handle_%s should '
+                                  'never be None' % (middleware,
+                                                     handler_name))
+
+    def _handle(self, pipeline, handler_name, message, endpoint, start=0):
+        for i in xrange(start, len(pipeline)):
+            middleware, handler = pipeline[i]
+            message = handler(message, endpoint)
+            if isinstance(message, Deferred):
+                return message.addCallback(
+                    self._resume, pipeline, i, handler_name, endpoint)
+            self._check_result(message, middleware, handler_name)
+        return message
+
+    def _resume(self, message, pipeline, i, handler_name, endpoint):
+        self._check_result(message, pipeline[i][0], handler_name)
+        return self._handle(pipeline, handler_name, message, endpoint, i + 1)
+
+    def _apply(self, handler_name, message, endpoint, reverse):
+        pipeline = self._pipeline(handler_name, reverse)
+        try:
+            result = self._handle(pipeline, handler_name, message, endpoint)
+        except:
+            return fail()
+        if isinstance(result, Deferred):
+            return result
+        return succeed(result)
 
     def apply_consume(self, handler_name, message, endpoint):
-        return self._handle(
-            self.middlewares, handler_name, message, endpoint)
+        return self._apply(handler_name, message, endpoint, False)
+
+    @inlineCallbacks
+    def teardown(self):
+        """Tear down the middlewares, in the reverse order to setup.
+
+        Middlewares without a ``teardown_middleware`` method are skipped.
+        """
+        for middleware in reversed(self._middlewares):
+            teardown = getattr(middleware, 'teardown_middleware', None)
+            if teardown is not None:
+                yield teardown()
 
     def apply_publish(self, handler_name, message, endpoint):
-        return self._handle(
-            reversed(self.middlewares), handler_name, message, endpoint)
+        return self._apply(handler_name, message, endpoint, True)
 
 
 def create_middlewares_from_config(worker, config):
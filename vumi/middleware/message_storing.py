@@ -1,12 +1,135 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
+import time
+from collections import deque
+
 import redis
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (inlineCallbacks, returnValue, Deferred,
+                                    DeferredList, succeed, maybeDeferred)
+from twisted.python import log
 
 from vumi.middleware.base import BaseMiddleware
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.persist.message_store import MessageStore
 from vumi.persist.txriak_manager import TxRiakManager
+from vumi.blinkenlights.metrics import MetricManager, Metric, Timer, AVG, MAX
+
+
+class WriteBehindBuffer(object):
+    """
+    Bounded buffer of message store writes that are done in the background.
+
+    Writes are flushed in batches of up to :attr:`batch_size`, once that
+    many are waiting or :attr:`flush_interval` seconds after the first one
+    was added. The writes in a batch run in parallel, one stage at a time
+    (lower stages first), and only one batch is written at a time. This
+    lets writes that depend on others (such as events, which look up
+    their message) be put in a later stage.
+
+    If :attr:`max_size` writes are already waiting, :meth:`add` returns a
+    Deferred that only fires once there is space, which slows down
+    callers that wait for it.
+
+    Writes that fail are logged and not retried.
+    """
+
+    def __init__(self, max_size=1000, batch_size=100, flush_interval=0.5,
+                 clock=None):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.depth = Metric('buffer_depth', [AVG, MAX])
+        self.flush_latency = Timer('flush_latency', [AVG, MAX])
+        self._writes = deque()
+        self._waiting = deque()
+        self._flushing = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._writes) + len(self._waiting)
+
+    def add(self, stage, func, *args, **kw):
+        """
+        Buffer a call to `func`, which should return a Deferred.
+
+        Returns a Deferred that fires once the write has been buffered.
+        """
+        write = (stage, func, args, kw)
+        # Writes mustn't overtake ones that are already waiting for space.
+        if not self._waiting and len(self._writes) < self.max_size:
+            self._writes.append(write)
+            self._schedule_flush()
+            return succeed(None)
+        d = Deferred()
+        self._waiting.append((write, d))
+        self._start_flush()
+        return d
+
+    def _schedule_flush(self):
+        if len(self._writes) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None and self._flushing is None:
+            self._timer = self.clock.callLater(self.flush_interval,
+                                               self._start_flush)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+    def _start_flush(self):
+        self._cancel_timer()
+        if self._flushing is not None or not self._writes:
+            return
+        batch = [self._writes.popleft()
+                 for _ in range(min(self.batch_size, len(self._writes)))]
+        d = self._write_batch(batch)
+        self._flushing = d
+        d.addCallback(self._batch_done)
+
+    @inlineCallbacks
+    def _write_batch(self, batch):
+        start = time.time()
+        for stage in sorted(set(write[0] for write in batch)):
+            ds = [maybeDeferred(func, *args, **kw)
+                  for write_stage, func, args, kw in batch
+                  if write_stage == stage]
+            results = yield DeferredList(ds, consumeErrors=True)
+            for success, result in results:
+                if not success:
+                    log.err(result, "Buffered message store write failed")
+        self.flush_latency.set(time.time() - start)
+
+    def _batch_done(self, result):
+        self._flushing = None
+        if self._writes:
+            self._schedule_flush()
+        # Starting the next batch may have made space for waiting writes.
+        while self._waiting and len(self._writes) < self.max_size:
+            write, d = self._waiting.popleft()
+            self._writes.append(write)
+            self._schedule_flush()
+            d.callback(None)
+        self.depth.set(len(self))
+        return result
+
+    @inlineCallbacks
+    def flush(self):
+        """
+        Write everything in the buffer.
+
+        Returns a Deferred that fires once everything has been written.
+        """
+        while self._flushing is not None or self._writes:
+            if self._flushing is None:
+                self._start_flush()
+            if self._flushing is not None:
+                yield self._flushing
 
 
 class StoringMiddleware(BaseMiddleware):
@@ -35,25 +158,83 @@ class StoringMiddleware(BaseMiddleware):
     :param dict riak:
         Riak configuration parameters. Must contain at least
         a bucket_prefix key.
+    :param bool write_behind:
+        If true, messages are passed on as soon as they've been added to
+        a :class:`WriteBehindBuffer` instead of waiting for them to be
+        stored. Buffered messages are lost if the worker dies before
+        they're written. Default is false.
+    :param int buffer_size:
+        Maximum number of writes to buffer before messages have to wait
+        for space. Default is 1000.
+    :param int flush_batch_size:
+        Maximum number of writes to do at once. Default is 100.
+    :param float flush_interval:
+        Maximum number of seconds before buffered writes are started.
+        Default is 0.5.
+    :param float status_flush_interval:
+        If set, batch status counters are written to Redis in batches
+        at most this many seconds apart instead of once per message.
+        See :class:`vumi.persist.message_store.BatchStatusCounters`.
+    :param string metrics_prefix:
+        If set, the buffer depth and flush latency are published as
+        blinkenlights metrics with this prefix. Only used with
+        `write_behind`.
     """
 
+    # Events look up their message, so messages are written first.
+    MESSAGE_STAGE = 0
+    EVENT_STAGE = 1
+
+    @inlineCallbacks
     def setup_middleware(self):
         store_prefix = self.config.get('store_prefix', 'message_store')
         r_config = self.config.get('redis', {})
         r_server = redis.Redis(**r_config)
         manager = TxRiakManager.from_config(self.config.get('riak'))
-        self.store = MessageStore(manager, r_server, store_prefix)
+        self.store = MessageStore(
+            manager, r_server, store_prefix,
+            status_flush_interval=self.config.get('status_flush_interval'))
+
+        self.buffer = None
+        self.metric_manager = None
+        if self.config.get('write_behind', False):
+            self.buffer = WriteBehindBuffer(
+                max_size=self.config.get('buffer_size', 1000),
+                batch_size=self.config.get('flush_batch_size', 100),
+                flush_interval=self.config.get('flush_interval', 0.5))
+            metrics_prefix = self.config.get('metrics_prefix')
+            if metrics_prefix is not None:
+                self.metric_manager = yield self.worker.start_publisher(
+                    MetricManager, metrics_prefix)
+                self.metric_manager.register(self.buffer.depth)
+                self.metric_manager.register(self.buffer.flush_latency)
+
+    @inlineCallbacks
+    def teardown_middleware(self):
+        if self.buffer is not None:
+            yield self.buffer.flush()
+        self.store.flush_status()
+        if self.metric_manager is not None:
+            self.metric_manager.stop()
+
+    def _store(self, stage, func, message, **kw):
+        if self.buffer is None:
+            return func(message, **kw)
+        # The message carries on while it waits to be written.
+        return self.buffer.add(stage, func, message.copy(), **kw)
 
     @inlineCallbacks
     def handle_inbound(self, message, endpoint):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        yield self._store(self.MESSAGE_STAGE, self.store.add_inbound_message,
+                          message, tag=tag)
         returnValue(message)
 
     @inlineCallbacks
     def handle_outbound(self, message, endpoint):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        yield self._store(self.MESSAGE_STAGE,
+                          self.store.add_outbound_message, message, tag=tag)
         returnValue(message)
 
     @inlineCallbacks
@@ -65,5 +246,5 @@ class StoringMiddleware(BaseMiddleware):
         if 'date' in transport_metadata:
             date = transport_metadata['date']
             transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        yield self._store(self.EVENT_STAGE, self.store.add_event, event)
         returnValue(event)
@@ -1,10 +1,11 @@
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.trial.unittest import TestCase
 
 import yaml
 
 from vumi.middleware.base import (BaseMiddleware, MiddlewareStack,
+                                  MiddlewareError,
                                   create_middlewares_from_config,
                                   setup_middlewares_from_config)
 
@@ -22,6 +23,9 @@ class ToyMiddleware(BaseMiddleware):
     def setup_middleware(self):
         self._setup_done = True
 
+    def teardown_middleware(self):
+        self.worker.processed(self.name, 'teardown', None, None)
+
     def handle_inbound(self, message, endpoint):
         return self._handle('inbound', message, endpoint)
 
@@ -35,6 +39,34 @@ class ToyMiddleware(BaseMiddleware):
         return self._handle('failure', message, endpoint)
 
 
+class AsyncToyMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, endpoint):
+        d = Deferred()
+        self.worker.pending.append(d)
+        d.addCallback(lambda _: ToyMiddleware._handle(
+            self, direction, message, endpoint))
+        return d
+
+
+class InboundOnlyMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, endpoint):
+        return '%s.%s' % (message, self.name)
+
+
+class NoneMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, endpoint):
+        return None
+
+
+class BrokenMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, endpoint):
+        raise ValueError("Broken.")
+
+
 class MiddlewareStackTestCase(TestCase):
 
     @inlineCallbacks
@@ -78,6 +110,69 @@ class MiddlewareStackTestCase(TestCase):
                 ('mw1', 'inbound', 'dummy_msg.mw3.mw2.mw1', 'end_foo'),
                 ])
 
+    @inlineCallbacks
+    def test_teardown(self):
+        yield self.stack.teardown()
+        self.assert_processed([
+                ('mw3', 'teardown', None, None),
+                ('mw2', 'teardown', None, None),
+                ('mw1', 'teardown', None, None),
+                ])
+
+    @inlineCallbacks
+    def test_teardown_without_teardown_middleware(self):
+        class PlainMiddleware(object):
+            name = 'plain'
+
+            def handle_inbound(self, message, endpoint):
+                return message
+
+        self.stack.middlewares = [self.stack.middlewares[0],
+                                  PlainMiddleware()]
+        yield self.stack.teardown()
+        self.assert_processed([('mw1', 'teardown', None, None)])
+
+    def test_sync_result_already_fired(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertTrue(d.called)
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    def test_async_middleware(self):
+        self.pending = []
+        mw = AsyncToyMiddleware('async', {}, self)
+        self.stack.middlewares = [self.stack.middlewares[0], mw,
+                                  self.stack.middlewares[2]]
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertFalse(d.called)
+        self.assert_processed([
+                ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+                ])
+        self.pending[0].callback(None)
+        self.assertEqual(self.successResultOf(d),
+                         'dummy_msg.mw1.async.mw3')
+        self.assert_processed([
+                ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+                ('async', 'inbound', 'dummy_msg.mw1.async', 'end_foo'),
+                ('mw3', 'inbound', 'dummy_msg.mw1.async.mw3', 'end_foo'),
+                ])
+
+    def test_inherited_handlers_skipped(self):
+        stack = MiddlewareStack([InboundOnlyMiddleware('mw1', {}, self)])
+        self.assertEqual(len(stack._pipeline('inbound', False)), 1)
+        self.assertEqual(stack._pipeline('outbound', False), ())
+        d = stack.apply_publish('outbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg')
+
+    def test_none_result(self):
+        stack = MiddlewareStack([NoneMiddleware('mw1', {}, self)])
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d).trap(MiddlewareError)
+
+    def test_handler_exception(self):
+        stack = MiddlewareStack([BrokenMiddleware('mw1', {}, self)])
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d).trap(ValueError)
+
 
 class UtilityFunctionsTestCase(TestCase):
 
@@ -1,9 +1,11 @@
 """Tests for vumi.middleware.message_storing."""
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from twisted.internet.task import Clock
 
-from vumi.middleware.message_storing import StoringMiddleware
+from vumi.middleware.message_storing import (StoringMiddleware,
+                                             WriteBehindBuffer)
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.tests.utils import FakeRedis
 from vumi.message import TransportUserMessage, TransportEvent
@@ -119,3 +121,153 @@ class StoringMiddlewareTestCase(TestCase):
 
         self.assertEqual(stored_event, ack)
         self.assertEqual(message_events, [ack])
+
+
+class WriteBehindBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.buffer = WriteBehindBuffer(max_size=4, batch_size=2,
+                                        flush_interval=1, clock=self.clock)
+        self.writes = []
+
+    def write(self, value):
+        d = Deferred()
+        self.writes.append((value, d))
+        return d
+
+    def finish_writes(self):
+        writes, self.writes = self.writes, []
+        for value, d in writes:
+            d.callback(None)
+        return [value for value, d in writes]
+
+    def test_flush_after_interval(self):
+        self.buffer.add(0, self.write, 'a')
+        self.assertEqual(self.writes, [])
+        self.clock.advance(1)
+        self.assertEqual(self.finish_writes(), ['a'])
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_flush_full_batch(self):
+        self.buffer.add(0, self.write, 'a')
+        self.buffer.add(0, self.write, 'b')
+        self.buffer.add(0, self.write, 'c')
+        self.assertEqual(self.finish_writes(), ['a', 'b'])
+        # The next batch is waiting for the timer to fire.
+        self.assertEqual(self.writes, [])
+        self.clock.advance(1)
+        self.assertEqual(self.finish_writes(), ['c'])
+
+    def test_stages(self):
+        self.buffer.add(1, self.write, 'event')
+        self.buffer.add(0, self.write, 'msg')
+        self.assertEqual([value for value, d in self.writes], ['msg'])
+        self.assertEqual(self.finish_writes(), ['msg'])
+        self.assertEqual(self.finish_writes(), ['event'])
+
+    def test_backpressure(self):
+        ds = [self.buffer.add(0, self.write, i) for i in range(7)]
+        # Two writes in progress, four buffered and one waiting.
+        self.assertEqual([d.called for d in ds], [True] * 6 + [False])
+        self.assertEqual(len(self.buffer), 5)
+        self.assertEqual(self.finish_writes(), [0, 1])
+        self.assertTrue(ds[6].called)
+        self.assertEqual(self.finish_writes(), [2, 3])
+        self.assertEqual(self.finish_writes(), [4, 5])
+        self.assertEqual(self.writes, [])
+        self.assertEqual([v for _, v in self.buffer.depth.poll()],
+                         [3, 1, 1])
+
+    def test_backpressure_order(self):
+        ds = [self.buffer.add(0, self.write, i) for i in range(8)]
+        # Add another write as soon as the first waiting one is buffered.
+        ds[6].addCallback(lambda _: self.buffer.add(0, self.write, 'x'))
+        self.assertEqual(self.finish_writes(), [0, 1])
+        self.assertEqual(self.finish_writes(), [2, 3])
+        self.assertEqual(self.finish_writes(), [4, 5])
+        self.assertEqual(self.finish_writes(), [6, 7])
+        self.clock.advance(1)
+        self.assertEqual(self.finish_writes(), ['x'])
+
+    def test_flush(self):
+        for i in range(3):
+            self.buffer.add(0, self.write, i)
+        d = self.buffer.flush()
+        self.assertEqual(self.finish_writes(), [0, 1])
+        self.assertFalse(d.called)
+        self.assertEqual(self.finish_writes(), [2])
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.buffer.flush_latency.poll()), 2)
+
+    def test_failed_write_logged(self):
+        self.buffer.add(0, self.write, 'a')
+        d = self.buffer.flush()
+        [(value, write_d)] = self.writes
+        write_d.errback(ValueError("Riak is down."))
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+class RecordingStore(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def add_inbound_message(self, msg, tag=None):
+        self.writes.append(('inbound', msg, tag))
+        return succeed(None)
+
+    def add_outbound_message(self, msg, tag=None):
+        self.writes.append(('outbound', msg, tag))
+        return succeed(None)
+
+    def add_event(self, event):
+        self.writes.append(('event', event, None))
+        return succeed(None)
+
+    def flush_status(self):
+        pass
+
+
+class WriteBehindStoringMiddlewareTestCase(TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        config = {
+            "riak": {
+                "bucket_prefix": "test.",
+                },
+            "write_behind": True,
+            "flush_batch_size": 10,
+            }
+        self.mw = StoringMiddleware("dummy_storer", config, object())
+        yield self.mw.setup_middleware()
+        self.mw.store = RecordingStore()
+
+    def tearDown(self):
+        return self.mw.teardown_middleware()
+
+    @inlineCallbacks
+    def test_messages_written_behind(self):
+        msg = TransportUserMessage(to_addr="45678", from_addr="12345",
+                                   transport_name="dummy_endpoint",
+                                   transport_type="dummy_transport_type")
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        ack = TransportEvent(event_type="ack",
+                             user_message_id=msg['message_id'],
+                             sent_message_id="1")
+        response = yield self.mw.handle_event(ack, "dummy_endpoint")
+        self.assertTrue(response is ack)
+        response = yield self.mw.handle_outbound(msg, "dummy_endpoint")
+        self.assertTrue(response is msg)
+        self.assertEqual(self.mw.store.writes, [])
+
+        # Changes made after the message has moved on aren't stored.
+        msg['content'] = 'changed'
+        yield self.mw.teardown_middleware()
+        self.assertEqual([(kind, tag) for kind, _, tag
+                          in self.mw.store.writes],
+                         [('outbound', ("pool", "tag")), ('event', None)])
+        self.assertEqual(self.mw.store.writes[0][1]['content'], None)
+        self.assertEqual(self.mw.store.writes[1][1], ack)
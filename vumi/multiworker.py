@@ -1,8 +1,22 @@
 # -*- test-case-name: vumi.tests.test_multiworker -*-
 
+import os
+import sys
+import json
+import tempfile
 from copy import deepcopy
 
-from vumi.service import Worker, WorkerCreator
+import yaml
+from twisted.internet import reactor
+from twisted.internet.defer import (Deferred, DeferredList, succeed,
+                                    inlineCallbacks, maybeDeferred)
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.web import http
+from twisted.web.resource import Resource
+
+from vumi.service import Worker, WorkerCreator, SharedAmqpConnection
+from vumi import log
 
 
 class MultiWorker(Worker):
@@ -16,6 +30,10 @@ class MultiWorker(Worker):
     :type defaults: dict
     :param defaults:
         Default configuration for child workers.
+    :type shared_connection: bool
+    :param shared_connection:
+        If true, child workers share a single AMQP connection instead of
+        each making their own. Default is false.
 
     Each entry in the ``workers`` config dict defines a child worker to start.
     A child worker's configuration should be provided in a config dict keyed by
@@ -24,6 +42,7 @@ class MultiWorker(Worker):
     """
 
     WORKER_CREATOR = WorkerCreator
+    SHARED_CONNECTION = SharedAmqpConnection
 
     def construct_worker_config(self, worker_name):
         """
@@ -47,9 +66,281 @@ class MultiWorker(Worker):
         super(MultiWorker, self).startService()
         self.workers = []
         self.worker_creator = self.WORKER_CREATOR(self.options)
+        if self.config.get('shared_connection', False):
+            # The workers need this running before they start. stopService
+            # makes sure they have stopped before it is stopped.
+            connection = self.SHARED_CONNECTION(self.options)
+            connection.setServiceParent(self)
+            self.worker_creator.shared_connection = connection
         for wname, wclass in self.config.get('workers', {}).items():
             worker = self.create_worker(wname, wclass)
             self.workers.append(worker)
 
+    @inlineCallbacks
+    def stopService(self):
+        # MultiService.stopService() stops all our children at once without
+        # waiting for any of them, which would close a shared connection
+        # while the workers using it are still stopping. Stop the workers
+        # first and wait for them.
+        workers = [service for service in list(self)
+                   if service in getattr(self, 'workers', [])]
+        ds = [maybeDeferred(self.removeService, worker) for worker in workers]
+        for d in ds:
+            d.addErrback(log.err, "Error stopping child worker")
+        yield DeferredList(ds)
+        yield super(MultiWorker, self).stopService()
+
     def startWorker(self):
         pass
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """Relays a child worker process's output and exit to its supervisor."""
+
+    def __init__(self, child):
+        self.child = child
+
+    def _log_output(self, data):
+        for line in data.splitlines():
+            log.msg("[%s] %s" % (self.child.name, line))
+
+    def outReceived(self, data):
+        self._log_output(data)
+
+    def errReceived(self, data):
+        self._log_output(data)
+
+    def processEnded(self, reason):
+        self.child.process_ended(reason)
+
+
+class ChildWorkerProcess(object):
+    """A child worker running in its own ``twistd vumi_worker`` process."""
+
+    def __init__(self, supervisor, name, worker_class, config):
+        self.supervisor = supervisor
+        self.name = name
+        self.worker_class = worker_class
+        self.config = config
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.restart_delay = None
+        self.restart_call = None
+        self.last_exit = None
+        self._config_files = []
+        self._exit_waiters = []
+
+    @property
+    def running(self):
+        return self.process is not None
+
+    def _write_config(self, config):
+        fd, filename = tempfile.mkstemp(prefix='vumi-%s-' % (self.name,),
+                                        suffix='.yaml')
+        with os.fdopen(fd, 'w') as config_file:
+            yaml.safe_dump(config, config_file)
+        self._config_files.append(filename)
+        return filename
+
+    def _remove_config(self):
+        for filename in self._config_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self._config_files = []
+
+    def get_args(self):
+        return [
+            sys.executable, '-c',
+            'from twisted.scripts.twistd import run; run()',
+            '--nodaemon', '--pidfile=', 'vumi_worker',
+            '--worker-class', self.worker_class,
+            '--vumi-config', self._write_config(self.supervisor.options),
+            '--config', self._write_config(self.config),
+            ]
+
+    def start(self):
+        self.restart_call = None
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self.process = self.supervisor.spawn_process(
+            WorkerProcessProtocol(self), self.get_args(), env)
+        self.started_at = self.supervisor.clock.seconds()
+        log.msg("Started %s (pid %s)." % (self.name, self.process.pid))
+
+    def signal(self, signal_name):
+        if self.process is not None:
+            try:
+                self.process.signalProcess(signal_name)
+            except ProcessExitedAlready:
+                pass
+
+    def stop(self, timeout):
+        """
+        Ask the process to shut down, killing it if it hasn't exited
+        after `timeout` seconds.
+
+        Returns a deferred that fires once the process has exited.
+        """
+        if self.restart_call is not None:
+            self.restart_call.cancel()
+            self.restart_call = None
+        if self.process is None:
+            return succeed(None)
+        d = Deferred()
+        self._exit_waiters.append(d)
+        self.signal('TERM')
+        kill_call = self.supervisor.clock.callLater(
+            timeout, self.signal, 'KILL')
+        d.addBoth(self._cancel_kill, kill_call)
+        return d
+
+    def _cancel_kill(self, result, kill_call):
+        if kill_call.active():
+            kill_call.cancel()
+        return result
+
+    def process_ended(self, reason):
+        self.process = None
+        self.last_exit = reason.value
+        self._remove_config()
+        waiters, self._exit_waiters = self._exit_waiters, []
+        for d in waiters:
+            d.callback(None)
+        if not waiters:
+            self.supervisor.child_exited(self, reason)
+
+    def health(self):
+        uptime = None
+        if self.running:
+            uptime = self.supervisor.clock.seconds() - self.started_at
+        return {
+            'worker_class': self.worker_class,
+            'running': self.running,
+            'pid': self.process.pid if self.running else None,
+            'uptime': uptime,
+            'restarts': self.restarts,
+            'last_exit': str(self.last_exit) if self.last_exit else None,
+            }
+
+
+class ProcessHealthResource(Resource):
+    isLeaf = True
+
+    def __init__(self, worker):
+        Resource.__init__(self)
+        self.worker = worker
+
+    def render_GET(self, request):
+        health = self.worker.health()
+        request.setHeader('Content-Type', 'application/json')
+        if health['running'] < health['total']:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.do_not_log = True
+        return json.dumps(health)
+
+
+class ProcessMultiWorker(MultiWorker):
+    """A worker that runs other workers in separate processes.
+
+    This is configured like :class:`MultiWorker`, but each child worker
+    runs in its own ``twistd vumi_worker`` process so they can use more
+    than one CPU core between them. Child processes that exit are
+    restarted.
+
+    Additional config options:
+
+    :type processes: dict
+    :param processes:
+        Dict of worker_name -> number of processes to run for that worker.
+        Defaults to one process per worker.
+    :type restart_delay: float
+    :param restart_delay:
+        Seconds to wait before restarting a child process that exited.
+        The delay doubles each time the process exits within
+        ``max_restart_delay`` seconds of being started. Default is 1.
+    :type max_restart_delay: float
+    :param max_restart_delay:
+        Upper limit for the restart delay. Default is 60.
+    :type stop_timeout: float
+    :param stop_timeout:
+        Seconds to wait for child processes to exit after asking them to
+        shut down before killing them. Default is 10.
+    :type health_port: int
+    :param health_port:
+        If set, a JSON summary of child process health is served on this
+        port at ``health_path``.
+    :type health_path: str
+    :param health_path:
+        Path for the health resource. Default is ``health``.
+    """
+
+    clock = reactor
+
+    def spawn_process(self, protocol, args, env):
+        return reactor.spawnProcess(protocol, args[0], args, env=env)
+
+    def create_worker(self, worker_name, worker_class):
+        """
+        Create the child worker processes for a worker.
+        """
+        config = self.construct_worker_config(worker_name)
+        count = int(self.config.get('processes', {}).get(worker_name, 1))
+        children = []
+        for i in range(count):
+            name = worker_name if count == 1 else '%s.%d' % (worker_name, i)
+            child = ChildWorkerProcess(self, name, worker_class, config)
+            child.start()
+            children.append(child)
+        return children
+
+    def startService(self):
+        Worker.startService(self)
+        self._stopping = False
+        self.restart_delay = float(self.config.get('restart_delay', 1))
+        self.max_restart_delay = float(
+            self.config.get('max_restart_delay', 60))
+        self.stop_timeout = float(self.config.get('stop_timeout', 10))
+        self.workers = []
+        for wname, wclass in self.config.get('workers', {}).items():
+            self.workers.extend(self.create_worker(wname, wclass))
+        self.health_resource = None
+        if 'health_port' in self.config:
+            self.health_resource = self.start_web_resources(
+                [(ProcessHealthResource(self),
+                  self.config.get('health_path', 'health'))],
+                int(self.config['health_port']))
+
+    def child_exited(self, child, reason):
+        if self._stopping:
+            return
+        uptime = self.clock.seconds() - child.started_at
+        if (child.restart_delay is not None and
+                uptime < self.max_restart_delay):
+            delay = min(child.restart_delay * 2, self.max_restart_delay)
+        else:
+            delay = self.restart_delay
+        child.restart_delay = delay
+        child.restarts += 1
+        log.warning("%s exited (%s), restarting in %.1fs." % (
+            child.name, reason.value, delay))
+        child.restart_call = self.clock.callLater(delay, child.start)
+
+    def health(self):
+        """
+        Return a summary of the state of the child processes.
+        """
+        workers = dict((child.name, child.health()) for child in self.workers)
+        return {
+            'total': len(workers),
+            'running': len([h for h in workers.values() if h['running']]),
+            'workers': workers,
+            }
+
+    @inlineCallbacks
+    def stopWorker(self):
+        self._stopping = True
+        if self.health_resource is not None:
+            yield self.health_resource.stopListening()
+        yield DeferredList([child.stop(self.stop_timeout)
+                            for child in self.workers])
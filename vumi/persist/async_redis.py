@@ -0,0 +1,80 @@
+# -*- test-case-name: vumi.persist.tests.test_async_redis -*-
+
+"""A Redis client that doesn't block the reactor.
+
+Every command returns a Deferred. Commands are sent by a synchronous
+``redis.Redis`` client running in a thread pool, so a slow Redis round
+trip holds up a pool thread rather than the whole worker.
+
+Components can be moved from the synchronous client to this one at
+their own pace. While they are, :attr:`AsyncRedis.sync` gives access to
+the synchronous client that both of them share.
+"""
+
+from twisted.internet import reactor as default_reactor
+from twisted.internet.threads import deferToThreadPool
+
+
+class AsyncRedis(object):
+    """Wraps a ``redis.Redis`` client so that commands return Deferreds.
+
+    :type r_server: redis.Redis
+    :param r_server:
+        Synchronous client to send commands with.
+    :type threadpool: twisted.python.threadpool.ThreadPool
+    :param threadpool:
+        Pool of threads to send commands from. Defaults to the reactor's
+        thread pool.
+    """
+
+    def __init__(self, r_server, threadpool=None, reactor=None):
+        if reactor is None:
+            reactor = default_reactor
+        if threadpool is None:
+            threadpool = reactor.getThreadPool()
+        self.sync = r_server
+        self.reactor = reactor
+        self.threadpool = threadpool
+
+    def _call(self, func, *args, **kw):
+        return deferToThreadPool(self.reactor, self.threadpool,
+                                 func, *args, **kw)
+
+    def __getattr__(self, name):
+        command = getattr(self.sync, name)
+
+        def call_command(*args, **kw):
+            return self._call(command, *args, **kw)
+        call_command.__name__ = name
+        return call_command
+
+    def pipeline(self, transaction=True):
+        """Return a pipeline that queues commands until
+        :meth:`AsyncRedisPipeline.execute` is called."""
+        return AsyncRedisPipeline(self, self.sync.pipeline(transaction))
+
+
+class AsyncRedisPipeline(object):
+    """Queues commands for an :class:`AsyncRedis` client.
+
+    Queueing a command doesn't talk to Redis and returns the pipeline, so
+    calls can be chained as with ``redis.Redis`` pipelines.
+    :meth:`execute` sends all the commands in a single round trip and
+    returns a Deferred that fires with a list of their results.
+    """
+
+    def __init__(self, client, pipe):
+        self.client = client
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        command = getattr(self.pipe, name)
+
+        def queue_command(*args, **kw):
+            command(*args, **kw)
+            return self
+        queue_command.__name__ = name
+        return queue_command
+
+    def execute(self):
+        return self.client._call(self.pipe.execute)
@@ -5,9 +5,11 @@
 
 from uuid import uuid4
 
+from twisted.internet import reactor
 from twisted.internet.defer import returnValue
 
 from vumi.message import TransportEvent, TransportUserMessage
+from vumi.utils import LRUCache
 from vumi.persist.model import Model, Manager
 from vumi.persist.fields import (VumiMessage, ForeignKey, ListOf, Tag, Dynamic,
                                  Unicode)
@@ -72,6 +74,144 @@ class InboundMessage(Model):
     batch = ForeignKey(Batch, null=True)
 
 
+class TagBatchCache(object):
+    """In-process LRU cache of which batch each tag is currently part of.
+
+    Entries expire after :attr:`ttl` seconds. Tags only change batches in
+    :meth:`MessageStore.batch_start` and :meth:`MessageStore.batch_done`,
+    which call :meth:`invalidate`. This clears the local cache and
+    increments a version number in Redis. Other processes check the
+    version at most every :attr:`check_interval` seconds and clear their
+    caches when it changes.
+
+    :param r_server:
+        Redis server holding the version number.
+    :param str version_key:
+        Redis key of the version number.
+    :param int max_size:
+        Maximum number of tags to cache.
+    """
+
+    MISSING = object()
+
+    def __init__(self, r_server, version_key, max_size=1000, ttl=300,
+                 check_interval=1, clock=None):
+        self.r_server = r_server
+        self.version_key = version_key
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        # Incremented whenever the cache is cleared, so that lookups that
+        # started before then don't add stale entries.
+        self.generation = 0
+        self._cache = LRUCache(max_size)  # tag -> (batch_id, expiry_time)
+        self._version = None
+        self._next_check = None
+
+    def _check_version(self, now):
+        if self._next_check is not None and now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        version = self.r_server.get(self.version_key)
+        if version != self._version:
+            self._version = version
+            self.clear()
+
+    def get(self, tag):
+        """
+        Return the cached batch_id for `tag` (which may be ``None``), or
+        :attr:`MISSING` if it isn't cached.
+        """
+        now = self.clock.seconds()
+        self._check_version(now)
+        entry = self._cache.get(tag)
+        if entry is None:
+            return self.MISSING
+        if entry[1] <= now:
+            self._cache.pop(tag)
+            return self.MISSING
+        return entry[0]
+
+    def set(self, tag, batch_id, generation):
+        """
+        Cache `batch_id` for `tag`, unless the cache has been cleared since
+        `generation` was read.
+        """
+        if generation != self.generation:
+            return
+        self._cache[tag] = (batch_id, self.clock.seconds() + self.ttl)
+
+    def clear(self):
+        self._cache.clear()
+        self.generation += 1
+
+    def invalidate(self):
+        """Clear the cache here and in all other processes."""
+        self._version = str(self.r_server.incr(self.version_key))
+        self.clear()
+
+
+class BatchStatusCounters(object):
+    """Batch status counter increments waiting to be written to Redis.
+
+    Increments are written to Redis as a single pipelined transaction of
+    ``HINCRBY`` commands. If `flush_interval` is ``None``, each call to
+    :meth:`inc` is written straight away. Otherwise increments are added
+    up locally and written at most `flush_interval` seconds later.
+    :meth:`get` includes increments that haven't been written yet.
+    """
+
+    def __init__(self, r_server, flush_interval=None, clock=None):
+        self.r_server = r_server
+        self.flush_interval = flush_interval
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self._pending = {}  # batch_key -> {field: increment}
+        self._timer = None
+
+    def inc(self, batch_key, *fields):
+        """Increment each of `fields` in the hash at `batch_key` by one."""
+        counts = self._pending.setdefault(batch_key, {})
+        for field in fields:
+            counts[field] = counts.get(field, 0) + 1
+        if self.flush_interval is None:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.flush_interval,
+                                               self.flush)
+
+    def pending(self, batch_key):
+        """Return the increments for `batch_key` not yet written."""
+        return self._pending.get(batch_key, {})
+
+    def get(self, batch_key):
+        """Return the counts for `batch_key`, including pending ones."""
+        raw_counts = self.r_server.hgetall(batch_key)
+        counts = dict((k, int(v)) for k, v in raw_counts.items())
+        for field, amount in self.pending(batch_key).items():
+            counts[field] = counts.get(field, 0) + amount
+        return counts
+
+    def flush(self):
+        """Write all pending increments to Redis."""
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        pipe = self.r_server.pipeline()
+        for batch_key, counts in pending.iteritems():
+            for field, amount in counts.iteritems():
+                pipe.hincrby(batch_key, field, amount)
+        pipe.execute()
+
+
 class MessageStore(object):
     """Vumi message store.
 
@@ -82,9 +222,24 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    Which batch each tag is currently part of is cached in a
+    :class:`TagBatchCache`, holding up to `tag_cache_size` tags for
+    `tag_cache_ttl` seconds.
+
+    The batch each outbound message belongs to is also kept in Redis for
+    `message_batch_ttl` seconds, so that events can update the batch
+    status without loading the message from Riak.
+
+    If `status_flush_interval` is set, batch status counters are updated
+    in Redis at most that many seconds after the messages and events they
+    count are stored (see :class:`BatchStatusCounters`).
+    :meth:`flush_status` should be called before the store is discarded.
     """
 
-    def __init__(self, manager, r_server, r_prefix):
+    def __init__(self, manager, r_server, r_prefix, tag_cache_size=1000,
+                 tag_cache_ttl=300, message_batch_ttl=172800,
+                 status_flush_interval=None):
         self.manager = manager
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
@@ -94,6 +249,12 @@ class MessageStore(object):
         # for batch status cache
         self.r_server = r_server
         self.r_prefix = r_prefix
+        self.tag_batches = TagBatchCache(
+            r_server, ":".join([r_prefix, "tag_batches", "version"]),
+            max_size=tag_cache_size, ttl=tag_cache_ttl)
+        self.message_batch_ttl = message_batch_ttl
+        self.status_counters = BatchStatusCounters(
+            r_server, flush_interval=status_flush_interval)
 
     @Manager.calls_manager
     def batch_start(self, tags, **metadata):
@@ -110,6 +271,7 @@ class MessageStore(object):
                 tag_record = self.current_tags(tag)
             tag_record.current_batch.set(batch)
             yield tag_record.save()
+        self.tag_batches.invalidate()
 
         self._init_status(batch_id)
         returnValue(batch_id)
@@ -121,6 +283,19 @@ class MessageStore(object):
         for tag in tags:
             tag.current_batch.set(None)
             yield tag.save()
+        self.tag_batches.invalidate()
+
+    @Manager.calls_manager
+    def _current_batch_id(self, tag):
+        generation = self.tag_batches.generation
+        batch_id = self.tag_batches.get(tag)
+        if batch_id is TagBatchCache.MISSING:
+            tag_record = yield self.current_tags.load(tag)
+            batch_id = None
+            if tag_record is not None:
+                batch_id = tag_record.current_batch.key
+            self.tag_batches.set(tag, batch_id, generation)
+        returnValue(batch_id)
 
     @Manager.calls_manager
     def add_outbound_message(self, msg, tag=None, batch_id=None):
@@ -128,13 +303,12 @@ class MessageStore(object):
         msg_record = self.outbound_messages(msg_id, msg=msg)
 
         if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
+            batch_id = yield self._current_batch_id(tag)
 
         if batch_id is not None:
             msg_record.batch.key = batch_id
             self._inc_status(batch_id, 'sent')
+        self._set_message_batch(msg_id, batch_id)
 
         yield msg_record.save()
 
@@ -150,16 +324,20 @@ class MessageStore(object):
         event_record = self.events(event_id, event=event, message=msg_id)
         yield event_record.save()
 
-        msg_record = yield self.outbound_messages.load(msg_id)
-        if msg_record is not None:
-            batch_id = msg_record.batch.key
-            if batch_id is not None:
-                event_type = event['event_type']
+        batch_id = self._get_message_batch(msg_id)
+        if batch_id is None:
+            # We don't know (or have forgotten) the message's batch.
+            msg_record = yield self.outbound_messages.load(msg_id)
+            if msg_record is not None:
+                batch_id = msg_record.batch.key
+        if batch_id:
+            event_type = event['event_type']
+            if event_type == 'delivery_report':
+                self._inc_status(batch_id, event_type,
+                                 '%s.%s' % (event_type,
+                                            event['delivery_status']))
+            else:
                 self._inc_status(batch_id, event_type)
-                if event_type == 'delivery_report':
-                    self._inc_status(batch_id,
-                                     '%s.%s' % (event_type,
-                                                event['delivery_status']))
 
     @Manager.calls_manager
     def get_event(self, event_id):
@@ -172,9 +350,7 @@ class MessageStore(object):
         msg_record = self.inbound_messages(msg_id, msg=msg)
 
         if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
+            batch_id = yield self._current_batch_id(tag)
 
         if batch_id is not None:
             msg_record.batch.key = batch_id
@@ -216,6 +392,33 @@ class MessageStore(object):
         events = yield message.backlinks.events()
         returnValue([e.event for e in events])
 
+    # outbound message batch ids are stored in Redis for processing events
+
+    def _message_batch_key(self, msg_id):
+        return ":".join([self.r_prefix, "messages", "batch", msg_id])
+
+    def _set_message_batch(self, msg_id, batch_id):
+        """
+        Remember the batch_id of an outbound message for
+        :attr:`message_batch_ttl` seconds.
+
+        The key is set with a single ``SETEX`` so that it can't be left
+        behind without an expiry. The default TTL of two days covers the
+        delivery reports for almost all messages. Events that arrive later
+        than that look up the message in Riak instead.
+        """
+        # An empty string means the message isn't in a batch.
+        self.r_server.setex(name=self._message_batch_key(msg_id),
+                            value=batch_id or '',
+                            time=self.message_batch_ttl)
+
+    def _get_message_batch(self, msg_id):
+        """
+        Return the batch_id of an outbound message, ``''`` if it has no
+        batch or ``None`` if we don't know.
+        """
+        return self.r_server.get(self._message_batch_key(msg_id))
+
     # batch status is stored in Redis as a cache of batch progress
 
     def _batch_key(self, batch_id):
@@ -230,12 +433,13 @@ class MessageStore(object):
         initial_status = dict((event, '0') for event in events)
         self.r_server.hmset(batch_key, initial_status)
 
-    def _inc_status(self, batch_id, event):
+    def _inc_status(self, batch_id, *events):
         batch_key = self._batch_key(batch_id)
-        self.r_server.hincrby(batch_key, event, 1)
+        self.status_counters.inc(batch_key, *events)
 
     def _get_status(self, batch_id):
-        batch_key = self._batch_key(batch_id)
-        raw_statuses = self.r_server.hgetall(batch_key)
-        statuses = dict((k, int(v)) for k, v in raw_statuses.items())
-        return statuses
+        return self.status_counters.get(self._batch_key(batch_id))
+
+    def flush_status(self):
+        """Write any pending batch status counter updates to Redis."""
+        self.status_counters.flush()
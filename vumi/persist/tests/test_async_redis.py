@@ -0,0 +1,55 @@
+"""Tests for vumi.persist.async_redis."""
+
+import threading
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.persist.async_redis import AsyncRedis
+from vumi.tests.utils import FakeRedis
+
+
+class ThreadRecordingRedis(FakeRedis):
+    """A FakeRedis that records which threads commands are run in."""
+
+    def __init__(self):
+        super(ThreadRecordingRedis, self).__init__()
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.current_thread())
+        return super(ThreadRecordingRedis, self).get(key)
+
+
+class TestAsyncRedis(TestCase):
+
+    def setUp(self):
+        self.sync = ThreadRecordingRedis()
+        self.r_server = AsyncRedis(self.sync)
+
+    def tearDown(self):
+        self.sync.teardown()
+
+    @inlineCallbacks
+    def test_command(self):
+        self.sync.set("foo", "bar")
+        d = self.r_server.get("foo")
+        self.assertEqual(self.sync.threads, [])
+        self.assertEqual((yield d), "bar")
+        [thread] = self.sync.threads
+        self.assertNotEqual(thread, threading.current_thread())
+
+    @inlineCallbacks
+    def test_command_failure(self):
+        self.sync.set("foo", "bar")
+        d = self.r_server.hget("foo", "field")
+        yield self.assertFailure(d, AttributeError)
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.r_server.pipeline()
+        self.assertEqual(pipe.set("foo", 1).incr("foo"), pipe)
+        self.assertEqual(self.sync.get("foo"), None)
+        results = yield pipe.execute()
+        self.assertEqual(results, [None, 2])
+        self.assertEqual(self.sync.get("foo"), "2")
@@ -3,14 +3,20 @@
 """Tests for vumi.persist.message_store."""
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
 
 from vumi.message import TransportEvent
 from vumi.tests.utils import FakeRedis
 from vumi.application.tests.test_base import ApplicationTestCase
-from vumi.persist.message_store import MessageStore
+from vumi.persist.message_store import (MessageStore, TagBatchCache,
+                                        BatchStatusCounters)
 from vumi.persist.txriak_manager import TxRiakManager
 
 
+MISSING = TagBatchCache.MISSING
+
+
 class TestMessageStore(ApplicationTestCase):
     # inherits from ApplicationTestCase for .mkmsg_in and .mkmsg_out
 
@@ -132,6 +138,17 @@ class TestMessageStore(ApplicationTestCase):
         self.assertEqual(self.store.batch_status(batch_id),
                          self._batch_status(sent=1))
 
+    @inlineCallbacks
+    def test_batch_status_with_flush_interval(self):
+        self.store = MessageStore(self.manager, self.r_server, 'teststore',
+                                  status_flush_interval=1)
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.assertEqual(self.store.batch_status(batch_id),
+                         self._batch_status(sent=1))
+        self.store.flush_status()
+        self.assertEqual(self.store.batch_status(batch_id),
+                         self._batch_status(sent=1))
+
     @inlineCallbacks
     def test_add_ack_event(self):
         msg_id, msg, batch_id = yield self._create_outbound()
@@ -162,6 +179,32 @@ class TestMessageStore(ApplicationTestCase):
         self.assertEqual(stored_ack, ack)
         self.assertEqual(message_events, [ack])
 
+    @inlineCallbacks
+    def test_add_event_uses_stored_batch_id(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.assertEqual(self.store._get_message_batch(msg_id), batch_id)
+
+        def fail_load(key):
+            self.fail("Outbound message loaded from Riak.")
+        self.store.outbound_messages.load = fail_load
+
+        ack = TransportEvent(user_message_id=msg_id, event_type='ack',
+                             sent_message_id='xyz')
+        yield self.store.add_event(ack)
+        self.assertEqual(self.store.batch_status(batch_id),
+                         self._batch_status(sent=1, ack=1))
+
+    @inlineCallbacks
+    def test_add_event_with_forgotten_batch_id(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.r_server.delete(self.store._message_batch_key(msg_id))
+
+        ack = TransportEvent(user_message_id=msg_id, event_type='ack',
+                             sent_message_id='xyz')
+        yield self.store.add_event(ack)
+        self.assertEqual(self.store.batch_status(batch_id),
+                         self._batch_status(sent=1, ack=1))
+
     @inlineCallbacks
     def test_add_delivery_report_events(self):
         msg_id, msg, batch_id = yield self._create_outbound()
@@ -212,3 +255,157 @@ class TestMessageStore(ApplicationTestCase):
 
         self.assertEqual(stored_msg, msg)
         self.assertEqual(batch_replies, [msg])
+
+    @inlineCallbacks
+    def test_tag_batch_cached(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        msg = self.mkmsg_out(content="outfoo")
+        yield self.store.add_outbound_message(msg, tag=tag)
+        self.assertEqual(self.store.tag_batches.get(tag), batch_id)
+
+        yield self.store.batch_done(batch_id)
+        self.assertEqual(self.store.tag_batches.get(tag),
+                         MISSING)
+        new_batch_id = yield self.store.batch_start([tag])
+        msg = self.mkmsg_out(content="outfoo")
+        yield self.store.add_outbound_message(msg, tag=tag)
+        batch_messages = yield self.store.batch_messages(new_batch_id)
+        self.assertEqual(batch_messages, [msg])
+
+
+class TestTagBatchCache(TestCase):
+
+    def setUp(self):
+        self.r_server = FakeRedis()
+        self.clock = Clock()
+        self.cache = self.mk_cache()
+
+    def tearDown(self):
+        self.r_server.teardown()
+
+    def mk_cache(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return TagBatchCache(self.r_server, 'teststore:version', **kw)
+
+    def test_get_missing(self):
+        self.assertEqual(self.cache.get(("pool", "tag")), MISSING)
+
+    def test_set_and_get(self):
+        self.cache.set(("pool", "tag1"), "batch1", self.cache.generation)
+        self.cache.set(("pool", "tag2"), None, self.cache.generation)
+        self.assertEqual(self.cache.get(("pool", "tag1")), "batch1")
+        self.assertEqual(self.cache.get(("pool", "tag2")), None)
+
+    def test_ttl(self):
+        self.cache.set(("pool", "tag"), "batch1", self.cache.generation)
+        self.clock.advance(self.cache.ttl - 1)
+        self.assertEqual(self.cache.get(("pool", "tag")), "batch1")
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get(("pool", "tag")), MISSING)
+
+    def test_lru(self):
+        cache = self.mk_cache(max_size=2)
+        cache.set("a", "batch_a", cache.generation)
+        cache.set("b", "batch_b", cache.generation)
+        cache.get("a")
+        cache.set("c", "batch_c", cache.generation)
+        self.assertEqual(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("a"), "batch_a")
+        self.assertEqual(cache.get("c"), "batch_c")
+
+    def test_stale_generation_ignored(self):
+        generation = self.cache.generation
+        self.cache.invalidate()
+        self.cache.set(("pool", "tag"), "old_batch", generation)
+        self.assertEqual(self.cache.get(("pool", "tag")), MISSING)
+
+    def test_invalidate_other_process(self):
+        other = self.mk_cache()
+        self.cache.set(("pool", "tag"), "batch1", self.cache.generation)
+        self.assertEqual(self.cache.get(("pool", "tag")), "batch1")
+        other.invalidate()
+        # We only check the version every check_interval seconds.
+        self.assertEqual(self.cache.get(("pool", "tag")), "batch1")
+        self.clock.advance(self.cache.check_interval)
+        self.assertEqual(self.cache.get(("pool", "tag")), MISSING)
+
+    def test_invalidate_self(self):
+        self.cache.set(("pool", "tag"), "batch1", self.cache.generation)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get(("pool", "tag")), MISSING)
+        # Our own version change doesn't clear the cache again.
+        self.cache.set(("pool", "tag"), "batch2", self.cache.generation)
+        self.clock.advance(self.cache.check_interval)
+        self.assertEqual(self.cache.get(("pool", "tag")), "batch2")
+
+
+class TestBatchStatusCounters(TestCase):
+
+    def setUp(self):
+        self.r_server = FakeRedis()
+        self.clock = Clock()
+
+    def tearDown(self):
+        self.r_server.teardown()
+
+    def test_immediate(self):
+        counters = BatchStatusCounters(self.r_server, clock=self.clock)
+        counters.inc('batch', 'ack')
+        counters.inc('batch', 'delivery_report', 'delivery_report.pending')
+        self.assertEqual(self.r_server.hgetall('batch'), {
+            'ack': '1',
+            'delivery_report': '1',
+            'delivery_report.pending': '1',
+            })
+        self.assertEqual(counters.pending('batch'), {})
+
+    def test_flush_interval(self):
+        counters = BatchStatusCounters(self.r_server, flush_interval=1,
+                                       clock=self.clock)
+        counters.inc('batch1', 'ack')
+        counters.inc('batch1', 'ack')
+        counters.inc('batch2', 'sent')
+        self.assertEqual(self.r_server.hgetall('batch1'), {})
+        self.assertEqual(counters.pending('batch1'), {'ack': 2})
+        self.clock.advance(1)
+        self.assertEqual(self.r_server.hgetall('batch1'), {'ack': '2'})
+        self.assertEqual(self.r_server.hgetall('batch2'), {'sent': '1'})
+        self.assertEqual(counters.pending('batch1'), {})
+
+    def test_flush(self):
+        counters = BatchStatusCounters(self.r_server, flush_interval=1,
+                                       clock=self.clock)
+        counters.inc('batch', 'ack')
+        counters.flush()
+        self.assertEqual(self.r_server.hgetall('batch'), {'ack': '1'})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_one_pipeline_per_flush(self):
+        pipelines = []
+        r_pipeline = self.r_server.pipeline
+
+        def pipeline(*args, **kw):
+            pipelines.append(r_pipeline(*args, **kw))
+            return pipelines[-1]
+        self.r_server.pipeline = pipeline
+        counters = BatchStatusCounters(self.r_server, flush_interval=1,
+                                       clock=self.clock)
+        for i in range(10):
+            counters.inc('batch', 'delivery_report', 'delivery_report.pending')
+        self.clock.advance(1)
+        self.assertEqual(len(pipelines), 1)
+        self.assertEqual(self.r_server.hgetall('batch'), {
+            'delivery_report': '10',
+            'delivery_report.pending': '10',
+            })
+
+    def test_get_includes_pending(self):
+        self.r_server.hmset('batch', {'ack': '0', 'sent': '2'})
+        counters = BatchStatusCounters(self.r_server, flush_interval=1,
+                                       clock=self.clock)
+        counters.inc('batch', 'ack', 'delivery_report')
+        counts = counters.get('batch')
+        self.assertEqual(counts, {'ack': 1, 'sent': 2, 'delivery_report': 1})
+        counters.flush()
+        self.assertEqual(counters.get('batch'), counts)
@@ -0,0 +1,110 @@
+import sys
+
+from twisted.python import usage
+from twisted.internet.task import Clock
+
+from vumi.tests.utils import FakeRedis, FakeRedisPipeline
+from vumi.persist.message_store import BatchStatusCounters
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["events", "e", "10000", "Number of events to count."],
+        ["batches", "b", "5", "Number of batches to spread events over."],
+        ["interval", "i", "1.0", "Flush interval for buffered counters."],
+        ["rate", "r", "500", "Events per second for buffered counters."],
+    ]
+
+    longdesc = """Counts the Redis round trips needed to update batch
+    status counters for a stream of acks and delivery reports, comparing
+    one HINCRBY per counter with pipelined and buffered updates."""
+
+
+class CountingRedis(object):
+    """Wraps a :class:`FakeRedis` and counts round trips to it.
+
+    Each command is one round trip, as is each pipeline execute.
+    """
+
+    def __init__(self):
+        self.r_server = FakeRedis()
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        command = getattr(self.r_server, name)
+
+        def counted(*args, **kw):
+            self.round_trips += 1
+            return command(*args, **kw)
+        return counted
+
+    def pipeline(self, transaction=True):
+        pipe = FakeRedisPipeline(self.r_server)
+        execute = pipe.execute
+
+        def counted_execute():
+            self.round_trips += 1
+            return execute()
+        pipe.execute = counted_execute
+        return pipe
+
+
+class LegacyBatchStatusCounters(BatchStatusCounters):
+    """Issues one ``HINCRBY`` per counter, as the store used to."""
+
+    def inc(self, batch_key, *fields):
+        for field in fields:
+            self.r_server.hincrby(batch_key, field, 1)
+
+
+class BatchStatusBenchmark(object):
+
+    def __init__(self, options):
+        self.events = int(options['events'])
+        self.batches = int(options['batches'])
+        self.interval = float(options['interval'])
+        self.rate = float(options['rate'])
+
+    def events_for(self, i):
+        if i % 2:
+            return ('ack',)
+        return ('delivery_report', 'delivery_report.delivered')
+
+    def count(self, counters_class, flush_interval=None):
+        r_server = CountingRedis()
+        clock = Clock()
+        counters = counters_class(r_server, flush_interval=flush_interval,
+                                  clock=clock)
+        for i in xrange(self.events):
+            counters.inc('batch:%d' % (i % self.batches,),
+                         *self.events_for(i))
+            clock.advance(1.0 / self.rate)
+        counters.flush()
+        r_server.r_server.teardown()
+        return r_server.round_trips
+
+    def report(self, name, round_trips):
+        print "%-30s %6d round trips (%.3f per event)" % (
+            name, round_trips, float(round_trips) / self.events)
+
+    def run(self):
+        print "Redis round trips for %d events over %d batches:" % (
+            self.events, self.batches)
+        self.report("HINCRBY per counter:",
+                    self.count(LegacyBatchStatusCounters))
+        self.report("Pipelined per event:",
+                    self.count(BatchStatusCounters))
+        self.report("Buffered (%gs at %g/s):" % (self.interval, self.rate),
+                    self.count(BatchStatusCounters, self.interval))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    BatchStatusBenchmark(options).run()
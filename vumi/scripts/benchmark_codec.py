@@ -0,0 +1,112 @@
+import sys
+import json
+import time
+from datetime import datetime
+
+from twisted.python import usage
+
+from vumi.message import (TransportUserMessage, TransportEvent,
+                          JSONMessageCodec, JSONMessageEncoder,
+                          VUMI_DATE_FORMAT)
+from vumi.utils import to_kwargs
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to encode and decode per run."],
+    ]
+
+    longdesc = """Benchmarks vumi.message encoding and decoding"""
+
+
+def legacy_date_time_decoder(json_object):
+    for key, value in json_object.items():
+        try:
+            json_object[key] = datetime.strptime(value, VUMI_DATE_FORMAT)
+        except ValueError:
+            continue
+        except TypeError:
+            continue
+    return json_object
+
+
+def legacy_encode(msg):
+    return json.dumps(msg.payload, cls=JSONMessageEncoder)
+
+
+def legacy_decode(cls, data):
+    payload = json.loads(data, object_hook=legacy_date_time_decoder)
+    return cls(_process_fields=False, **to_kwargs(payload))
+
+
+class CodecBenchmark(object):
+    """
+    Encodes and decodes messages with both the legacy object_hook based
+    JSON codec and :class:`JSONMessageCodec`.
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.codec = JSONMessageCodec()
+
+    def make_user_message(self, i):
+        return TransportUserMessage(
+            to_addr="+27831234567", from_addr="12345",
+            transport_name="bench", transport_type="sms",
+            content="Message %d: some typical user content." % (i,),
+            transport_metadata={'smsc': 'bench', 'sequence': i},
+            helper_metadata={'tag': {'tag': ['pool', 'tag%d' % (i,)]},
+                             'go': {'conversation': 'abc%d' % (i,)}})
+
+    def make_event(self, i):
+        return TransportEvent(
+            event_type='delivery_report', user_message_id='msg%d' % (i,),
+            delivery_status='delivered', transport_name='bench',
+            transport_metadata={})
+
+    def new_encode(self, msg):
+        return self.codec.encode(msg.payload)
+
+    def new_decode(self, cls, data):
+        payload = self.codec.decode(data, cls.TIMESTAMP_FIELDS)
+        return cls(_process_fields=False, **to_kwargs(payload))
+
+    def time_run(self, name, func, items):
+        start = time.time()
+        results = [func(item) for item in items]
+        elapsed = time.time() - start
+        print "  %-20s %.3f seconds (%.0f msgs/s)" % (
+            name, elapsed, len(items) / elapsed)
+        return results
+
+    def bench(self, cls, msgs):
+        print "%s (%d messages):" % (cls.__name__, len(msgs))
+        old_data = self.time_run("legacy encode", legacy_encode, msgs)
+        new_data = self.time_run("codec encode", self.new_encode, msgs)
+        if old_data != new_data:
+            raise RuntimeError("Encoded output differs.")
+        old_msgs = self.time_run(
+            "legacy decode", lambda d: legacy_decode(cls, d), old_data)
+        new_msgs = self.time_run(
+            "codec decode", lambda d: self.new_decode(cls, d), new_data)
+        if old_msgs != new_msgs or new_msgs != msgs:
+            raise RuntimeError("Decoded messages differ.")
+
+    def run(self):
+        self.bench(TransportUserMessage,
+                   [self.make_user_message(i) for i in range(self.messages)])
+        self.bench(TransportEvent,
+                   [self.make_event(i) for i in range(self.messages)])
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    CodecBenchmark(options).run()
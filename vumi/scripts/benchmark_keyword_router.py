@@ -0,0 +1,119 @@
+import sys
+import time
+import random
+
+from twisted.python import usage
+
+from vumi.message import TransportUserMessage
+from vumi.utils import get_first_word
+from vumi.dispatchers.base import ContentKeywordRouter
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "2000", "Number of messages to dispatch."],
+        ["to-addrs", "t", "10", "Number of distinct to_addrs in rules."],
+        ["seed", "s", "0", "Random seed for rules and messages."],
+    ]
+
+    longdesc = """Benchmarks ContentKeywordRouter inbound dispatch with
+    10, 1k and 10k keyword rules, comparing a linear scan of the rules
+    with the keyword and to_addr index."""
+
+
+class StubDispatcher(object):
+
+    def __init__(self):
+        self.published = 0
+
+    def publish_inbound_message(self, name, msg):
+        self.published += 1
+
+
+class LinearContentKeywordRouter(ContentKeywordRouter):
+    """Checks every rule for every message, as the router used to."""
+
+    def dispatch_inbound_message(self, msg):
+        keyword = get_first_word(msg['content']).lower()
+        matched = False
+        for rule in self.rules:
+            if self.is_msg_matching_routing_rules(keyword, msg, rule):
+                matched = True
+                self.publish_exposed_inbound(rule['app'], msg.copy())
+        if not matched:
+            self.publish_exposed_inbound(self.fallback_application, msg)
+
+
+class KeywordRouterBenchmark(object):
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.to_addrs = ['%d' % (8000 + i,)
+                         for i in range(int(options['to-addrs']))]
+        self.random = random.Random(int(options['seed']))
+
+    def make_rules(self, count):
+        rules = []
+        for i in range(count):
+            rule = {'app': 'app%d' % (i % 10,), 'keyword': 'kw%d' % (i,)}
+            if i % 2:
+                rule['to_addr'] = self.random.choice(self.to_addrs)
+            if i % 3 == 0:
+                rule['prefix'] = '+256'
+            rules.append(rule)
+        return rules
+
+    def make_messages(self, count):
+        msgs = []
+        for i in range(self.messages):
+            # About one in ten messages doesn't match a keyword.
+            keyword = 'kw%d' % (self.random.randrange(int(count * 1.1)),)
+            msgs.append(TransportUserMessage(
+                to_addr=self.random.choice(self.to_addrs),
+                from_addr=self.random.choice(['+256788601462',
+                                              '+27831234567']),
+                transport_name="bench", transport_type="sms",
+                content="%s rest of the message" % (keyword,)))
+        return msgs
+
+    def time_router(self, router_class, rules, msgs):
+        dispatcher = StubDispatcher()
+        router = router_class(dispatcher, {
+            'dispatcher_name': 'bench',
+            'rules': rules,
+            'transport_mappings': {},
+            'fallback_application': 'fallback',
+            })
+        start = time.time()
+        for msg in msgs:
+            router.dispatch_inbound_message(msg)
+        elapsed = time.time() - start
+        return elapsed * 1e6 / len(msgs), dispatcher.published
+
+    def bench(self, count):
+        rules = self.make_rules(count)
+        msgs = self.make_messages(count)
+        linear, linear_published = self.time_router(
+            LinearContentKeywordRouter, rules, msgs)
+        indexed, indexed_published = self.time_router(
+            ContentKeywordRouter, rules, msgs)
+        assert linear_published == indexed_published
+        print "%5d rules: linear %9.2fus  indexed %6.2fus  (%.1fx)" % (
+            count, linear, indexed, linear / indexed)
+
+    def run(self):
+        print "Per-message dispatch time (%d messages):" % (self.messages,)
+        for count in (10, 1000, 10000):
+            self.bench(count)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    KeywordRouterBenchmark(options).run()
@@ -0,0 +1,103 @@
+import sys
+import time
+
+from twisted.python import usage
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.message import TransportUserMessage
+from vumi.middleware.base import (BaseMiddleware, MiddlewareStack,
+                                  MiddlewareError)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "20000",
+         "Number of messages to pass through each stack."],
+    ]
+
+    longdesc = """Benchmarks per-message MiddlewareStack overhead with 0,
+    3 and 10 synchronous middlewares, comparing the legacy inlineCallbacks
+    implementation with the current one."""
+
+
+class TagMiddleware(BaseMiddleware):
+    """A cheap synchronous middleware, like the tagging middleware."""
+
+    def handle_inbound(self, message, endpoint):
+        message['helper_metadata'][self.name] = endpoint
+        return message
+
+    def handle_outbound(self, message, endpoint):
+        return message
+
+
+class LegacyMiddlewareStack(MiddlewareStack):
+
+    @inlineCallbacks
+    def _legacy_handle(self, middlewares, handler_name, message, endpoint):
+        method_name = 'handle_%s' % (handler_name,)
+        for middleware in middlewares:
+            handler = getattr(middleware, method_name)
+            message = yield handler(message, endpoint)
+            if message is None:
+                raise MiddlewareError('Returned value of %s.%s should never '
+                                      'be None' % (middleware, method_name,))
+        returnValue(message)
+
+    def apply_consume(self, handler_name, message, endpoint):
+        return self._legacy_handle(
+            self.middlewares, handler_name, message, endpoint)
+
+    def apply_publish(self, handler_name, message, endpoint):
+        return self._legacy_handle(
+            reversed(self.middlewares), handler_name, message, endpoint)
+
+
+class MiddlewareBenchmark(object):
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+
+    def make_message(self, i):
+        return TransportUserMessage(
+            to_addr="+27831234567", from_addr="12345",
+            transport_name="bench", transport_type="sms",
+            content="Message %d" % (i,))
+
+    def make_middlewares(self, count):
+        return [TagMiddleware('mw%d' % (i,), {}, None)
+                for i in range(count)]
+
+    def time_stack(self, stack, msgs):
+        start = time.time()
+        for msg in msgs:
+            stack.apply_consume('inbound', msg, 'bench')
+            stack.apply_publish('outbound', msg, 'bench')
+        elapsed = time.time() - start
+        # Each message passes through the stack once in each direction.
+        return elapsed * 1e6 / (2 * len(msgs))
+
+    def bench(self, count):
+        msgs = [self.make_message(i) for i in range(self.messages)]
+        middlewares = self.make_middlewares(count)
+        legacy = self.time_stack(LegacyMiddlewareStack(middlewares), msgs)
+        current = self.time_stack(MiddlewareStack(middlewares), msgs)
+        print "%2d middlewares: legacy %6.2fus  current %6.2fus  (%.1fx)" % (
+            count, legacy, current, legacy / current)
+
+    def run(self):
+        print "Per-message overhead (%d messages):" % (self.messages,)
+        for count in (0, 3, 10):
+            self.bench(count)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    MiddlewareBenchmark(options).run()
@@ -0,0 +1,75 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+from twisted.python import usage
+
+
+# Run in a fresh interpreter so nothing is already imported or cached.
+STARTUP_SCRIPT = """
+import time
+start = time.time()
+from vumi.servicemaker import VumiWorkerServiceMaker, StartWorkerOptions
+options = StartWorkerOptions()
+options.parseOptions(%r)
+VumiWorkerServiceMaker().makeService(options)
+print time.time() - start
+"""
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["runs", "n", "10", "Number of worker processes to start per case."],
+        ["worker-class", None, "vumi.demos.words.EchoWorker",
+         "Worker class to start."],
+    ]
+
+    longdesc = """Benchmarks the startup time of `twistd vumi_worker`
+    processes with and without the persistent AMQP spec cache. Each run
+    times option parsing and worker creation in a new process, which is
+    where the AMQP spec is loaded. No AMQP connection is made."""
+
+
+class StartupBenchmark(object):
+
+    def __init__(self, options):
+        self.runs = int(options['runs'])
+        self.args = ['--worker-class', options['worker-class']]
+
+    def time_startup(self, cache_dir):
+        env = dict(os.environ, VUMI_SPEC_CACHE_DIR=cache_dir,
+                   PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen(
+            [sys.executable, '-c', STARTUP_SCRIPT % (self.args,)], env=env,
+            stdout=subprocess.PIPE)
+        output, _ = process.communicate()
+        return float(output.strip().splitlines()[-1])
+
+    def bench(self, name, cache_dir):
+        times = [self.time_startup(cache_dir) for _ in range(self.runs)]
+        print "%-20s min %.3fs  avg %.3fs  max %.3fs" % (
+            name, min(times), sum(times) / len(times), max(times))
+
+    def run(self):
+        cache_dir = tempfile.mkdtemp(prefix='vumi-spec-cache-bench-')
+        try:
+            self.bench("no spec cache", '')
+            print "%-20s %.3fs" % (
+                "populate cache", self.time_startup(cache_dir))
+            self.bench("warm spec cache", cache_dir)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    StartupBenchmark(options).run()
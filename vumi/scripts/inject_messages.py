@@ -1,5 +1,7 @@
 # -*- test-case-name: vumi.scripts.tests.test_inject_messages -*-
+import os
 import sys
+import stat
 import json
 from twisted.python import usage
 from twisted.internet import reactor, threads
@@ -28,6 +30,10 @@ class InjectorOptions(VumiOptions):
 class MessageInjector(Worker):
 
     WORKER_QUEUE = DeferredQueue()
+    # Number of lines to read from a file before publishing them as a
+    # batch. Other input, such as a pipe, is published a line at a time
+    # so that messages aren't held up waiting for more lines.
+    BATCH_SIZE = 100
 
     @inlineCallbacks
     def startWorker(self):
@@ -42,23 +48,54 @@ class MessageInjector(Worker):
                                      in_file, out_file)
 
     def _process_file_in_thread(self, in_file, out_file):
+        if not self.is_regular_file(in_file):
+            for line in in_file:
+                line = line.strip()
+                threads.blockingCallFromThread(reactor, self.process_line,
+                                               line)
+                self.emit(out_file, line)
+            return
+        lines = []
         for line in in_file:
-            line = line.strip()
+            lines.append(line.strip())
+            if len(lines) >= self.BATCH_SIZE:
+                self._process_batch_in_thread(lines, out_file)
+                lines = []
+        if lines:
+            self._process_batch_in_thread(lines, out_file)
+
+    def _process_batch_in_thread(self, lines, out_file):
+        threads.blockingCallFromThread(reactor, self.process_lines, lines)
+        for line in lines:
             self.emit(out_file, line)
-            threads.blockingCallFromThread(reactor, self.process_line, line)
+
+    def is_regular_file(self, in_file):
+        """Return whether all of `in_file` can be read without waiting for
+        more input. File-like objects without a file descriptor count."""
+        try:
+            fileno = in_file.fileno()
+        except AttributeError:
+            return True
+        return stat.S_ISREG(os.fstat(fileno).st_mode)
 
     def emit(self, out_file, obj):
         if out_file is not None:
             out_file.write('%s\n' % (obj,))
 
-    def process_line(self, line):
+    def make_message(self, line):
         data = {
             'transport_name': self.transport_name,
             'transport_metadata': {},
         }
         data.update(json.loads(line))
-        self.publisher.publish_message(
-            TransportUserMessage(**to_kwargs(data)))
+        return TransportUserMessage(**to_kwargs(data))
+
+    def process_line(self, line):
+        self.publisher.publish_message(self.make_message(line))
+
+    def process_lines(self, lines):
+        return self.publisher.publish_batch(
+            [self.make_message(line) for line in lines])
 
 
 @inlineCallbacks
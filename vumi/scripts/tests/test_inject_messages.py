@@ -1,6 +1,7 @@
 from twisted.internet.defer import inlineCallbacks
 from vumi.transports.tests.test_base import TransportTestCase
 from vumi.scripts.inject_messages import MessageInjector
+import os
 import json
 import StringIO
 
@@ -38,6 +39,15 @@ class MessageInjectorTestCase(TransportTestCase):
         [msg] = self._amqp.get_messages('vumi', 'test_transport.inbound')
         self.check_msg(msg, data)
 
+    @inlineCallbacks
+    def test_process_lines(self):
+        data = [self.make_data(message_id=i) for i in range(3)]
+        yield self.transport.process_lines([json.dumps(d) for d in data])
+        msgs = self._amqp.get_messages('vumi', 'test_transport.inbound')
+        self.assertEqual(3, len(msgs))
+        for msg, datum in zip(msgs, data):
+            self.check_msg(msg, datum)
+
     @inlineCallbacks
     def test_process_file(self):
         data = [self.make_data(message_id=i) for i in range(10)]
@@ -49,3 +59,22 @@ class MessageInjectorTestCase(TransportTestCase):
         for msg, datum in zip(msgs, data):
             self.check_msg(msg, datum)
         self.assertEqual(out_file.getvalue(), data_string + "\n")
+
+    @inlineCallbacks
+    def test_process_pipe(self):
+        data = [self.make_data(message_id=i) for i in range(3)]
+        data_string = "\n".join(json.dumps(datum) for datum in data)
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data_string)
+        os.close(write_fd)
+        in_file = os.fdopen(read_fd)
+        self.addCleanup(in_file.close)
+        out_file = StringIO.StringIO()
+        batches = []
+        self.transport.process_lines = batches.append
+        yield self.transport.process_file(in_file, out_file)
+        # Lines from a pipe aren't held back to be published in batches.
+        self.assertEqual([], batches)
+        msgs = self._amqp.get_messages('vumi', 'test_transport.inbound')
+        self.assertEqual(3, len(msgs))
+        self.assertEqual(out_file.getvalue(), data_string + "\n")
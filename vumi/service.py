@@ -1,12 +1,25 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
+import os
+import sys
 import json
+import time
+import types
+import marshal
+import hashlib
+import tempfile
+import cPickle as pickle
 from copy import deepcopy
+from collections import deque
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (inlineCallbacks, returnValue,
+                                    DeferredSemaphore, DeferredList,
+                                    Deferred, succeed, maybeDeferred,
+                                    gatherResults)
 from twisted.internet import protocol, reactor
 from twisted.web.resource import Resource
 import txamqp
@@ -14,14 +27,146 @@ from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
-from vumi.errors import VumiError
-from vumi.message import Message
+from vumi.errors import VumiError, RoutingKeyError
+from vumi.message import Message, get_codec
+from vumi.local_bus import get_local_bus, LocalConsumer, LocalPublisher
 from vumi.utils import (load_class_by_string, vumi_resource_path, http_request,
                         basic_auth_string, LogFilterSite)
 
 
 SPECS = {}
 
+# Bump this if the layout of the spec cache files changes.
+SPEC_CACHE_FORMAT = 1
+
+
+def get_spec_cache_dir():
+    """
+    Return the directory for the persistent AMQP spec cache, or `None` if
+    it's disabled.
+
+    The directory is taken from the `VUMI_SPEC_CACHE_DIR` environment
+    variable (an empty value disables the cache) and defaults to a
+    per-user directory under the system temporary directory. Cached specs
+    are pickles, so we refuse to use a directory owned by someone else or
+    writable by anyone but its owner.
+    """
+    cache_dir = os.environ.get('VUMI_SPEC_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(),
+                                 'vumi-spec-cache-%d' % (os.getuid(),))
+    if not cache_dir:
+        return None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        stat = os.stat(cache_dir)
+    except OSError:
+        return None
+    if stat.st_uid != os.getuid() or stat.st_mode & 0022:
+        return None
+    return cache_dir
+
+
+def _spec_cache_path(cache_dir, specfile):
+    digest = hashlib.sha1()
+    with open(specfile, 'rb') as spec_data:
+        digest.update(spec_data.read())
+    digest.update(repr((SPEC_CACHE_FORMAT, sys.version, txamqp.__file__)))
+    return os.path.join(cache_dir, 'amqp-spec-%s.pickle' % (
+        digest.hexdigest(),))
+
+
+def _spec_methods(spec):
+    """
+    Yield `(method_spec, function)` for each method txamqp generated when
+    loading `spec`.
+    """
+    for klass in spec.classes:
+        module_class = getattr(spec.module, txamqp.spec.pythonize(klass.name))
+        for method in klass.methods:
+            yield method, getattr(module_class,
+                                  txamqp.spec.pythonize(method.name)).im_func
+            yield method, getattr(spec.klass, txamqp.spec.pythonize(
+                klass.name + "_" + method.name)).im_func
+
+
+def dump_spec(spec, cache_file):
+    """
+    Write a loaded spec to `cache_file`.
+
+    Generating the spec's methods takes most of the time spent loading a
+    spec, so the compiled methods are stored alongside the parsed spec.
+    """
+    methods = {}
+    for method, func in _spec_methods(spec):
+        methods.setdefault(method, {})[func.__name__] = (
+            marshal.dumps(func.func_code), func.func_defaults)
+    module, klass = spec.module, spec.klass
+    # These hold the generated code, which can't be pickled.
+    del spec.module, spec.klass
+    try:
+        data = pickle.dumps((spec, methods), pickle.HIGHEST_PROTOCOL)
+    finally:
+        spec.module, spec.klass = module, klass
+    # Write to a temporary file first so other processes never see a
+    # partial cache file.
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_file, cache_file)
+
+
+def load_dumped_spec(cache_file):
+    """
+    Load a spec written by :func:`dump_spec`.
+    """
+    with open(cache_file, 'rb') as f:
+        spec, methods = pickle.load(f)
+
+    def mk_define_method(method):
+        def define_method(name):
+            code, defaults = methods[method][name]
+            return types.FunctionType(
+                marshal.loads(code),
+                {txamqp.spec.Method.METHOD: method,
+                 '__builtins__': __builtins__},
+                name, defaults)
+        return define_method
+
+    for klass in spec.classes:
+        for method in klass.methods:
+            method.define_method = mk_define_method(method)
+    try:
+        spec.post_load()
+    finally:
+        for klass in spec.classes:
+            for method in klass.methods:
+                del method.define_method
+    return spec
+
+
+def load_spec(specfile):
+    """
+    Load an AMQP spec, using the persistent spec cache if possible.
+    """
+    cache_dir = get_spec_cache_dir()
+    if cache_dir is None:
+        return txamqp.spec.load(specfile)
+    cache_file = _spec_cache_path(cache_dir, specfile)
+    if os.path.exists(cache_file):
+        try:
+            return load_dumped_spec(cache_file)
+        except Exception:
+            log.err(None, "Failed to load cached AMQP spec %r" % (
+                cache_file,))
+    spec = txamqp.spec.load(specfile)
+    try:
+        dump_spec(spec, cache_file)
+    except Exception:
+        log.err(None, "Failed to cache AMQP spec %r" % (cache_file,))
+    return spec
+
 
 def get_spec(specfile):
     """
@@ -30,9 +175,12 @@ def get_spec(specfile):
     This is important for tests, which create lots of txamqp clients,
     and therefore generate lots of specs. Just doing this results in a
     decidedly happy test run time reduction.
+
+    New processes load specs from the persistent cache described in
+    :func:`get_spec_cache_dir` when they can.
     """
     if specfile not in SPECS:
-        SPECS[specfile] = txamqp.spec.load(specfile)
+        SPECS[specfile] = load_spec(specfile)
     return SPECS[specfile]
 
 
@@ -74,6 +222,73 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class SharedAmqpConnection(MultiService, object):
+    """
+    An AMQP connection shared by several workers in one process.
+
+    Each attached worker is given the same :class:`WorkerAMQClient` and
+    opens its own channels on it. All attached workers are told when the
+    connection is made, lost or re-established.
+
+    The connection is made when this service is started, so it should be
+    started before (or along with) the workers attached to it.
+    """
+
+    def __init__(self, options, timeout=30, bindAddress=None):
+        super(SharedAmqpConnection, self).__init__()
+        self.options = options
+        self.config = {}
+        self.workers = []
+        self._amqp_client = None
+        self._connect(timeout, bindAddress)
+
+    def _connect(self, timeout, bindAddress):
+        service = TCPClient(self.options['hostname'], self.options['port'],
+                            AmqpFactory(self), timeout, bindAddress)
+        service.setServiceParent(self)
+
+    def attach(self, worker):
+        """
+        Attach a worker to this connection.
+        """
+        worker._shared_connection = self
+        self.workers.append(worker)
+        if self._amqp_client is not None:
+            reactor.callLater(0, self._connect_worker, worker,
+                              self._amqp_client)
+
+    def detach(self, worker):
+        """
+        Detach a worker from this connection, stopping its consumers.
+
+        Returns a deferred that fires once the consumers have stopped.
+        """
+        if worker in self.workers:
+            self.workers.remove(worker)
+        worker._shared_connection = None
+        if self._amqp_client is None:
+            return succeed(None)
+        return DeferredList([maybeDeferred(consumer.stop)
+                             for consumer in worker._amqp_consumers
+                             if consumer.keep_consuming],
+                            consumeErrors=True)
+
+    def _connect_worker(self, worker, amqp_client):
+        if worker in self.workers and amqp_client is self._amqp_client:
+            return worker._amqp_connected(amqp_client)
+
+    def _amqp_connected(self, amqp_client):
+        self._amqp_client = amqp_client
+        return DeferredList([
+            maybeDeferred(self._connect_worker, worker, amqp_client)
+            for worker in list(self.workers)])
+
+    def _amqp_connection_failed(self):
+        self._amqp_client = None
+        for worker in list(self.workers):
+            worker._amqp_connection_failed()
+
+
 class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def connectionMade(self):
@@ -99,18 +314,74 @@ class WorkerAMQClient(AMQClient):
     def get_new_channel_id(self):
         """
         AMQClient keeps track of channels in a dictionary. The
-        channel ids are the keys, get the highest number and up it
-        or just return zero for the first channel
+        channel ids are the keys. We remember the last id we handed out
+        rather than searching for the highest one each time. This also
+        means ids can't be handed out twice while channels are opening.
+        """
+        channel_id = getattr(self, '_next_channel_id', None)
+        if channel_id is None:
+            channel_id = (max(self.channels) + 1) if self.channels else 0
+        self._next_channel_id = channel_id + 1
+        return channel_id
+
+    def get_publisher_channel(self, exchange_name):
+        """
+        Return a deferred that fires with the channel shared by all the
+        publishers for the given exchange, opening it if necessary.
+        """
+        channels = getattr(self, '_publisher_channels', None)
+        if channels is None:
+            channels = self._publisher_channels = {}
+            self._publisher_channel_waiters = {}
+        if exchange_name in channels:
+            return succeed(channels[exchange_name])
+        d = Deferred()
+        waiters = self._publisher_channel_waiters
+        if exchange_name in waiters:
+            waiters[exchange_name].append(d)
+        else:
+            waiters[exchange_name] = [d]
+            self.get_channel().addBoth(
+                self._publisher_channel_opened, exchange_name)
+        return d
+
+    def _publisher_channel_opened(self, result, exchange_name):
+        waiters = self._publisher_channel_waiters.pop(exchange_name)
+        if isinstance(result, Failure):
+            # Everyone waiting gets the failure. The next publisher to ask
+            # tries to open the channel again.
+            for d in waiters:
+                d.errback(result)
+            return
+        self._publisher_channels[exchange_name] = result
+        for d in waiters:
+            d.callback(result)
+
+    def get_binding_cache(self):
+        """
+        Return the routing key binding cache shared by all the publishers
+        on this connection.
         """
-        return (max(self.channels) + 1) if self.channels else 0
+        if getattr(self, '_binding_cache', None) is None:
+            self._binding_cache = RoutingKeyBindingCache(self.vumi_options)
+        return self._binding_cache
 
     def _declare_exchange(self, source, channel):
         # get the details for AMQP
         exchange_name = source.exchange_name
         exchange_type = source.exchange_type
         durable = source.durable
-        return channel.exchange_declare(exchange=exchange_name,
-                                        type=exchange_type, durable=durable)
+        # exchanges stick around, so we only need to declare each one once
+        declared = getattr(self, '_declared_exchanges', None)
+        if declared is None:
+            declared = self._declared_exchanges = set()
+        key = (exchange_name, exchange_type, durable)
+        if key in declared:
+            return succeed(None)
+        d = maybeDeferred(channel.exchange_declare, exchange=exchange_name,
+                          type=exchange_type, durable=durable)
+        d.addCallback(lambda r: declared.add(key))
+        return d
 
     @inlineCallbacks
     def start_consumer(self, consumer_class, *args, **kwargs):
@@ -134,6 +405,8 @@ class WorkerAMQClient(AMQClient):
         # bind it to the exchange with the routing key
         yield channel.queue_bind(queue=queue_name, exchange=exchange_name,
                                  routing_key=routing_key)
+        # we know about this binding, so our publishers don't have to ask
+        self.get_binding_cache().add_binding(exchange_name, routing_key)
         # register the consumer
         reply = yield channel.basic_consume(queue=queue_name)
         queue = yield self.queue(reply.consumer_tag)
@@ -145,11 +418,11 @@ class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
-        # get a channel
-        channel = yield self.get_channel()
-        # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
+        publisher.binding_cache = self.get_binding_cache()
+        # get a channel, shared with other publishers on this exchange
+        channel = yield self.get_publisher_channel(publisher.exchange_name)
         # declare the exchange, doesn't matter if it already exists
         yield self._declare_exchange(publisher, channel)
         # start!
@@ -171,9 +444,15 @@ class Worker(MultiService, object):
             config = {}
         self.config = config
         self._amqp_client = None
+        self._shared_connection = None
+        self._amqp_consumers = []
+        self._amqp_publishers = []
+        self._local_consumers = []
+        self.startup_timings = []
 
     def _amqp_connected(self, amqp_client):
         self._amqp_client = amqp_client
+        self._amqp_consumers = []
         return self.startWorker()
 
     def _amqp_connection_failed(self):
@@ -191,10 +470,40 @@ class Worker(MultiService, object):
     def stopWorker(self):
         pass
 
+    @inlineCallbacks
+    def run_startup_phase(self, phase, func, *args, **kw):
+        """
+        Run one phase of worker startup.
+
+        The time the phase took is logged and recorded in
+        :attr:`startup_timings` as a `(phase, seconds)` pair.
+        """
+        start = time.time()
+        result = yield func(*args, **kw)
+        duration = time.time() - start
+        self.startup_timings.append((phase, duration))
+        log.msg("%s startup phase %r took %.3fs" % (
+            type(self).__name__, phase, duration))
+        returnValue(result)
+
     @inlineCallbacks
     def stopService(self):
         if self.running:
             yield self.stopWorker()
+        # Publish anything still buffered while we have channels to do it.
+        publishers, self._amqp_publishers = self._amqp_publishers, []
+        for publisher in publishers:
+            if publisher.buffer_size is not None:
+                yield publisher.flush()
+        # Local consumers have no channel to close, so stop them here to
+        # make sure their unacked messages are requeued.
+        local_consumers, self._local_consumers = self._local_consumers, []
+        for consumer in local_consumers:
+            if consumer.keep_consuming:
+                yield consumer.stop()
+        if self._shared_connection is not None:
+            # We can't close the connection, so close our channels instead.
+            yield self._shared_connection.detach(self)
         yield super(Worker, self).stopService()
 
     def routing_key_to_class_name(self, routing_key):
@@ -202,7 +511,25 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False):
+                message_class=None, paused=False, max_in_flight=None,
+                ack_batch_size=None, ack_batch_time=None, lazy_decode=None):
+
+        # Ack coalescing is usually a deployment decision, so we allow
+        # it to be set in the worker config.
+        if ack_batch_size is None:
+            ack_batch_size = self.config.get('ack_batch_size')
+        if ack_batch_time is None:
+            ack_batch_time = self.config.get('ack_batch_time',
+                                             Consumer.ack_batch_time)
+        if lazy_decode is None:
+            lazy_decode = self.config.get('lazy_decode', False)
+
+        if self.is_local(routing_key, exchange_name):
+            return self.start_local_consumer(
+                routing_key, callback, queue_name=queue_name,
+                exchange_name=exchange_name, exchange_type=exchange_type,
+                message_class=message_class, paused=paused,
+                max_in_flight=max_in_flight)
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -215,6 +542,10 @@ class Worker(MultiService, object):
             'exchange_type': exchange_type,
             'durable': durable,
             'start_paused': paused,
+            'max_in_flight': max_in_flight,
+            'ack_batch_size': ack_batch_size,
+            'ack_batch_time': ack_batch_time,
+            'lazy_decode': lazy_decode,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -223,11 +554,59 @@ class Worker(MultiService, object):
         return self.start_consumer(klass, callback)
 
     def start_consumer(self, consumer_class, *args, **kw):
-        return self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        d = self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        return d.addCallback(self._track_consumer)
+
+    def is_local(self, routing_key, exchange_name='vumi'):
+        """
+        Check whether messages for `routing_key` on `exchange_name` go
+        through the in-process bus instead of the AMQP broker.
+
+        This is set by the ``local_routing_keys`` and ``local_exchanges``
+        config options. See :mod:`vumi.local_bus`.
+        """
+        return (routing_key in self.config.get('local_routing_keys', ()) or
+                exchange_name in self.config.get('local_exchanges', ()))
+
+    def start_local_consumer(self, routing_key, callback, queue_name=None,
+                             exchange_name='vumi', exchange_type='direct',
+                             message_class=None, paused=False,
+                             max_in_flight=None):
+        bus = get_local_bus()
+        queue_name = queue_name or routing_key
+        bus.exchange_declare(exchange_name, exchange_type)
+        bus.queue_bind(queue_name, exchange_name, routing_key)
+        consumer = LocalConsumer(
+            bus, bus.queue_declare(queue_name), callback,
+            message_class=message_class, max_in_flight=max_in_flight,
+            start_paused=paused)
+        log.msg('Starting local consumer for %s on %s' % (
+            routing_key, exchange_name))
+        consumer.start()
+        self._local_consumers.append(consumer)
+        return succeed(consumer)
+
+    def _track_consumer(self, consumer):
+        self._amqp_consumers.append(consumer)
+        return consumer
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, buffer_size=None, buffer_time=None,
+                   content_type=None):
+        # Buffering delays the deferred returned by publish_message(), so
+        # it's only enabled for publishers that ask for it. The message
+        # encoding may be set in the worker config, like ack coalescing.
+        if buffer_time is None:
+            buffer_time = Publisher.buffer_time
+        if content_type is None:
+            content_type = self.config.get('message_content_type')
+        if content_type is not None:
+            # Fail now rather than on the first message published.
+            get_codec(content_type)
+        if self.is_local(routing_key, exchange_name):
+            return self.start_local_publisher(routing_key, exchange_name,
+                                              exchange_type)
         class_name = self.routing_key_to_class_name(routing_key)
         publisher_class = type("%sDynamicPublisher" % class_name, (Publisher,),
             {
@@ -236,11 +615,25 @@ class Worker(MultiService, object):
                 "exchange_type": exchange_type,
                 "durable": durable,
                 "delivery_mode": delivery_mode,
+                "buffer_size": buffer_size,
+                "buffer_time": buffer_time,
+                "content_type": content_type,
             })
         return self.start_publisher(publisher_class)
 
     def start_publisher(self, publisher_class, *args, **kw):
-        return self._amqp_client.start_publisher(publisher_class, *args, **kw)
+        d = self._amqp_client.start_publisher(publisher_class, *args, **kw)
+        return d.addCallback(self._track_publisher)
+
+    def _track_publisher(self, publisher):
+        self._amqp_publishers.append(publisher)
+        return publisher
+
+    def start_local_publisher(self, routing_key, exchange_name='vumi',
+                              exchange_type='direct'):
+        bus = get_local_bus()
+        bus.exchange_declare(exchange_name, exchange_type)
+        return succeed(LocalPublisher(bus, exchange_name, routing_key))
 
     def start_web_resources(self, resources, port, site_class=None):
         # start the HTTP server for receiving the receipts
@@ -270,6 +663,30 @@ class Worker(MultiService, object):
 
 
 class Consumer(object):
+    """
+    Consumes messages from an AMQP queue.
+
+    By default messages are processed one at a time, in the order they
+    were delivered. Setting :attr:`max_in_flight` to a number greater
+    than one allows up to that many calls to :meth:`consume_message`
+    to be waiting on their results at once. This is useful for
+    consumers that spend most of their time waiting on remote I/O, but
+    means that messages may finish processing out of order.
+
+    Each processed message is acked as soon as it has been processed
+    unless :attr:`ack_batch_size` is set. In that case acks are held
+    back and sent as a single ack for the highest contiguous delivery
+    tag once :attr:`ack_batch_size` acks are waiting or
+    :attr:`ack_batch_time` seconds have passed, whichever comes first.
+    Messages that are not acked (because :meth:`consume_message`
+    returned ``False`` or failed) are never covered by a coalesced ack.
+    Once such a message is outstanding on the channel, later messages
+    are acked individually (but still in batches).
+
+    If :attr:`lazy_decode` is set, message bodies are only decoded when
+    their fields are first accessed (see :meth:`vumi.message.Message.decode`)
+    so validation errors surface in :meth:`consume_message` instead.
+    """
 
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -280,6 +697,10 @@ class Consumer(object):
 
     message_class = Message
     start_paused = False
+    max_in_flight = None
+    ack_batch_size = None
+    ack_batch_time = 0.1
+    lazy_decode = False
 
     @inlineCallbacks
     def start(self, channel, queue):
@@ -287,21 +708,57 @@ class Consumer(object):
         self.queue = queue
         self.keep_consuming = True
         self._testing = hasattr(channel, 'message_processed')
+        self._in_flight = set()
+        self._in_flight_lock = None
+        if self.is_concurrent():
+            self._in_flight_lock = DeferredSemaphore(self.max_in_flight)
+        self._reset_acks()
 
         @inlineCallbacks
         def read_messages():
             log.msg("Consumer starting...")
             try:
                 while self.keep_consuming:
-                    message = yield self.queue.get()
-                    yield self.consume(message)
+                    if self._in_flight_lock is not None:
+                        yield self._in_flight_lock.acquire()
+                        if not self.keep_consuming:
+                            # stop() was called while we were waiting, so
+                            # it won't wait for anything we start now.
+                            self._in_flight_lock.release()
+                            break
+                        message = yield self.queue.get()
+                        self._consume_in_flight(message)
+                    else:
+                        message = yield self.queue.get()
+                        yield self.consume(message)
             except txamqp.queue.Closed, e:
                 log.err("Queue has closed", e)
+                # Delivery tags are only valid on the channel they arrived
+                # on, so there's nothing useful we can do with these.
+                self._reset_acks()
 
         read_messages()
         yield None
         returnValue(self)
 
+    def is_concurrent(self):
+        return self.max_in_flight is not None and self.max_in_flight > 1
+
+    def _consume_in_flight(self, message):
+        d = self.consume(message)
+        self._in_flight.add(d)
+
+        def _release(result):
+            self._in_flight.discard(d)
+            self._in_flight_lock.release()
+            return result
+
+        d.addBoth(_release)
+        # A failure here shouldn't stop us from consuming further messages.
+        # The message is not acked, so the broker will redeliver it.
+        d.addErrback(log.err)
+        return d
+
     def pause(self):
         return self.channel.channel_flow(active=False)
 
@@ -310,26 +767,127 @@ class Consumer(object):
 
     @inlineCallbacks
     def consume(self, message):
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
+        self._track_delivery(message)
+        try:
+            result = yield self.consume_message(self.decode(message))
+        except:
+            self._delivery_done(message, False)
+            raise
         if self._testing:
             self.channel.message_processed()
         if result is not False:
             returnValue(self.ack(message))
         else:
+            self._delivery_done(message, False)
             log.msg('Received %s as a return value consume_message. '
                     'Not acknowledging AMQ message' % result)
 
+    def decode(self, message):
+        """
+        Decode an AMQP message body into an instance of
+        :attr:`message_class`, using the codec for its content type.
+        """
+        content = message.content
+        return self.message_class.decode(
+            content.body, content.properties.get('content type'),
+            lazy=self.lazy_decode)
+
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
 
     def ack(self, message):
-        self.channel.basic_ack(message.delivery_tag, True)
+        if self.is_coalescing_acks():
+            return self._delivery_done(message, True)
+        # Acking multiple messages at once is only safe if we process
+        # messages in the order they were delivered.
+        multiple = not self.is_concurrent()
+        self.channel.basic_ack(message.delivery_tag, multiple)
+
+    def is_coalescing_acks(self):
+        return self.ack_batch_size is not None and self.ack_batch_size > 1
+
+    def _reset_acks(self):
+        if getattr(self, '_ack_timer', None) is not None:
+            if self._ack_timer.active():
+                self._ack_timer.cancel()
+        self._ack_timer = None
+        # Deliveries are [delivery_tag, status] pairs in delivery order.
+        # Status is None while processing, True if the message should be
+        # acked and False if it should not.
+        self._deliveries = deque()
+        self._deliveries_by_tag = {}
+        self._acks_waiting = 0
+        # Set once we have left a message unacked on this channel, after
+        # which acking with `multiple` set is no longer safe.
+        self._ack_hole = False
+
+    def _track_delivery(self, message):
+        if not self.is_coalescing_acks():
+            return
+        delivery = [message.delivery_tag, None]
+        self._deliveries.append(delivery)
+        self._deliveries_by_tag[message.delivery_tag] = delivery
+
+    def _delivery_done(self, message, ack):
+        delivery = self._deliveries_by_tag.pop(message.delivery_tag, None)
+        if delivery is None:
+            return
+        delivery[1] = ack
+        if not ack:
+            # Acks may have been held back until this message was done.
+            if any(status for _tag, status in self._deliveries):
+                self._schedule_flush()
+            return
+        self._acks_waiting += 1
+        if self._acks_waiting >= self.ack_batch_size:
+            self.flush_acks()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._ack_timer is None:
+            self._ack_timer = reactor.callLater(self.ack_batch_time,
+                                                self.flush_acks)
+
+    def flush_acks(self):
+        """Send any acks being held back for coalescing."""
+        if self._ack_timer is not None:
+            if self._ack_timer.active():
+                self._ack_timer.cancel()
+            self._ack_timer = None
+        last_contiguous_tag = None
+        single_tags = []
+        remaining = deque()
+        for delivery in self._deliveries:
+            delivery_tag, status = delivery
+            if status is None:
+                remaining.append(delivery)
+            elif status is False:
+                self._ack_hole = True
+            elif self._ack_hole:
+                single_tags.append(delivery_tag)
+            elif remaining:
+                # Hold this back until the messages before it are done.
+                remaining.append(delivery)
+            else:
+                last_contiguous_tag = delivery_tag
+        self._deliveries = remaining
+        self._acks_waiting = 0
+        if last_contiguous_tag is not None:
+            self.channel.basic_ack(last_contiguous_tag, True)
+        for delivery_tag in single_tags:
+            self.channel.basic_ack(delivery_tag, False)
 
     @inlineCallbacks
     def stop(self):
         self.keep_consuming = False
+        # Let any messages we're still processing finish so that they
+        # get acked before the channel goes away.
+        if self._in_flight:
+            yield DeferredList(list(self._in_flight))
+        if self.is_coalescing_acks():
+            self.flush_acks()
         # This just marks the channel as closed on the client
         #self.channel.close(None)
         # This actually closes the channel on the server
@@ -346,15 +904,184 @@ class DynamicConsumer(Consumer):
         return self.callback(message)
 
 
-class RoutingKeyError(Exception):
-    def __init__(self, value):
-        self.value = value
+class RoutingKeyBindingCache(object):
+    """
+    Cache of which routing keys are bound to queues on the broker.
+
+    Bindings are fetched from the RabbitMQ management API, all at once,
+    and a single cache is shared by all the publishers on a connection.
+    Only one fetch is in progress at a time, no matter how many routing
+    keys are being checked.
+
+    A routing key that is bound is trusted for :attr:`BOUND_TTL` seconds,
+    after which it is still trusted while the bindings are refreshed in
+    the background. A routing key that is not bound is remembered for
+    :attr:`UNBOUND_TTL` seconds before the bindings are fetched again.
+
+    Bindings are only fetched if the ``check_bindings`` vumi option is
+    set. Otherwise, or if the management API can't be reached, all
+    routing keys are treated as bound until the next refresh.
+
+    Publishers refuse routing keys that aren't all lower case before they
+    check whether they're bound, so only lower case routing keys are ever
+    known to be bound.
+    """
+
+    BOUND_TTL = 300
+    UNBOUND_TTL = 5
+    BINDINGS_URL = "http://localhost:55672/api/bindings"
+
+    def __init__(self, vumi_options, clock=None):
+        self.vumi_options = vumi_options
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        # (exchange_name, routing_key) -> (is_bound, expiry_time)
+        self._known = {}
+        # exchange_name -> set of bound routing keys, or None if the
+        # bindings could not be detected.
+        self._bindings = None
+        self._fetched_at = None
+        self._refresh_waiters = None
+
+    def lookup(self, exchange_name, routing_key):
+        """
+        Return ``True`` or ``False`` if we know whether the routing key is
+        bound, or ``None`` if we don't. This never fetches bindings.
+        """
+        known = self._known.get((exchange_name, routing_key))
+        if known is not None and known[1] > self.clock.seconds():
+            return known[0]
+        return None
+
+    def add_binding(self, exchange_name, routing_key):
+        """Record a binding we know about without asking the broker."""
+        if routing_key != routing_key.lower():
+            # Publishers mustn't find this in the cache and skip the
+            # lower case check.
+            return
+        if self._bindings is not None:
+            self._bindings.setdefault(exchange_name, set()).add(routing_key)
+        self._known[(exchange_name, routing_key)] = (
+            True, self.clock.seconds() + self.BOUND_TTL)
+
+    def is_bound(self, exchange_name, routing_key):
+        """
+        Return a deferred that fires with whether the routing key is bound.
+        """
+        is_bound = self.lookup(exchange_name, routing_key)
+        if is_bound is not None:
+            return succeed(is_bound)
+        is_bound = self._check_bindings(exchange_name, routing_key)
+        if is_bound is not None:
+            return succeed(is_bound)
+        d = self.refresh()
+        d.addCallback(lambda _: self._check_bindings(
+            exchange_name, routing_key, refreshed=True))
+        return d
+
+    def _check_bindings(self, exchange_name, routing_key, refreshed=False):
+        if self._fetched_at is None:
+            return None
+        now = self.clock.seconds()
+        age = now - self._fetched_at
+        key = (exchange_name, routing_key)
+
+        if (self._bindings is None or
+                routing_key in self._bindings.get(exchange_name, ())):
+            if age >= self.BOUND_TTL:
+                # Stale, but probably still true. Don't make the caller
+                # wait for the refresh.
+                self._start_refresh()
+                return True
+            self._known[key] = (True, self._fetched_at + self.BOUND_TTL)
+            return True
+
+        if refreshed or age < self.UNBOUND_TTL:
+            self._known[key] = (False, self._fetched_at + self.UNBOUND_TTL)
+            return False
+        return None
+
+    def refresh(self):
+        """
+        Fetch bindings from the broker, unless a fetch is already in
+        progress. Returns a deferred that fires when the fetch is done.
+        """
+        d = Deferred()
+        self._start_refresh(d)
+        return d
+
+    def _start_refresh(self, waiter=None):
+        starting = self._refresh_waiters is None
+        if starting:
+            self._refresh_waiters = []
+        if waiter is not None:
+            self._refresh_waiters.append(waiter)
+        if starting:
+            d = self.fetch_bindings()
+            d.addCallback(self._refresh_done)
+
+    def _refresh_done(self, bindings):
+        self._bindings = bindings
+        self._fetched_at = self.clock.seconds()
+        known, self._known = self._known, {}
+        for exchange_name, routing_key in known:
+            self._check_bindings(exchange_name, routing_key, refreshed=True)
+        waiters, self._refresh_waiters = self._refresh_waiters, None
+        for d in waiters:
+            d.callback(None)
+
+    @inlineCallbacks
+    def fetch_bindings(self):
+        """
+        Fetch all bindings in our vhost from the RabbitMQ management API.
 
-    def __str__(self):
-        return repr(self.value)
+        Returns a dict of exchange name to a set of bound routing keys, or
+        ``None`` if the bindings could not be detected or the
+        ``check_bindings`` vumi option isn't set.
+        """
+        if not self.vumi_options.get('check_bindings'):
+            returnValue(None)
+        try:
+            resp = yield http_request(self.BINDINGS_URL, None, headers={
+                    'Authorization': basic_auth_string(
+                        self.vumi_options['username'],
+                        self.vumi_options['password']),
+                    }, method='GET')
+            bound_routing_keys = {}
+            for b in json.loads(resp):
+                if b['vhost'] == self.vumi_options['vhost']:
+                    bound_routing_keys.setdefault(b['source'], set()).add(
+                        b['routing_key'])
+        except:
+            # The following is very noisy in the logs:
+            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
+            #         " installed?")
+            bound_routing_keys = None
+        returnValue(bound_routing_keys)
 
 
 class Publisher(object):
+    """
+    Publishes messages to an AMQP exchange.
+
+    :meth:`publish_batch` publishes a list of messages with a single
+    routing key check and a single deferred for the whole list.
+
+    If :attr:`buffer_size` is set, :meth:`publish_message` doesn't publish
+    straight away. Instead, messages are gathered until there are
+    :attr:`buffer_size` of them or :attr:`buffer_time` seconds have
+    passed, whichever comes first, and then published as a batch. The
+    deferred returned by :meth:`publish_message` fires once the batch has
+    been published. This is only useful to callers that don't wait for
+    each message to be published before sending the next one.
+
+    Messages are encoded with the codec for :attr:`content_type` (see
+    :func:`vumi.message.get_codec`) and the AMQP content type header is set
+    so consumers can pick the matching decoder. Consumers accept any
+    supported content type, so publishers can be switched over one at a
+    time.
+    """
     exchange_name = "vumi"
     exchange_type = "direct"
     routing_key = "routing_key"
@@ -362,95 +1089,181 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    buffer_size = None
+    buffer_time = 0.01
+    content_type = None
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
-        self.bound_routing_keys = {}
+        self._buffer = []
+        self._buffer_timer = None
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
+        if getattr(self, 'binding_cache', None) is None:
+            self.binding_cache = RoutingKeyBindingCache(self.vumi_options)
 
-    @inlineCallbacks
-    def list_bindings(self):
-        try:
-            # Note utils.callback() does a POST not a GET
-            # which may lead to errors if the RabbitMQ Management REST api
-            # changes
-            resp = yield http_request(
-                "http://localhost:55672/api/bindings", headers={
-                    'Authorization': basic_auth_string(
-                        self.vumi_options['username'],
-                        self.vumi_options['password']),
-                    })
-            bindings = json.loads(resp)
-            bound_routing_keys = {}
-            for b in bindings:
-                if (b['vhost'] == self.vumi_options['vhost'] and
-                    b['source'] == self.exchange_name):
-                    bound_routing_keys[b['routing_key']] = \
-                            bound_routing_keys.get(b['routing_key'], []) + \
-                            [b['destination']]
-        except:
-            bound_routing_keys = {"bindings": "undetected"}
-        returnValue(bound_routing_keys)
-
-    @inlineCallbacks
-    def routing_key_is_bound(self, key):
+    def routing_key_is_bound(self, key, exchange_name=None):
+        if exchange_name is None:
+            exchange_name = self.exchange_name
         # Don't check for bound routing keys on RPC reply exchanges
         # The one-use queues are changing too frequently to cache efficiently,
         # too many http calls to RabbitMQ Management will be required,
         # and the auto-generated queues & routing_keys are unlikley to
         # result in errors where routing keys are unbound
-        if self.exchange_name[-4:].lower() == '_rpc':
-            returnValue(True)
-        if (len(self.bound_routing_keys) == 1 and
-            self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        if key in self.bound_routing_keys.keys():
-            returnValue(True)
-        self.bound_routing_keys = yield self.list_bindings()
-        if (len(self.bound_routing_keys) == 1 and
-            self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        returnValue(key in self.bound_routing_keys.keys())
+        if exchange_name[-4:].lower() == '_rpc':
+            return succeed(True)
+        return self.binding_cache.is_bound(exchange_name, key)
 
     @inlineCallbacks
-    def check_routing_key(self, routing_key, require_bind):
+    def check_routing_key(self, routing_key, require_bind,
+                          exchange_name=None):
+        if exchange_name is None:
+            exchange_name = self.exchange_name
         if(routing_key != routing_key.lower()):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
                                   % (routing_key))
         if not require_bind:
             return
-        is_bound = yield self.routing_key_is_bound(routing_key)
+        is_bound = yield self.routing_key_is_bound(routing_key, exchange_name)
         if not is_bound:
             raise RoutingKeyError("The routing_key: %s is not bound to any"
                                   " queues in vhost: %s  exchange: %s" % (
-                                  routing_key, self.vumi_options['vhost'],
-                                  self.exchange_name))
+                                  routing_key, self.vumi_options.get('vhost'),
+                                  exchange_name))
 
-    @inlineCallbacks
     def publish(self, message, **kwargs):
         exchange_name = kwargs.get('exchange_name') or self.exchange_name
         routing_key = kwargs.get('routing_key') or self.routing_key
         require_bind = kwargs.get('require_bind', self.require_bind)
-        yield self.check_routing_key(routing_key, require_bind)
-        yield self.channel.basic_publish(exchange=exchange_name,
-                                         content=message,
-                                         routing_key=routing_key)
+        # Routing keys only get into the binding cache after they've been
+        # checked, so we can skip straight to publishing.
+        if (require_bind and
+                self.binding_cache.lookup(exchange_name, routing_key)):
+            return self._basic_publish(exchange_name, routing_key, message)
+        d = self.check_routing_key(routing_key, require_bind, exchange_name)
+        d.addCallback(lambda _: self._basic_publish(
+            exchange_name, routing_key, message))
+        return d
+
+    def _basic_publish(self, exchange_name, routing_key, message):
+        return maybeDeferred(self.channel.basic_publish,
+                             exchange=exchange_name, content=message,
+                             routing_key=routing_key)
+
+    def publish_many(self, messages, **kwargs):
+        """
+        Publish a list of AMQP messages to the same exchange and routing key.
+
+        This is the batch equivalent of :meth:`publish`.
+        """
+        exchange_name = kwargs.get('exchange_name') or self.exchange_name
+        routing_key = kwargs.get('routing_key') or self.routing_key
+        require_bind = kwargs.get('require_bind', self.require_bind)
+
+        def _publish(_):
+            ds = []
+            for message in messages:
+                d = self.channel.basic_publish(exchange=exchange_name,
+                                               content=message,
+                                               routing_key=routing_key)
+                if isinstance(d, Deferred):
+                    ds.append(d)
+            return gatherResults(ds, consumeErrors=True)
+
+        if (require_bind and
+                self.binding_cache.lookup(exchange_name, routing_key)):
+            return _publish(None)
+        d = self.check_routing_key(routing_key, require_bind, exchange_name)
+        return d.addCallback(_publish)
+
+    def publish_batch(self, messages, **kwargs):
+        """
+        Publish a list of :class:`vumi.message.Message` instances.
+
+        Returns a deferred that fires with the list of messages once they
+        have all been published.
+        """
+        delivery_mode = kwargs.pop('delivery_mode', self.delivery_mode)
+        amq_messages = [self.make_content(message, delivery_mode)
+                        for message in messages]
+        d = self.publish_many(amq_messages, **kwargs)
+        d.addCallback(lambda r: messages)
+        return d
 
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        if self.buffer_size is not None:
+            return self._buffer_message(message, kwargs)
+        delivery_mode = kwargs.pop('delivery_mode', self.delivery_mode)
+        d = self.publish(self.make_content(message, delivery_mode), **kwargs)
         d.addCallback(lambda r: message)
         return d
 
+    def make_content(self, message, delivery_mode):
+        """
+        Encode a :class:`vumi.message.Message` as AMQP content using the
+        codec for :attr:`content_type`.
+
+        Messages are JSON encoded with no content type header by default.
+        """
+        amq_message = Content(message.encode(self.content_type))
+        amq_message['delivery mode'] = delivery_mode
+        if self.content_type is not None:
+            amq_message['content type'] = self.content_type
+        return amq_message
+
+    def _buffer_message(self, message, kwargs):
+        d = Deferred()
+        self._buffer.append((message, kwargs, d))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+        elif self._buffer_timer is None:
+            self._buffer_timer = reactor.callLater(self.buffer_time,
+                                                   self.flush)
+        return d
+
+    def flush(self):
+        """
+        Publish any buffered messages.
+
+        Returns a deferred that fires once they have been published.
+        """
+        if self._buffer_timer is not None:
+            if self._buffer_timer.active():
+                self._buffer_timer.cancel()
+            self._buffer_timer = None
+        buffered, self._buffer = self._buffer, []
+
+        # Messages published with the same options can go out together.
+        batches = {}
+        batch_order = []
+        for message, kwargs, d in buffered:
+            key = tuple(sorted(kwargs.items()))
+            if key not in batches:
+                batches[key] = (kwargs, [], [])
+                batch_order.append(key)
+            batches[key][1].append(message)
+            batches[key][2].append(d)
+
+        flush_ds = []
+        for key in batch_order:
+            kwargs, messages, ds = batches[key]
+            batch_d = self.publish_batch(messages, **kwargs)
+            batch_d.addCallbacks(self._batch_published, self._batch_failed,
+                                 callbackArgs=(ds,), errbackArgs=(ds,))
+            flush_ds.append(batch_d)
+        return DeferredList(flush_ds)
+
+    def _batch_published(self, messages, ds):
+        for message, d in zip(messages, ds):
+            d.callback(message)
+
+    def _batch_failed(self, failure, ds):
+        for d in ds:
+            d.errback(failure)
+
     def publish_json(self, data, **kw):
         """helper method"""
         return self.publish_raw(json.dumps(data, cls=json.JSONEncoder), **kw)
@@ -467,8 +1280,9 @@ class WorkerCreator(object):
     Creates workers
     """
 
-    def __init__(self, vumi_options):
+    def __init__(self, vumi_options, shared_connection=None):
         self.options = vumi_options
+        self.shared_connection = shared_connection
 
     def create_worker(self, worker_class, config, timeout=30,
                       bindAddress=None):
@@ -484,7 +1298,10 @@ class WorkerCreator(object):
     def create_worker_by_class(self, worker_class, config, timeout=30,
                                bindAddress=None):
         worker = worker_class(deepcopy(self.options), config)
-        self._connect(worker, timeout=timeout, bindAddress=bindAddress)
+        if self.shared_connection is not None:
+            self.shared_connection.attach(worker)
+        else:
+            self._connect(worker, timeout=timeout, bindAddress=bindAddress)
         return worker
 
     def _connect(self, worker, timeout, bindAddress):
@@ -64,26 +64,26 @@ def mkMethod(name, index=-1):
 
 def mkContent(body, children=None, properties=None):
     return Thing("Content", body=body, children=children,
-                 properties=properties)
+                 properties=properties or {})
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
-def mk_get_ok(body, exchange, routing_key, dtag):
+def mk_get_ok(body, exchange, routing_key, dtag, properties=None):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
 class FakeAMQPBroker(object):
@@ -185,7 +185,8 @@ class FakeAMQPBroker(object):
             dtag, msg = self._get_queue(queue).get_message()
             while dtag is not None:
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg['properties'])
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, queue)
                 delivered = True
@@ -251,7 +252,8 @@ class FakeAMQPBroker(object):
 
     def get_messages(self, exchange, rkey):
         contents = self.get_dispatched(exchange, rkey)
-        messages = [VumiMessage.from_json(content.body)
+        messages = [VumiMessage.decode(content.body,
+                                       content.properties.get('content type'))
                     for content in contents]
         return messages
 
@@ -355,7 +357,7 @@ class FakeAMQPChannel(object):
         if msg:
             self.unacked.append((dtag, queue))
             return mk_get_ok(msg['content'], msg['exchange'],
-                             msg['routing_key'], dtag)
+                             msg['routing_key'], dtag, msg['properties'])
         return Message(mkMethod("get-empty", 72))
 
     def message_processed(self):
@@ -441,6 +443,7 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': dict(getattr(content, 'properties', None) or {}),
                 })
 
     def ack(self, delivery_tag):
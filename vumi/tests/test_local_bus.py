@@ -0,0 +1,289 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
+
+from vumi import local_bus
+from vumi.local_bus import (LocalMessageBus, LocalConsumer, LocalPublisher,
+                            topic_matches)
+from vumi.errors import RoutingKeyError
+from vumi.message import Message, TransportUserMessage
+from vumi.service import Worker
+from vumi.tests.utils import get_stubbed_worker
+
+
+class TopicMatchesTestCase(TestCase):
+
+    def test_exact(self):
+        self.assertTrue(topic_matches('a.b', 'a.b'))
+        self.assertFalse(topic_matches('a.b', 'a.c'))
+        self.assertFalse(topic_matches('a.b', 'a.b.c'))
+
+    def test_star(self):
+        self.assertTrue(topic_matches('a.*', 'a.b'))
+        self.assertFalse(topic_matches('a.*', 'a'))
+        self.assertFalse(topic_matches('a.*', 'a.b.c'))
+
+    def test_hash(self):
+        self.assertTrue(topic_matches('#', 'a.b'))
+        self.assertTrue(topic_matches('a.#', 'a'))
+        self.assertTrue(topic_matches('a.#', 'a.b.c'))
+        self.assertTrue(topic_matches('a.#.d', 'a.b.c.d'))
+        self.assertFalse(topic_matches('a.#.d', 'a.b.c'))
+
+
+class LocalMessageBusTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.bus = LocalMessageBus(self.clock)
+        self.bus.exchange_declare('vumi', 'direct')
+
+    def consume(self, routing_key, callback, **kw):
+        self.bus.queue_bind(routing_key, 'vumi', routing_key)
+        consumer = LocalConsumer(self.bus, self.bus.queue_declare(routing_key),
+                                 callback, **kw)
+        consumer.start()
+        return consumer
+
+    def publish(self, routing_key, **fields):
+        publisher = LocalPublisher(self.bus, 'vumi', routing_key)
+        return publisher.publish_message(Message(**fields))
+
+    def deliver(self):
+        self.clock.advance(0)
+
+    def test_delivery_in_order(self):
+        received = []
+        self.consume('foo', received.append)
+        for i in range(3):
+            self.publish('foo', i=i)
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0, 1, 2])
+
+    def test_delivery_not_in_publisher_stack(self):
+        received = []
+        self.consume('foo', received.append)
+        d = self.publish('foo', i=0)
+        self.assertTrue(d.called)
+        self.assertEqual(received, [])
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0])
+
+    def test_messages_held_until_consumer_starts(self):
+        received = []
+        self.publish('foo', i=0)
+        self.publish('foo', i=1)
+        self.deliver()
+        self.assertEqual(received, [])
+        self.consume('foo', received.append)
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0, 1])
+
+    def test_consumers_get_copies(self):
+        received = []
+        self.consume('foo', received.append)
+        msg = Message(data={'a': 1})
+        LocalPublisher(self.bus, 'vumi', 'foo').publish_message(msg)
+        self.deliver()
+        received[0]['data']['a'] = 2
+        self.assertEqual(msg['data'], {'a': 1})
+
+    def test_message_class(self):
+        received = []
+        self.consume('foo', received.append,
+                     message_class=TransportUserMessage)
+        msg = TransportUserMessage(to_addr='+1', from_addr='+2',
+                                   transport_name='t', transport_type='sms')
+        LocalPublisher(self.bus, 'vumi', 'foo').publish_message(
+            Message(**msg.payload))
+        self.deliver()
+        self.assertEqual(type(received[0]), TransportUserMessage)
+        self.assertEqual(received[0], msg)
+
+    def test_max_in_flight(self):
+        pending = []
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        self.consume('foo', handler, max_in_flight=2)
+        for i in range(3):
+            self.publish('foo', i=i)
+        self.deliver()
+        self.assertEqual([m['i'] for m, d in pending], [0, 1])
+        pending[0][1].callback(None)
+        self.deliver()
+        self.assertEqual([m['i'] for m, d in pending], [0, 1, 2])
+
+    def test_prefetch_limits_unacked(self):
+        received = []
+
+        def handler(msg):
+            received.append(msg)
+            return False
+
+        consumer = self.consume('foo', handler, max_in_flight=10)
+        consumer.channel.basic_qos(0, 2, False)
+        for i in range(3):
+            self.publish('foo', i=i)
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0, 1])
+
+    def test_pause_and_unpause(self):
+        received = []
+        consumer = self.consume('foo', received.append)
+        consumer.pause()
+        self.publish('foo', i=0)
+        self.deliver()
+        self.assertEqual(received, [])
+        consumer.unpause()
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0])
+
+    @inlineCallbacks
+    def test_unacked_messages_requeued_on_stop(self):
+        failed = []
+
+        def fail_handler(msg):
+            failed.append(msg)
+            raise ValueError("Processing failed.")
+
+        consumer = self.consume('foo', fail_handler)
+        self.publish('foo', i=0)
+        self.publish('foo', i=1)
+        self.deliver()
+        self.assertEqual([m['i'] for m in failed], [0, 1])
+        self.flushLoggedErrors(ValueError)
+        yield consumer.stop()
+
+        received = []
+        self.consume('foo', received.append)
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0, 1])
+
+    @inlineCallbacks
+    def test_equal_unacked_messages_requeued_on_stop(self):
+        acks = []
+
+        def handler(msg):
+            acks.append(msg['ack'])
+            return msg['ack']
+
+        consumer = self.consume('foo', handler, max_in_flight=3)
+        self.publish('foo', i=0, ack=False)
+        self.publish('foo', i=0, ack=True)
+        self.publish('foo', i=0, ack=False)
+        self.deliver()
+        self.assertEqual(acks, [False, True, False])
+        self.assertEqual(len(consumer._unacked), 2)
+        yield consumer.stop()
+        self.assertEqual(len(self.bus.queues['foo'].messages), 2)
+
+    @inlineCallbacks
+    def test_stop_waits_for_in_flight(self):
+        d = Deferred()
+        consumer = self.consume('foo', lambda msg: d)
+        self.publish('foo', i=0)
+        self.deliver()
+        stop_d = consumer.stop()
+        self.assertFalse(stop_d.called)
+        d.callback(None)
+        yield stop_d
+        self.assertEqual(list(self.bus.queues['foo'].messages), [])
+
+    def test_round_robin(self):
+        first, second = [], []
+        self.consume('foo', first.append)
+        self.consume('foo', second.append)
+        for i in range(4):
+            self.publish('foo', i=i)
+        self.deliver()
+        self.assertEqual([m['i'] for m in first], [0, 2])
+        self.assertEqual([m['i'] for m in second], [1, 3])
+
+    def test_consumer_publishing_to_own_queue(self):
+        received = []
+        publisher = LocalPublisher(self.bus, 'vumi', 'foo')
+
+        def handler(msg):
+            received.append(msg['i'])
+            if msg['i'] < 3:
+                publisher.publish_message(Message(i=msg['i'] + 1))
+
+        self.consume('foo', handler)
+        self.publish('foo', i=0)
+        self.deliver()
+        self.assertEqual(received, [0, 1, 2, 3])
+
+    def test_topic_exchange(self):
+        self.bus.exchange_declare('events', 'topic')
+        received = []
+        self.bus.queue_bind('q', 'events', 'foo.*')
+        LocalConsumer(self.bus, self.bus.queue_declare('q'),
+                      received.append).start()
+        publisher = LocalPublisher(self.bus, 'events', 'foo.bar')
+        publisher.publish_message(Message(i=0))
+        self.deliver()
+        self.assertEqual([m['i'] for m in received], [0])
+        d = publisher.publish_message(Message(i=1), routing_key='bar.baz')
+        return self.assertFailure(d, RoutingKeyError)
+
+
+class WorkerLocalBusTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(local_bus, '_local_bus', LocalMessageBus(self.clock))
+        self.config = {'local_routing_keys': ['local.inbound']}
+
+    @inlineCallbacks
+    def test_local_routing_key(self):
+        sender = get_stubbed_worker(Worker, self.config)
+        receiver = get_stubbed_worker(
+            Worker, self.config, sender._amqp_client.broker)
+        received = []
+        yield receiver.consume('local.inbound', received.append,
+                               message_class=TransportUserMessage)
+        publisher = yield sender.publish_to('local.inbound')
+        msg = TransportUserMessage(to_addr='+1', from_addr='+2',
+                                   transport_name='t', transport_type='sms')
+        yield publisher.publish_message(msg)
+        self.clock.advance(0)
+        self.assertEqual(received, [msg])
+        broker = sender._amqp_client.broker
+        self.assertEqual(broker.get_messages('vumi', 'local.inbound'), [])
+
+    @inlineCallbacks
+    def test_other_routing_keys_use_amqp(self):
+        worker = get_stubbed_worker(Worker, self.config)
+        publisher = yield worker.publish_to('amqp.inbound')
+        self.assertFalse(isinstance(publisher, LocalPublisher))
+        yield publisher.publish_message(Message(i=0), require_bind=False)
+        broker = worker._amqp_client.broker
+        self.assertEqual([m['i'] for m in broker.get_messages(
+            'vumi', 'amqp.inbound')], [0])
+        self.assertEqual(local_bus.get_local_bus().queues, {})
+
+    @inlineCallbacks
+    def test_local_exchange(self):
+        worker = get_stubbed_worker(Worker, {'local_exchanges': ['local']})
+        received = []
+        yield worker.consume('foo', received.append, exchange_name='local')
+        publisher = yield worker.publish_to('foo', exchange_name='local')
+        yield publisher.publish_message(Message(i=0))
+        self.clock.advance(0)
+        self.assertEqual([m['i'] for m in received], [0])
+
+    @inlineCallbacks
+    def test_stop_worker_requeues_unacked(self):
+        worker = get_stubbed_worker(Worker, self.config)
+        yield worker.consume('local.inbound', lambda msg: False)
+        publisher = yield worker.publish_to('local.inbound')
+        yield publisher.publish_message(Message(i=0))
+        self.clock.advance(0)
+        worker.running = False
+        yield worker.stopService()
+        queue = local_bus.get_local_bus().queues['local.inbound']
+        self.assertEqual([m['i'] for m in queue.messages], [0])
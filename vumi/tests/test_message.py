@@ -1,8 +1,18 @@
+import json
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
+from vumi import message as vumi_message
+from vumi.errors import (MessageCodecError, MissingMessageField,
+                         InvalidMessageField)
 from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+                          TransportUserMessage, JSONMessageCodec,
+                          MsgpackMessageCodec, get_codec,
+                          JSONMessageEncoder, VUMI_DATE_FORMAT,
+                          date_time_decoder, parse_vumi_date, from_json,
+                          to_json)
 
 
 class MessageTest(TestCase):
@@ -206,6 +216,24 @@ class MessageTest(TestCase):
         self.assertEqual(msg['transport_metadata'], {})
         self.assertEqual(msg['helper_metadata'], {})
 
+    def test_message_copy(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='heya',
+            transport_name='sphex', transport_type='sms',
+            transport_metadata={'foo': ['bar']},
+            helper_metadata={'tag': {'when': datetime(2012, 1, 2)}})
+        copy = msg.copy()
+        self.assertTrue(isinstance(copy, TransportUserMessage))
+        self.assertEqual(msg, copy)
+        self.assertEqual(TransportUserMessage.from_json(msg.to_json()), copy)
+        copy['transport_metadata']['foo'].append('baz')
+        copy['helper_metadata']['tag']['new'] = 1
+        copy['content'] = 'changed'
+        self.assertEqual({'foo': ['bar']}, msg['transport_metadata'])
+        self.assertEqual({'tag': {'when': datetime(2012, 1, 2)}},
+                         msg['helper_metadata'])
+        self.assertEqual('heya', msg['content'])
+
     def test_transport_event_ack(self):
         msg = TransportEvent(
             event_id='def',
@@ -239,3 +267,280 @@ class MessageTest(TestCase):
         self.assertEqual('20110921', msg['message_version'])
         # self.assertEqual('sphex', msg['transport_name'])
         self.assertEqual('delivered', msg['delivery_status'])
+
+
+class JSONMessageCodecTest(TestCase):
+
+    def setUp(self):
+        self.codec = JSONMessageCodec()
+
+    def legacy_decode(self, data):
+        def hook(json_object):
+            for key, value in json_object.items():
+                try:
+                    json_object[key] = datetime.strptime(
+                        value, VUMI_DATE_FORMAT)
+                except (ValueError, TypeError):
+                    pass
+            return json_object
+        return json.loads(data, object_hook=hook)
+
+    def assert_decodes_like_legacy(self, data, timestamp_fields=()):
+        expected = self.legacy_decode(data)
+        self.assertEqual(expected, self.codec.decode(data, timestamp_fields))
+        self.assertEqual(expected, from_json(data))
+
+    def test_parse_vumi_date(self):
+        self.assertEqual(datetime(2012, 1, 2, 3, 4, 5, 600000),
+                         parse_vumi_date("2012-01-02 03:04:05.6"))
+        self.assertEqual(datetime(2012, 1, 2, 3, 4, 5, 123456),
+                         parse_vumi_date(u"2012-1-2 3:4:5.123456"))
+        self.assertEqual(None, parse_vumi_date("2012-13-02 03:04:05.6"))
+        self.assertEqual(None, parse_vumi_date("2012-01-02 03:04:05"))
+        self.assertEqual(None, parse_vumi_date("2012-01-02 03:04:05.6 x"))
+        self.assertEqual(None, parse_vumi_date("2012-01-01 10:00:00.000\n"))
+        self.assertEqual(None, parse_vumi_date(None))
+        self.assertEqual(None, parse_vumi_date(12))
+
+    def test_encode_matches_legacy(self):
+        payload = {
+            'timestamp': datetime(2012, 1, 2, 3, 4, 5, 6),
+            'content': u'caf\xe9',
+            'helper_metadata': {'when': datetime(2012, 5, 6, 7, 8, 9)},
+            }
+        self.assertEqual(json.dumps(payload, cls=JSONMessageEncoder),
+                         self.codec.encode(payload))
+        self.assertEqual(json.dumps(payload, cls=JSONMessageEncoder),
+                         to_json(payload))
+
+    def test_encode_unserializable(self):
+        self.assertRaises(TypeError, self.codec.encode, {'foo': object()})
+
+    def test_decode_without_dates(self):
+        self.assert_decodes_like_legacy('{"a": "b", "c": [1, {"d": null}]}')
+
+    def test_decode_strings_as_unicode(self):
+        obj = self.codec.decode('{"a": "b", "c": ["d"], "e": {"f": "g"}}')
+        self.assertEqual({u'a': u'b', u'c': [u'd'], u'e': {u'f': u'g'}}, obj)
+        self.assertEqual(unicode, type(obj['a']))
+        self.assertEqual(unicode, type(obj['c'][0]))
+        self.assertEqual(unicode, type(obj['e']['f']))
+        self.assertEqual(unicode, type(obj.keys()[0]))
+
+    def test_decode_ignores_fast_json(self):
+        class StrJSON(object):
+            JSONEncoder = json.JSONEncoder
+
+            @staticmethod
+            def loads(data):
+                return {'a': 'b'}
+
+        self.patch(vumi_message, 'fast_json', StrJSON)
+        obj = JSONMessageCodec().decode('{"a": "b"}')
+        self.assertEqual(unicode, type(obj['a']))
+
+    def test_decode_timestamp_field(self):
+        data = '{"timestamp": "2012-01-02 03:04:05.000006", "a": "b"}'
+        self.assert_decodes_like_legacy(data, ('timestamp',))
+        self.assertEqual(datetime(2012, 1, 2, 3, 4, 5, 6),
+                         self.codec.decode(data, ('timestamp',))['timestamp'])
+
+    def test_decode_nested_dates(self):
+        data = json.dumps({
+            'timestamp': '2012-01-02 03:04:05.000006',
+            'meta': {'when': '2012-05-06 07:08:09.1', 'x': ['a']},
+            'items': [{'at': '2012-05-06 07:08:09.123456'}],
+            'list_dates': ['2012-05-06 07:08:09.123456'],
+            'content': 'Not a date: 2012-05-06 07:08:09.123456',
+            'bad': '2012-05-36 07:08:09.123456',
+            })
+        self.assert_decodes_like_legacy(data, ('timestamp',))
+        self.assert_decodes_like_legacy(data)
+
+    def test_decode_date_in_content(self):
+        data = json.dumps({'content': '2012-05-06 07:08:09.123456'})
+        self.assert_decodes_like_legacy(data, ('timestamp',))
+
+    def test_date_time_decoder(self):
+        self.assertEqual(
+            {'a': datetime(2012, 1, 2, 3, 4, 5, 6), 'b': 'c', 'd': 1},
+            date_time_decoder({'a': '2012-01-02 03:04:05.000006', 'b': 'c',
+                               'd': 1}))
+
+    def test_message_round_trip(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='heya',
+            transport_name='sphex', transport_type='sms',
+            helper_metadata={'when': datetime(2012, 1, 2, 3, 4, 5, 6)})
+        self.assertEqual(msg, TransportUserMessage.from_json(msg.to_json()))
+        event = TransportEvent(event_type='ack', user_message_id='abc',
+                               sent_message_id='ghi')
+        self.assertEqual(event, TransportEvent.from_json(event.to_json()))
+
+
+class MessageCodecTest(TestCase):
+
+    def make_message(self):
+        return TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content=u'caf\xe9',
+            transport_name='sphex', transport_type='sms',
+            helper_metadata={'when': datetime(2012, 1, 2, 3, 4, 5, 6)})
+
+    def test_get_codec_default(self):
+        self.assertTrue(isinstance(get_codec(), JSONMessageCodec))
+        self.assertTrue(get_codec() is get_codec('application/json'))
+
+    def test_get_codec_unknown(self):
+        self.assertRaises(MessageCodecError, get_codec, 'text/unknown')
+
+    def test_json_encode_decode(self):
+        msg = self.make_message()
+        self.assertEqual(msg.to_json(), msg.encode())
+        self.assertEqual(msg, TransportUserMessage.decode(
+            msg.encode('application/json'), 'application/json'))
+
+    def test_msgpack_missing(self):
+        self.patch(vumi_message, 'msgpack', None)
+        self.assertRaises(MessageCodecError, MsgpackMessageCodec)
+
+    def test_msgpack_encode_decode(self):
+        msg = self.make_message()
+        data = msg.encode('application/x-msgpack')
+        self.assertEqual(msg, TransportUserMessage.decode(
+            data, 'application/x-msgpack'))
+        self.assertTrue(len(data) < len(msg.to_json()))
+
+    def test_msgpack_decodes_strings_as_unicode(self):
+        codec = MsgpackMessageCodec()
+        payload = codec.decode(codec.encode({'a': 'b', u'c': [u'd']}))
+        self.assertEqual({u'a': u'b', u'c': [u'd']}, payload)
+        self.assertEqual(unicode, type(payload['a']))
+        self.assertEqual(unicode, type(payload.keys()[0]))
+
+    if vumi_message.msgpack is None:
+        test_msgpack_encode_decode.skip = "msgpack not installed"
+        test_msgpack_decodes_strings_as_unicode.skip = "msgpack not installed"
+
+    def test_msgpack_string_options(self):
+        options = {}
+
+        class FakeMsgpack(object):
+            @staticmethod
+            def packb(payload, default, use_bin_type):
+                options['use_bin_type'] = use_bin_type
+                return json.dumps(payload, default=default)
+
+            @staticmethod
+            def unpackb(data, object_hook, raw):
+                options['raw'] = raw
+                return json.loads(data, object_hook=object_hook)
+
+        self.patch(vumi_message, 'msgpack', FakeMsgpack)
+        codec = MsgpackMessageCodec()
+        msg = self.make_message()
+        payload = codec.decode(codec.encode(msg.payload))
+        self.assertEqual(msg, TransportUserMessage(_process_fields=False,
+                                                   **payload))
+        # str must not be sent as binary and strings must decode to unicode.
+        self.assertEqual({'use_bin_type': False, 'raw': False}, options)
+
+
+class LazyMessageTest(TestCase):
+
+    def make_data(self, **kw):
+        return TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='heya',
+            transport_name='sphex', transport_type='sms',
+            helper_metadata={'tag': ['pool', 'tag1']}, **kw).to_json()
+
+    def test_lazy_decode(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        self.assertEqual(None, msg._payload)
+        self.assertEqual(data, msg.to_json())
+        self.assertEqual(None, msg._payload)
+        self.assertEqual('heya', msg['content'])
+        self.assertEqual(TransportUserMessage.decode(data), msg)
+
+    def test_read_immutable_fields(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        self.assertEqual('sphex', msg['transport_name'])
+        self.assertEqual('12345', msg.get('from_addr'))
+        self.assertTrue('to_addr' in msg)
+        self.assertTrue(msg.to_json() is data)
+
+    def test_set_field(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        msg['content'] = 'changed'
+        self.assertNotEqual(data, msg.to_json())
+        decoded = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual('changed', decoded['content'])
+
+    def test_read_mutable_field(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        msg['helper_metadata']['tag'][1] = 'tag2'
+        self.assertEqual(
+            {'tag': ['pool', 'tag2']},
+            TransportUserMessage.from_json(msg.to_json())['helper_metadata'])
+
+    def test_payload_access(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        msg.payload['content'] = 'changed'
+        decoded = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual('changed', decoded['content'])
+
+    def test_encode_other_codec(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        self.patch(vumi_message, '_codecs', dict(vumi_message._codecs))
+        vumi_message._codecs['text/test'] = JSONMessageCodec(json)
+        self.assertFalse(msg.encode('text/test') is data)
+        self.assertEqual(json.loads(data),
+                         json.loads(msg.encode('text/test')))
+
+    def test_copy(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data, lazy=True)
+        copy = msg.copy()
+        self.assertTrue(copy.to_json() is data)
+        copy['content'] = 'changed'
+        self.assertEqual('heya', msg['content'])
+        self.assertTrue(msg.to_json() is data)
+
+    def test_copy_decoded(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data)
+        msg._payload['content'] = 'changed'
+        copy = msg.copy()
+        # The copy is made from the decoded payload, not the data.
+        self.assertEqual('changed', copy._payload['content'])
+        self.assertFalse(copy._payload is msg._payload)
+
+    def test_validation_on_access(self):
+        msg = TransportUserMessage.decode('{"content": "foo"}', lazy=True)
+        self.assertRaises(MissingMessageField, msg.__getitem__, 'content')
+        self.assertEqual(None, msg._payload)
+        self.assertRaises(MissingMessageField, msg.__getitem__, 'content')
+        self.assertRaises(MissingMessageField, lambda: msg.payload)
+        self.assertRaises(MissingMessageField, msg.copy().get, 'content')
+
+    def test_validation_failure_after_field_changes(self):
+        fields = json.loads(self.make_data())
+        del fields['group']
+        fields['session_event'] = 'bad'
+        msg = TransportUserMessage.decode(json.dumps(fields), lazy=True)
+        # Validation sets 'group' before it fails, which mustn't discard
+        # the raw data.
+        self.assertRaises(InvalidMessageField, msg.__getitem__, 'content')
+        self.assertRaises(InvalidMessageField, msg.__getitem__, 'content')
+
+    def test_eager_decode_keeps_data(self):
+        data = self.make_data()
+        msg = TransportUserMessage.decode(data)
+        self.assertTrue(msg.to_json() is data)
+        msg['content'] = 'changed'
+        self.assertFalse(msg.to_json() is data)
@@ -1,11 +1,21 @@
+import os
+
+import yaml
 from twisted.trial.unittest import TestCase
+from twisted.internet.error import (ProcessDone, ProcessTerminated,
+                                    ProcessExitedAlready)
+from twisted.internet.task import Clock, deferLater
+from twisted.internet import reactor
+from twisted.python.failure import Failure
 from twisted.internet.defer import (Deferred, DeferredList, inlineCallbacks,
                                     returnValue)
 
 from vumi.tests.utils import StubbedWorkerCreator, get_stubbed_worker
-from vumi.service import Worker
+from vumi.tests.fake_amqp import FakeAMQClient
+from vumi.service import Worker, SharedAmqpConnection, get_spec
+from vumi.utils import vumi_resource_path
 from vumi.message import TransportUserMessage
-from vumi.multiworker import MultiWorker
+from vumi.multiworker import MultiWorker, ProcessMultiWorker
 
 
 class ToyWorker(Worker):
@@ -31,12 +41,44 @@ class ToyWorker(Worker):
             message.reply(''.join(reversed(message['content']))))
 
 
+class SlowStoppingWorker(ToyWorker):
+    @inlineCallbacks
+    def stopWorker(self):
+        yield deferLater(reactor, 0, lambda: None)
+        yield self.pub.publish_message(mkmsg("bye"))
+        self.events.append("STOP: %s" % self.name)
+
+
+class StubbedSharedConnection(SharedAmqpConnection):
+    def __init__(self, options, broker):
+        self.broker = broker
+        super(StubbedSharedConnection, self).__init__(options)
+
+    def _connect(self, timeout, bindAddress):
+        self.connections = 0
+
+    def startService(self):
+        super(StubbedSharedConnection, self).startService()
+        spec = get_spec(vumi_resource_path("amqp-spec-0-8.xml"))
+        self.connections += 1
+        reactor.callLater(0, self._amqp_connected,
+                          FakeAMQClient(spec, self.options, self.broker))
+
+    def stopService(self):
+        # Remember which workers had stopped before we did.
+        self.events_at_stop = list(ToyWorker.events)
+        return super(StubbedSharedConnection, self).stopService()
+
+
 class StubbedMultiWorker(MultiWorker):
     def WORKER_CREATOR(self, options):
         worker_creator = StubbedWorkerCreator(options)
         worker_creator.broker = self._amqp_client.broker
         return worker_creator
 
+    def SHARED_CONNECTION(self, options):
+        return StubbedSharedConnection(options, self._amqp_client.broker)
+
     def wait_for_workers(self):
         return DeferredList([w._d for w in self.workers])
 
@@ -130,3 +172,194 @@ class MultiWorkerTestCase(TestCase):
         worker2 = worker.getServiceNamed("worker2")
         self.assertEqual({'foo': 'bar'}, worker1.config)
         self.assertEqual({'foo': 'baz'}, worker2.config)
+
+    @inlineCallbacks
+    def test_shared_connection(self):
+        cfg = {'shared_connection': True}
+        cfg.update(self.base_config)
+        worker = yield self.get_multiworker(cfg)
+        connection = worker.worker_creator.shared_connection
+        self.assertEqual(1, connection.connections)
+        self.assertEqual(sorted(worker.workers), sorted(connection.workers))
+        clients = set(w._amqp_client for w in worker.workers)
+        self.assertEqual(set([connection._amqp_client]), clients)
+
+        yield self.dispatch(mkmsg("foo"), "worker1")
+        yield self.dispatch(mkmsg("bar"), "worker2")
+        self.assertEqual(['oof'], self.get_replies("worker1"))
+        self.assertEqual(['rab'], self.get_replies("worker2"))
+
+        ToyWorker.events[:] = []
+        yield worker.stopService()
+        self.assertEqual(['STOP: worker%s' % (i + 1) for i in range(3)],
+                         sorted(ToyWorker.events))
+        self.assertEqual([], connection.workers)
+        self.assertEqual([False] * 3, [c.keep_consuming for w in worker.workers
+                                       for c in w._amqp_consumers])
+
+    @inlineCallbacks
+    def test_shared_connection_stopped_after_workers(self):
+        cfg = {
+            'shared_connection': True,
+            'workers': {'worker1': "%s.SlowStoppingWorker" % (__name__,)},
+            }
+        worker = yield self.get_multiworker(cfg)
+        connection = worker.worker_creator.shared_connection
+        ToyWorker.events[:] = []
+        yield worker.stopService()
+        self.assertEqual(['STOP: worker1'], connection.events_at_stop)
+        self.assertEqual(['bye'], self.get_replies("worker1"))
+
+
+class FakeProcess(object):
+    def __init__(self, protocol, args, env, pid):
+        self.protocol = protocol
+        self.args = args
+        self.env = env
+        self.pid = pid
+        self.signals = []
+        self.ended = False
+
+    def signalProcess(self, signal_name):
+        if self.ended:
+            raise ProcessExitedAlready()
+        self.signals.append(signal_name)
+
+    def end(self, exit_code=0):
+        self.ended = True
+        if exit_code:
+            reason = ProcessTerminated(exitCode=exit_code)
+        else:
+            reason = ProcessDone(None)
+        self.protocol.processEnded(Failure(reason))
+
+
+class StubbedProcessMultiWorker(ProcessMultiWorker):
+    def spawn_process(self, protocol, args, env):
+        process = FakeProcess(protocol, args, env, len(self.processes) + 1)
+        self.processes.append(process)
+        return process
+
+
+class ProcessMultiWorkerTestCase(TestCase):
+
+    base_config = {
+        'workers': {
+            'worker1': "%s.ToyWorker" % (__name__,),
+            'worker2': "%s.ToyWorker" % (__name__,),
+            },
+        'processes': {'worker2': 2},
+        'defaults': {'foo': 'baz'},
+        'worker1': {'foo': 'bar'},
+        }
+
+    def setUp(self):
+        self.workers = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        for worker in self.workers:
+            if worker.running:
+                stop_d = worker.stopService()
+                for process in worker.processes:
+                    if not process.ended:
+                        process.end()
+                yield stop_d
+
+    def get_multiworker(self, config):
+        worker = get_stubbed_worker(StubbedProcessMultiWorker, config)
+        worker.processes = []
+        worker.clock = Clock()
+        worker.startService()
+        self.workers.append(worker)
+        return worker
+
+    def running_processes(self, worker):
+        return dict((child.name, child.process) for child in worker.workers
+                    if child.running)
+
+    def test_start_processes(self):
+        worker = self.get_multiworker(self.base_config)
+        processes = self.running_processes(worker)
+        self.assertEqual(['worker1', 'worker2.0', 'worker2.1'],
+                         sorted(processes))
+        args = processes['worker1'].args
+        self.assertEqual("%s.ToyWorker" % (__name__,),
+                         args[args.index('--worker-class') + 1])
+        config_file = args[args.index('--config') + 1]
+        self.assertEqual({'foo': 'bar'}, yaml.safe_load(open(config_file)))
+        args = processes['worker2.1'].args
+        config_file = args[args.index('--config') + 1]
+        self.assertEqual({'foo': 'baz'}, yaml.safe_load(open(config_file)))
+
+    def test_restart(self):
+        worker = self.get_multiworker(self.base_config)
+        [child] = [c for c in worker.workers if c.name == 'worker1']
+        old_process = child.process
+        config_file = old_process.args[old_process.args.index('--config') + 1]
+        old_process.end(1)
+        self.assertFalse(child.running)
+        self.assertFalse(os.path.exists(config_file))
+        self.assertEqual(1, child.restarts)
+
+        worker.clock.advance(1)
+        self.assertTrue(child.running)
+        self.assertNotEqual(old_process, child.process)
+
+        # Exiting again straight away doubles the delay.
+        child.process.end(1)
+        worker.clock.advance(1)
+        self.assertFalse(child.running)
+        worker.clock.advance(1)
+        self.assertTrue(child.running)
+        self.assertEqual(2, child.restarts)
+
+    @inlineCallbacks
+    def test_graceful_stop(self):
+        worker = self.get_multiworker(self.base_config)
+        processes = list(worker.processes)
+        d = worker.stopService()
+        self.assertEqual([['TERM']] * 3, [p.signals for p in processes])
+        processes[0].end()
+        processes[1].end()
+        self.assertFalse(d.called)
+
+        worker.clock.advance(worker.stop_timeout)
+        self.assertEqual(['TERM', 'KILL'], processes[2].signals)
+        processes[2].end(-9)
+        yield d
+        self.assertEqual(3, len(worker.processes))
+        self.assertEqual({}, self.running_processes(worker))
+
+    def test_health(self):
+        worker = self.get_multiworker(self.base_config)
+        [child] = [c for c in worker.workers if c.name == 'worker1']
+        child.process.end(1)
+        health = worker.health()
+        self.assertEqual(3, health['total'])
+        self.assertEqual(2, health['running'])
+        self.assertEqual(False, health['workers']['worker1']['running'])
+        self.assertEqual(1, health['workers']['worker1']['restarts'])
+        self.assertEqual(True, health['workers']['worker2.0']['running'])
+        self.assertEqual(None, health['workers']['worker2.0']['last_exit'])
+
+    def test_health_uptime(self):
+        worker = self.get_multiworker(self.base_config)
+        worker.clock.advance(5)
+        health = worker.health()
+        self.assertEqual(5, health['workers']['worker1']['uptime'])
+
+    @inlineCallbacks
+    def test_stop_waits_for_health_port(self):
+        config = dict(self.base_config, health_port=0)
+        worker = self.get_multiworker(config)
+        port = worker.health_resource
+        stop_listening, listening_d = port.stopListening, Deferred()
+        port.stopListening = lambda: listening_d.addCallback(
+            lambda _: stop_listening())
+        d = worker.stopService()
+        for process in worker.processes:
+            process.end()
+        self.assertFalse(d.called)
+        listening_d.callback(None)
+        yield d
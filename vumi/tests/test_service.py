@@ -1,9 +1,35 @@
+import os
+import base64
+from copy import deepcopy
+
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, gatherResults
+from twisted.internet.task import Clock, deferLater
+from twisted.internet import reactor
+
+import txamqp.spec
 
-from vumi.service import Worker, WorkerCreator
+from vumi import service
+from vumi.service import (Worker, WorkerCreator, RoutingKeyBindingCache,
+                          RoutingKeyError, SharedAmqpConnection, get_spec,
+                          load_spec, get_spec_cache_dir)
 from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
-from vumi.message import Message
+from vumi.tests.fake_amqp import FakeAMQClient
+from vumi.utils import vumi_resource_path
+from vumi.errors import MessageCodecError
+from vumi import message as vumi_message
+from vumi.message import Message, JSONMessageCodec
+
+
+class Base64JSONCodec(JSONMessageCodec):
+    content_type = 'application/x-test-base64'
+
+    def encode(self, payload):
+        return base64.b64encode(super(Base64JSONCodec, self).encode(payload))
+
+    def decode(self, data, timestamp_fields=()):
+        return super(Base64JSONCodec, self).decode(
+            base64.b64decode(data), timestamp_fields)
 
 
 class ServiceTestCase(TestCase):
@@ -33,6 +59,198 @@ class ServiceTestCase(TestCase):
                                                  message.content)
         self.assertEquals(log, [Message(key="value")])
 
+    @inlineCallbacks
+    def test_consume_max_in_flight(self):
+        """With max_in_flight set, up to that many messages should be
+        processed concurrently and each should be acked individually."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        pending = []
+        started = [Deferred() for _ in range(3)]
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            started[len(pending) - 1].callback(None)
+            return d
+
+        consumer = yield worker.consume('test.routing.key', handler,
+                                        max_in_flight=2)
+        for i in range(3):
+            broker.publish_message('vumi', 'test.routing.key', Message(i=i))
+        yield started[1]
+        self.assertEqual([Message(i=0), Message(i=1)],
+                         [msg for msg, _d in pending])
+        self.assertFalse(started[2].called)
+
+        # Finishing the second message first should ack only that one and
+        # let the third message in.
+        pending[1][1].callback(None)
+        yield started[2]
+        self.assertEqual(2, len(consumer.channel.unacked))
+
+        pending[0][1].callback(None)
+        pending[2][1].callback(None)
+        yield broker.wait_delivery()
+        self.assertEqual([], consumer.channel.unacked)
+
+    @inlineCallbacks
+    def test_consume_max_in_flight_stop(self):
+        """Stopping a consumer that is waiting for a free slot should not
+        start processing another message when a slot frees up."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        pending = []
+        started = [Deferred() for _ in range(2)]
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            started[len(pending) - 1].callback(None)
+            return d
+
+        consumer = yield worker.consume('test.routing.key', handler,
+                                        max_in_flight=2)
+        for i in range(3):
+            broker.publish_message('vumi', 'test.routing.key', Message(i=i))
+        yield started[1]
+        # Let the consumer start waiting for a free slot.
+        yield deferLater(reactor, 0, lambda: None)
+
+        stop_d = consumer.stop()
+        self.assertFalse(stop_d.called)
+        pending[0][1].callback(None)
+        pending[1][1].callback(None)
+        yield stop_d
+        self.assertEqual([Message(i=0), Message(i=1)],
+                         [msg for msg, _d in pending])
+
+    @inlineCallbacks
+    def test_consume_max_in_flight_no_ack(self):
+        """Messages whose handlers return False should not be acked."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        consumer = yield worker.consume(
+            'test.routing.key', lambda msg: msg['ack'], max_in_flight=5)
+        broker.publish_message('vumi', 'test.routing.key', Message(ack=False))
+        broker.publish_message('vumi', 'test.routing.key', Message(ack=True))
+        yield broker.wait_delivery()
+        self.assertEqual(1, len(consumer.channel.unacked))
+
+    def record_acks(self, consumer):
+        """Record delivery tags delivered to and acked by a consumer."""
+        delivered, acks = [], []
+        channel = consumer.channel
+        deliver_message, basic_ack = channel.deliver_message, channel.basic_ack
+
+        def record_delivery(msg, queue):
+            delivered.append(msg.delivery_tag)
+            return deliver_message(msg, queue)
+
+        def record_ack(delivery_tag, multiple):
+            acks.append((delivery_tag, multiple))
+            return basic_ack(delivery_tag, multiple)
+
+        channel.deliver_message = record_delivery
+        channel.basic_ack = record_ack
+        return delivered, acks
+
+    @inlineCallbacks
+    def test_consume_coalesced_acks(self):
+        """With ack_batch_size set, a single ack should be sent for each
+        batch of contiguous messages."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        consumer = yield worker.consume('test.routing.key', lambda msg: None,
+                                        ack_batch_size=3)
+        delivered, acks = self.record_acks(consumer)
+        for i in range(5):
+            broker.publish_message('vumi', 'test.routing.key', Message(i=i))
+        yield broker.wait_delivery()
+        self.assertEqual([(delivered[2], True)], acks)
+        self.assertEqual(delivered[3:],
+                         [tag for tag, _q in consumer.channel.unacked])
+
+        # The remaining acks are sent when the timer fires.
+        self.assertTrue(consumer._ack_timer.active())
+        consumer.flush_acks()
+        self.assertEqual([(delivered[2], True), (delivered[4], True)], acks)
+        self.assertEqual([], consumer.channel.unacked)
+
+    @inlineCallbacks
+    def test_consume_coalesced_acks_from_config(self):
+        worker = get_stubbed_worker(Worker, {'ack_batch_size': 10,
+                                             'ack_batch_time': 5})
+        consumer = yield worker.consume('test.routing.key', lambda msg: None)
+        self.assertEqual(10, consumer.ack_batch_size)
+        self.assertEqual(5, consumer.ack_batch_time)
+
+    @inlineCallbacks
+    def test_consume_coalesced_acks_no_ack(self):
+        """Messages that aren't acked should never be covered by a
+        coalesced ack."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        consumer = yield worker.consume(
+            'test.routing.key', lambda msg: msg['ack'], ack_batch_size=3)
+        delivered, acks = self.record_acks(consumer)
+        for ack in [True, False, True, True]:
+            broker.publish_message('vumi', 'test.routing.key',
+                                   Message(ack=ack))
+        yield broker.wait_delivery()
+        self.assertEqual([(delivered[0], True), (delivered[2], False),
+                          (delivered[3], False)], acks)
+        self.assertEqual([delivered[1]],
+                         [tag for tag, _q in consumer.channel.unacked])
+
+    @inlineCallbacks
+    def test_consume_coalesced_acks_after_held_message_fails(self):
+        """Acks held back behind a slow message should still be sent if
+        that message isn't acked."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        slow, fast_done = Deferred(), Deferred()
+
+        def handler(msg):
+            if msg['slow']:
+                return slow
+            if msg['last']:
+                reactor.callLater(0, fast_done.callback, None)
+            return True
+
+        consumer = yield worker.consume('test.routing.key', handler,
+                                        max_in_flight=3, ack_batch_size=2)
+        delivered, acks = self.record_acks(consumer)
+        for i in range(3):
+            broker.publish_message('vumi', 'test.routing.key',
+                                   Message(slow=(i == 0), last=(i == 2)))
+        yield fast_done
+        # The fast messages are held back behind the slow one.
+        self.assertEqual([], acks)
+        self.assertEqual(None, consumer._ack_timer)
+
+        slow.callback(False)
+        self.assertTrue(consumer._ack_timer.active())
+        consumer.flush_acks()
+        self.assertEqual([(delivered[1], False), (delivered[2], False)], acks)
+        self.assertEqual([delivered[0]],
+                         [tag for tag, _q in consumer.channel.unacked])
+
+    @inlineCallbacks
+    def test_consume_coalesced_acks_on_stop(self):
+        """Stopping a consumer should send any acks being held back."""
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        consumer = yield worker.consume('test.routing.key', lambda msg: None,
+                                        ack_batch_size=3)
+        delivered, acks = self.record_acks(consumer)
+        broker.publish_message('vumi', 'test.routing.key', Message(i=0))
+        yield broker.wait_delivery()
+        self.assertEqual([], acks)
+        yield consumer.stop()
+        self.assertEqual([(delivered[0], True)], acks)
+        self.assertEqual(None, consumer._ack_timer)
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -46,6 +264,293 @@ class ServiceTestCase(TestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publish_batch(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key')
+        msgs = [Message(key=i) for i in range(3)]
+        result = yield publisher.publish_batch(msgs)
+        self.assertEqual(msgs, result)
+        published = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEqual(['{"key": 0}', '{"key": 1}', '{"key": 2}'],
+                         [msg.body for msg in published])
+        self.assertEqual({'delivery mode': 2}, published[0].properties)
+
+    @inlineCallbacks
+    def test_buffered_publisher(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key',
+                                            buffer_size=3)
+        broker = publisher.channel.broker
+        d1 = publisher.publish_message(Message(key=1))
+        d2 = publisher.publish_message(Message(key=2), routing_key='other')
+        self.assertEqual([], broker.get_dispatched('vumi', 'test.routing.key'))
+        self.assertFalse(d1.called)
+
+        d3 = publisher.publish_message(Message(key=3))
+        self.assertEqual(Message(key=1), (yield d1))
+        self.assertEqual(Message(key=2), (yield d2))
+        self.assertEqual(Message(key=3), (yield d3))
+        self.assertEqual(['{"key": 1}', '{"key": 3}'], [
+            msg.body for msg in broker.get_dispatched(
+                'vumi', 'test.routing.key')])
+        self.assertEqual(['{"key": 2}'], [
+            msg.body for msg in broker.get_dispatched('vumi', 'other')])
+        self.assertEqual(None, publisher._buffer_timer)
+
+    @inlineCallbacks
+    def test_buffered_publisher_flush(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key',
+                                            buffer_size=10)
+        d = publisher.publish_message(Message(key=1))
+        self.assertTrue(publisher._buffer_timer.active())
+        yield publisher.flush()
+        msg = yield d
+        self.assertEqual(Message(key=1), msg)
+        self.assertEqual(None, publisher._buffer_timer)
+
+    @inlineCallbacks
+    def test_buffered_publisher_flushed_on_stop(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key',
+                                            buffer_size=10)
+        broker = publisher.channel.broker
+        d = publisher.publish_message(Message(key=1))
+        worker.startService()
+        yield worker.stopService()
+        self.assertEqual(Message(key=1), (yield d))
+        self.assertEqual(['{"key": 1}'], [
+            msg.body for msg in broker.get_dispatched(
+                'vumi', 'test.routing.key')])
+
+    @inlineCallbacks
+    def test_publisher_not_buffered_by_default(self):
+        worker = get_stubbed_worker(Worker, {'publish_buffer_size': 10})
+        publisher = yield worker.publish_to('test.routing.key')
+        d = publisher.publish_message(Message(key=1))
+        self.assertTrue(d.called)
+        self.assertEqual(None, publisher._buffer_timer)
+        self.assertEqual(['{"key": 1}'], [
+            msg.body for msg in publisher.channel.broker.get_dispatched(
+                'vumi', 'test.routing.key')])
+
+    def patch_codecs(self):
+        codecs = dict(vumi_message.MESSAGE_CODECS)
+        codecs[Base64JSONCodec.content_type] = Base64JSONCodec
+        self.patch(vumi_message, 'MESSAGE_CODECS', codecs)
+        self.patch(vumi_message, '_codecs', dict(vumi_message._codecs))
+
+    @inlineCallbacks
+    def test_publish_content_type(self):
+        self.patch_codecs()
+        worker = get_stubbed_worker(Worker, {
+            'message_content_type': Base64JSONCodec.content_type})
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key=1))
+        yield publisher.publish_batch([Message(key=2)])
+        broker = publisher.channel.broker
+        published = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual(
+            [base64.b64encode('{"key": 1}'), base64.b64encode('{"key": 2}')],
+            [msg.body for msg in published])
+        self.assertEqual({'delivery mode': 2,
+                          'content type': Base64JSONCodec.content_type},
+                         published[0].properties)
+        self.assertEqual([Message(key=1), Message(key=2)],
+                         broker.get_messages('vumi', 'test.routing.key'))
+
+    def test_publish_to_unknown_content_type(self):
+        worker = get_stubbed_worker(Worker, {
+            'message_content_type': 'text/unknown'})
+        self.assertRaises(MessageCodecError, worker.publish_to,
+                          'test.routing.key')
+        self.assertEqual([], worker._amqp_publishers)
+
+    def test_publish_to_unavailable_content_type(self):
+        self.patch(vumi_message, 'msgpack', None)
+        self.patch(vumi_message, '_codecs', {})
+        worker = get_stubbed_worker(Worker)
+        self.assertRaises(MessageCodecError, worker.publish_to,
+                          'test.routing.key',
+                          content_type='application/x-msgpack')
+        self.assertEqual([], worker._amqp_publishers)
+
+    @inlineCallbacks
+    def test_consume_mixed_content_types(self):
+        self.patch_codecs()
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        json_publisher = yield worker.publish_to('test.routing.key')
+        b64_publisher = yield worker.publish_to(
+            'test.routing.key', content_type=Base64JSONCodec.content_type)
+        json_publisher.publish_message(Message(key=1))
+        b64_publisher.publish_message(Message(key=2))
+        json_publisher.publish_message(Message(key=3))
+        yield broker.kick_delivery()
+        self.assertEqual([Message(key=1), Message(key=2), Message(key=3)],
+                         log)
+
+    @inlineCallbacks
+    def test_publishers_share_channels(self):
+        worker = get_stubbed_worker(Worker)
+        pub1 = yield worker.publish_to('test.key1')
+        pub2 = yield worker.publish_to('test.key2')
+        pub3 = yield worker.publish_to('test.key3', exchange_name='other')
+        self.assertTrue(pub1.channel is pub2.channel)
+        self.assertTrue(pub1.channel is not pub3.channel)
+
+    @inlineCallbacks
+    def test_publisher_channel_open_failure(self):
+        worker = get_stubbed_worker(Worker)
+        client = worker._amqp_client
+        opening = Deferred()
+        client.get_channel = lambda: opening
+        d1 = client.get_publisher_channel('vumi')
+        d2 = client.get_publisher_channel('vumi')
+        opening.errback(RuntimeError("No channel for you."))
+        yield self.assertFailure(d1, RuntimeError)
+        yield self.assertFailure(d2, RuntimeError)
+
+        # The next publisher tries again.
+        del client.get_channel
+        channel = yield client.get_publisher_channel('vumi')
+        self.assertNotEqual(None, channel)
+        shared = yield client.get_publisher_channel('vumi')
+        self.assertTrue(channel is shared)
+
+    @inlineCallbacks
+    def test_channels_opened_together(self):
+        worker = get_stubbed_worker(Worker)
+        d1 = worker.consume('test.key1', lambda msg: None)
+        d2 = worker.consume('test.key2', lambda msg: None)
+        consumer1, consumer2 = yield gatherResults([d1, d2])
+        self.assertNotEqual(consumer1.channel.channel_id,
+                            consumer2.channel.channel_id)
+
+
+class StubbedBindingCache(RoutingKeyBindingCache):
+    def __init__(self, bindings):
+        RoutingKeyBindingCache.__init__(self, {'vhost': '/test'}, Clock())
+        self.bindings = bindings
+        self.fetches = []
+
+    def fetch_bindings(self):
+        d = Deferred()
+        self.fetches.append(d)
+        return d
+
+    def finish_fetch(self):
+        self.fetches[-1].callback(deepcopy(self.bindings))
+
+
+class RoutingKeyBindingCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = StubbedBindingCache({'vumi': set(['bound.key'])})
+
+    def assert_bound(self, expected, d):
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual([expected], results)
+
+    def test_single_fetch(self):
+        d1 = self.cache.is_bound('vumi', 'bound.key')
+        d2 = self.cache.is_bound('vumi', 'other.key')
+        self.assertEqual(1, len(self.cache.fetches))
+        self.cache.finish_fetch()
+        self.assert_bound(True, d1)
+        self.assert_bound(False, d2)
+
+    def test_bound_ttl(self):
+        self.cache.is_bound('vumi', 'bound.key')
+        self.cache.finish_fetch()
+        self.assertEqual(True, self.cache.lookup('vumi', 'bound.key'))
+
+        self.cache.clock.advance(self.cache.BOUND_TTL)
+        self.assertEqual(None, self.cache.lookup('vumi', 'bound.key'))
+        # Stale bindings are used while they're refreshed in the background.
+        self.assert_bound(True, self.cache.is_bound('vumi', 'bound.key'))
+        self.assert_bound(True, self.cache.is_bound('vumi', 'bound.key'))
+        self.assertEqual(2, len(self.cache.fetches))
+        self.cache.finish_fetch()
+        self.assertEqual(True, self.cache.lookup('vumi', 'bound.key'))
+
+    def test_unbound_ttl(self):
+        self.cache.is_bound('vumi', 'new.key')
+        self.cache.finish_fetch()
+        self.assertEqual(False, self.cache.lookup('vumi', 'new.key'))
+        self.assert_bound(False, self.cache.is_bound('vumi', 'new.key'))
+        self.assertEqual(1, len(self.cache.fetches))
+
+        self.cache.bindings['vumi'].add('new.key')
+        self.cache.clock.advance(self.cache.UNBOUND_TTL)
+        d = self.cache.is_bound('vumi', 'new.key')
+        self.assertEqual(2, len(self.cache.fetches))
+        self.cache.finish_fetch()
+        self.assert_bound(True, d)
+
+    def test_undetected(self):
+        self.cache.bindings = None
+        d = self.cache.is_bound('vumi', 'foo')
+        self.cache.finish_fetch()
+        self.assert_bound(True, d)
+        self.assert_bound(True, self.cache.is_bound('vumi', 'bar'))
+        self.assertEqual(1, len(self.cache.fetches))
+
+    def test_add_binding(self):
+        self.cache.add_binding('vumi', 'new.key')
+        self.assert_bound(True, self.cache.is_bound('vumi', 'new.key'))
+        self.assertEqual([], self.cache.fetches)
+
+    def test_add_binding_not_lower_case(self):
+        self.cache.add_binding('vumi', 'Mixed.Key')
+        self.assertEqual(None, self.cache.lookup('vumi', 'Mixed.Key'))
+
+    def test_fetch_bindings_disabled(self):
+        cache = RoutingKeyBindingCache({'vhost': '/test'}, Clock())
+        self.assertEqual(None, self.successResultOf(cache.fetch_bindings()))
+
+    @inlineCallbacks
+    def test_publisher_uses_cache(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('bound.key')
+        publisher.binding_cache = self.cache
+        broker = publisher.channel.broker
+
+        d = publisher.publish_message(Message(key="value"))
+        self.cache.finish_fetch()
+        yield d
+        yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(1, len(self.cache.fetches))
+        self.assertEqual(2, len(broker.get_dispatched('vumi', 'bound.key')))
+
+        d = publisher.publish_message(Message(key="value"),
+                                      routing_key='unbound.key')
+        self.assertFailure(d, RoutingKeyError)
+        self.assertEqual([], broker.get_dispatched('vumi', 'unbound.key'))
+
+    @inlineCallbacks
+    def test_shared_cache(self):
+        worker = get_stubbed_worker(Worker)
+        pub1 = yield worker.publish_to('foo')
+        pub2 = yield worker.publish_to('bar')
+        self.assertTrue(pub1.binding_cache is pub2.binding_cache)
+        yield worker.consume('baz', lambda msg: None)
+        self.assertEqual(True, pub1.binding_cache.lookup('vumi', 'baz'))
+
+    @inlineCallbacks
+    def test_publish_to_consumed_mixed_case_key(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('foo')
+        yield worker.consume('Mixed.Key', lambda msg: None)
+        d = publisher.publish_message(Message(key="value"),
+                                      routing_key='Mixed.Key')
+        yield self.assertFailure(d, RoutingKeyError)
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -80,3 +585,151 @@ class TestWorkerCreator(TestCase):
                                   LoadableTestWorker.__name__)
         worker = creator.create_worker(worker_class, {})
         self.assertEquals("poke", worker.poke())
+
+
+class RecordingWorker(Worker):
+    def __init__(self, options, config=None):
+        super(RecordingWorker, self).__init__(options, config)
+        self.events = []
+
+    @inlineCallbacks
+    def startWorker(self):
+        self.events.append(('start', self._amqp_client))
+        yield self.consume('%s.in' % (self.config['name'],),
+                           lambda msg: None)
+
+    def _amqp_connection_failed(self):
+        self.events.append(('failed',))
+
+
+class NoConnectSharedAmqpConnection(SharedAmqpConnection):
+    def _connect(self, timeout, bindAddress):
+        pass
+
+
+class SharedAmqpConnectionTestCase(TestCase):
+
+    def setUp(self):
+        self.connection = NoConnectSharedAmqpConnection({})
+        spec = get_spec(vumi_resource_path("amqp-spec-0-8.xml"))
+        self.client = FakeAMQClient(spec, {})
+
+    def mk_worker(self, name):
+        creator = WorkerCreator({}, shared_connection=self.connection)
+        return creator.create_worker_by_class(RecordingWorker, {'name': name})
+
+    @inlineCallbacks
+    def test_connect_workers(self):
+        worker1 = self.mk_worker('w1')
+        worker2 = self.mk_worker('w2')
+        yield self.connection._amqp_connected(self.client)
+        self.assertEqual([('start', self.client)], worker1.events)
+        self.assertEqual([('start', self.client)], worker2.events)
+
+    @inlineCallbacks
+    def test_attach_when_connected(self):
+        yield self.connection._amqp_connected(self.client)
+        worker = self.mk_worker('w1')
+        self.assertEqual([], worker.events)
+        d = Deferred()
+        reactor.callLater(0, d.callback, None)
+        yield d
+        self.assertEqual([('start', self.client)], worker.events)
+
+    @inlineCallbacks
+    def test_reconnect(self):
+        worker1 = self.mk_worker('w1')
+        worker2 = self.mk_worker('w2')
+        yield self.connection._amqp_connected(self.client)
+        self.connection._amqp_connection_failed()
+        self.assertEqual(('failed',), worker1.events[-1])
+        self.assertEqual(('failed',), worker2.events[-1])
+        yield self.connection._amqp_connected(self.client)
+        self.assertEqual(('start', self.client), worker1.events[-1])
+        self.assertEqual(('start', self.client), worker2.events[-1])
+
+    @inlineCallbacks
+    def test_detach(self):
+        worker1 = self.mk_worker('w1')
+        worker2 = self.mk_worker('w2')
+        yield self.connection._amqp_connected(self.client)
+        worker1.startService()
+        yield worker1.stopService()
+        self.assertEqual([worker2], self.connection.workers)
+        [consumer1] = worker1._amqp_consumers
+        [consumer2] = worker2._amqp_consumers
+        self.assertFalse(consumer1.keep_consuming)
+        self.assertTrue(consumer2.keep_consuming)
+
+
+class SpecCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.specfile = vumi_resource_path("amqp-spec-0-8.xml")
+        self.cache_dir = self.mktemp()
+        self.set_cache_dir(self.cache_dir)
+
+    def set_cache_dir(self, cache_dir):
+        self.patch(os, 'environ',
+                   dict(os.environ, VUMI_SPEC_CACHE_DIR=cache_dir))
+
+    def assert_specs_equivalent(self, spec1, spec2):
+        self.assertEqual(
+            [(c.name, c.id, [(m.name, m.id) for m in c.methods])
+             for c in spec1.classes],
+            [(c.name, c.id, [(m.name, m.id) for m in c.methods])
+             for c in spec2.classes])
+        method1 = spec1.klass.basic_publish.im_func
+        method2 = spec2.klass.basic_publish.im_func
+        self.assertEqual(method1.__doc__, method2.__doc__)
+        self.assertEqual(method1.func_defaults, method2.func_defaults)
+        self.assertEqual(
+            spec2.classes.byname['basic'].methods.byname['publish'],
+            method2.func_globals[txamqp.spec.Method.METHOD])
+
+    def test_cache_dir(self):
+        self.assertEqual(self.cache_dir, get_spec_cache_dir())
+        self.assertTrue(os.path.isdir(self.cache_dir))
+
+    def test_cache_disabled(self):
+        self.set_cache_dir('')
+        self.assertEqual(None, get_spec_cache_dir())
+        load_spec(self.specfile)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_insecure_cache_dir(self):
+        os.makedirs(self.cache_dir)
+        os.chmod(self.cache_dir, 0777)
+        self.assertEqual(None, get_spec_cache_dir())
+
+    def test_load_cached(self):
+        spec = load_spec(self.specfile)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        def no_load(specfile):
+            self.fail("Spec file loaded")
+        self.patch(txamqp.spec, 'load', no_load)
+        cached_spec = load_spec(self.specfile)
+        self.assertNotEqual(spec, cached_spec)
+        self.assert_specs_equivalent(spec, cached_spec)
+
+    def test_cached_spec_works(self):
+        load_spec(self.specfile)
+        self.patch(service, 'SPECS', {})
+        self.patch(txamqp.spec, 'load', lambda specfile: self.fail("loaded"))
+        worker = get_stubbed_worker(Worker)
+        d = worker.publish_to('test.routing.key')
+        d.addCallback(lambda pub: pub.publish_message(Message(a=1)))
+        return d
+
+    def test_corrupt_cache(self):
+        load_spec(self.specfile)
+        [cache_file] = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, cache_file), 'wb') as f:
+            f.write('garbage')
+        spec = load_spec(self.specfile)
+        self.assertEqual(1, len(self.flushLoggedErrors()))
+        self.assert_specs_equivalent(txamqp.spec.load(self.specfile), spec)
+        # The cache file is replaced with a good one.
+        self.assert_specs_equivalent(spec, load_spec(self.specfile))
+        self.assertEqual([], self.flushLoggedErrors())
@@ -1,7 +1,9 @@
 from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
 
 from vumi.service import Worker
-from vumi.tests.utils import get_stubbed_worker, FakeRedis
+from vumi.tests.utils import (get_stubbed_worker, FakeRedis,
+                              FakeAsyncRedis)
 from vumi.tests.fake_amqp import FakeAMQClient
 
 
@@ -153,3 +155,38 @@ class FakeRedisTestCase(TestCase):
         self.assertEqual(self.r_server.lrem('list', 1, -2), 2)
         self.assertEqual(self.r_server.lrange('list', 0, -1),
                          ['v0', 1, 'v1', 1, 'v2', 1, 'v3', 'v4'])
+
+
+class FakeAsyncRedisTestCase(TestCase):
+
+    def setUp(self):
+        self.r_server = FakeAsyncRedis()
+
+    def tearDown(self):
+        self.r_server.teardown()
+
+    @inlineCallbacks
+    def test_commands_return_deferreds(self):
+        d = self.r_server.set("foo", 1)
+        self.assertTrue(hasattr(d, 'addCallback'))
+        yield d
+        self.assertEqual((yield self.r_server.get("foo")), '1')
+        self.assertEqual((yield self.r_server.incr("foo")), 2)
+        self.assertEqual((yield self.r_server.delete("foo")), True)
+
+    @inlineCallbacks
+    def test_shares_data_with_sync(self):
+        sync = FakeRedis()
+        r_server = FakeAsyncRedis(sync)
+        sync.hset("hash", "field", "1")
+        self.assertEqual((yield r_server.hgetall("hash")), {"field": "1"})
+        yield r_server.hincrby("hash", "field", 2)
+        self.assertEqual(sync.hget("hash", "field"), "3")
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.r_server.pipeline()
+        pipe.set("foo", 1).incr("foo").get("foo")
+        self.assertEqual(self.r_server.sync.get("foo"), None)
+        results = yield pipe.execute()
+        self.assertEqual(results[1:], [2, '2'])
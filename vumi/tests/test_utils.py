@@ -2,7 +2,7 @@ import os.path
 
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
@@ -11,8 +11,11 @@ from twisted.internet.protocol import Protocol, Factory
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
-                        get_first_word, redis_from_config)
-from vumi.tests.utils import FakeRedis
+                        OperatorPrefixIndex, LRUCache,
+                        get_first_word, redis_from_config,
+                        async_redis_from_config, gather_deferred_dict)
+from vumi.tests.utils import FakeRedis, FakeAsyncRedis
+from vumi.persist.async_redis import AsyncRedis
 
 
 class UtilsTestCase(TestCase):
@@ -53,6 +56,72 @@ class UtilsTestCase(TestCase):
         self.assertEqual('VODACOM', get_operator_name('27821234567', mapping))
         self.assertEqual('UNKNOWN', get_operator_name('27801234567', mapping))
 
+    def test_operator_prefix_index(self):
+        index = OperatorPrefixIndex({'27': {'2782': 'VODACOM', '2783': 'MTN'}})
+        self.assertEqual(len(index), 2)
+        self.assertEqual('MTN', index.get_operator_name('27831234567'))
+        self.assertEqual('VODACOM', index.get_operator_name('27821234567'))
+        self.assertEqual('UNKNOWN', index.get_operator_name('27801234567'))
+
+    def test_operator_prefix_index_longest_match(self):
+        index = OperatorPrefixIndex({
+            2771: {27710: 'MTN', 27711: 'VODACOM'},
+            27711234: 'CELLC',
+            })
+        self.assertEqual('MTN', index.get_operator_name('27710000000'))
+        self.assertEqual('VODACOM', index.get_operator_name('27711000000'))
+        self.assertEqual('CELLC', index.get_operator_name('27711234000'))
+        index.add('2771', '8TA')
+        self.assertEqual('8TA', index.get_operator_name('27719000000'))
+
+    def test_operator_prefix_index_lookup(self):
+        index = OperatorPrefixIndex.from_config({
+            'COUNTRY_CODE': '27',
+            'OPERATOR_PREFIX': {'27': {'2782': 'VODACOM', '2783': 'MTN'}},
+            'OPERATOR_NUMBER': {'VODACOM': '2782000'},
+            })
+        self.assertEqual(('VODACOM', '2782000'), index.lookup('0821234567'))
+        self.assertEqual(('VODACOM', '2782000'),
+                         index.lookup('+27821234567'))
+        self.assertEqual(('MTN', None), index.lookup('27831234567'))
+        self.assertEqual(('UNKNOWN', None), index.lookup('27801234567'))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_cache_order(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache[key] = key
+        cache['a'] = 'A'
+        cache.get('b')
+        cache['d'] = 'd'
+        self.assertFalse('c' in cache)
+        cache['e'] = 'e'
+        self.assertFalse('a' in cache)
+        self.assertEqual(['b', 'd', 'e'], sorted(cache._items))
+        self.assertEqual(cache.pop('d'), 'd')
+        self.assertEqual(cache.pop('d', 'missing'), 'missing')
+        cache['f'] = 'f'
+        cache['g'] = 'g'
+        self.assertEqual(['e', 'f', 'g'], sorted(cache._items))
+
+    def test_lru_cache_disabled(self):
+        cache = LRUCache(0)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), None)
+
     def test_get_first_word(self):
         self.assertEqual('KEYWORD',
                          get_first_word('KEYWORD rest of the message'))
@@ -67,6 +136,43 @@ class UtilsTestCase(TestCase):
         fake_redis = FakeRedis()
         self.assertEqual(redis_from_config(fake_redis), fake_redis)
 
+    def test_redis_from_config_fake_async_redis(self):
+        fake_redis = FakeAsyncRedis()
+        self.assertEqual(redis_from_config(fake_redis), fake_redis.sync)
+
+    def test_async_redis_from_config_str(self):
+        fake_redis = async_redis_from_config("FAKE_REDIS")
+        self.assertTrue(isinstance(fake_redis, FakeAsyncRedis))
+
+    def test_async_redis_from_config_fake_async_redis(self):
+        fake_redis = FakeAsyncRedis()
+        self.assertEqual(async_redis_from_config(fake_redis), fake_redis)
+
+    def test_async_redis_from_config_fake_redis(self):
+        fake_redis = FakeRedis()
+        async_redis = async_redis_from_config(fake_redis)
+        self.assertTrue(isinstance(async_redis, FakeAsyncRedis))
+        self.assertEqual(async_redis.sync, fake_redis)
+
+    def test_async_redis_from_config(self):
+        async_redis = async_redis_from_config({})
+        self.assertTrue(isinstance(async_redis, AsyncRedis))
+
+    @inlineCallbacks
+    def test_gather_deferred_dict(self):
+        slow = Deferred()
+        d = gather_deferred_dict({'a': succeed(1), 'b': slow})
+        self.assertFalse(d.called)
+        slow.callback(2)
+        result = yield d
+        self.assertEqual({'a': 1, 'b': 2}, result)
+
+    def test_gather_deferred_dict_failure(self):
+        failing = Deferred()
+        d = gather_deferred_dict({'a': succeed(1), 'b': failing})
+        failing.errback(ValueError("bad"))
+        return self.assertFailure(d, ValueError)
+
 
 class FakeHTTP10(Protocol):
     def dataReceived(self, data):
@@ -276,6 +276,17 @@ class FakeRedis(object):
         value = str(value)  # set() sets string value
         self._data[key] = value
 
+    # Same argument names as the python redis lib, which doesn't agree on
+    # the order of value and time between versions.
+    def setex(self, name, value, time):
+        self.set(name, value)
+        self.expire(name, time)
+
+    def mget(self, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        return [self.get(key) for key in list(keys) + list(args)]
+
     def delete(self, key):
         existed = self.exists(key)
         self._data.pop(key, None)
@@ -466,6 +477,84 @@ class FakeRedis(object):
         if delayed is not None and not delayed.cancelled:
             delayed.cancel()
 
+    # Pipelines
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline(object):
+    """Queues commands for a :class:`FakeRedis` until :meth:`execute`.
+
+    Commands are run one after the other, which is as atomic as a
+    transaction in a single process.
+    """
+
+    def __init__(self, r_server):
+        self.r_server = r_server
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        command = getattr(self.r_server, name)
+
+        def queue(*args, **kw):
+            self.command_stack.append((command, args, kw))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.command_stack = self.command_stack, []
+        return [command(*args, **kw) for command, args, kw in commands]
+
+
+class FakeAsyncRedis(FakeRedis):
+    """In process and memory implementation of
+    :class:`vumi.persist.async_redis.AsyncRedis`.
+
+    It has the same commands as :class:`FakeRedis`, but they return
+    Deferreds. The data is held by the :class:`FakeRedis` at :attr:`sync`,
+    which may be shared with components still using the synchronous
+    client.
+    """
+
+    def __init__(self, r_server=None):
+        if r_server is None:
+            r_server = FakeRedis()
+        self.sync = r_server
+
+    def teardown(self):
+        self.sync.teardown()
+
+    def pipeline(self, transaction=True):
+        return FakeAsyncRedisPipeline(self.sync)
+
+
+def _fake_async_command(name):
+    def call_command(self, *args, **kw):
+        return defer.maybeDeferred(getattr(self.sync, name), *args, **kw)
+    call_command.__name__ = name
+    return call_command
+
+
+def _add_fake_async_commands(async_cls, sync_cls):
+    """Give `async_cls` a Deferred-returning version of each public
+    `sync_cls` command it doesn't define itself."""
+    for name in vars(sync_cls).keys():
+        if not name.startswith('_') and name not in vars(async_cls):
+            setattr(async_cls, name, _fake_async_command(name))
+
+
+_add_fake_async_commands(FakeAsyncRedis, FakeRedis)
+
+
+class FakeAsyncRedisPipeline(FakeRedisPipeline):
+    """Pipeline for a :class:`FakeAsyncRedis`. :meth:`execute` returns a
+    Deferred."""
+
+    def execute(self):
+        return defer.maybeDeferred(
+            super(FakeAsyncRedisPipeline, self).execute)
+
 
 class LogCatcher(object):
     """Gather logs."""
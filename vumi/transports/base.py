@@ -14,6 +14,8 @@ from vumi.message import TransportUserMessage, TransportEvent
 from vumi.service import Worker
 from vumi.transports.failures import FailureMessage
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.blinkenlights.latency import start_latency_recorder
+from vumi.utils import gather_deferred_dict
 
 
 class Transport(Worker):
@@ -25,12 +27,17 @@ class Transport(Worker):
     * :attr:`start_message_consumer` -- Set to ``False`` if the message
       consumer should not be started. The subclass is responsible for starting
       it in this case.
+
+    Outbound messages are processed one at a time unless the
+    ``max_in_flight`` config option is set, in which case up to that many
+    calls to :meth:`handle_outbound_message` may be in progress at once.
     """
 
     SUPPRESS_FAILURE_EXCEPTIONS = True
 
     transport_name = None
     start_message_consumer = True
+    latency_recorder = None
 
     @inlineCallbacks
     def startWorker(self):
@@ -49,18 +56,20 @@ class Transport(Worker):
                                    self.config['TRANSPORT_NAME'])
         self.transport_name = self.config['transport_name']
         self.concurrent_sends = self.config.get('concurrent_sends')
+        self.max_in_flight = self.config.get('max_in_flight')
 
-        yield self._setup_failure_publisher()
-        yield self._setup_message_publisher()
-        yield self._setup_event_publisher()
-
-        yield self.setup_middleware()
-
-        yield self.setup_transport()
+        yield self.run_startup_phase('publishers', self._setup_publishers)
+        yield self.run_startup_phase('middleware', self.setup_middleware)
+        yield self.run_startup_phase('transport', self.setup_transport)
+        if self.latency_recorder is not None:
+            self.latency_recorder.instrument(
+                self, 'handle_outbound_message',
+                'transport.handle_outbound_message')
 
         self.message_consumer = None
         if self.start_message_consumer:
-            yield self._setup_message_consumer()
+            yield self.run_startup_phase('consumers',
+                                         self._setup_message_consumer)
 
     @inlineCallbacks
     def stopWorker(self):
@@ -68,6 +77,10 @@ class Transport(Worker):
             consumer = self._consumers.pop()
             yield consumer.stop()
         yield self.teardown_transport()
+        if getattr(self, '_middlewares', None) is not None:
+            yield self._middlewares.teardown()
+        if self.latency_recorder is not None:
+            self.latency_recorder.stop()
 
     def get_rkey(self, mtype):
         return '%s.%s' % (self.transport_name, mtype)
@@ -110,8 +123,19 @@ class Transport(Worker):
         Subclasses should not override this unless they need to do nonstandard
         middleware setup.
         """
+        self.latency_recorder = yield start_latency_recorder(
+            self, self.transport_name)
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        self._middlewares = MiddlewareStack(middlewares, self.latency_recorder)
+
+    @inlineCallbacks
+    def _setup_publishers(self):
+        # start all the publishers before waiting for any of them
+        yield gather_deferred_dict({
+            'failure': self._setup_failure_publisher(),
+            'message': self._setup_message_publisher(),
+            'event': self._setup_event_publisher(),
+            })
 
     @inlineCallbacks
     def _setup_message_publisher(self):
@@ -125,7 +149,8 @@ class Transport(Worker):
 
         self.message_consumer = yield self.consume(
             self.get_rkey('outbound'), self._process_message,
-            message_class=TransportUserMessage)
+            message_class=TransportUserMessage,
+            max_in_flight=self.max_in_flight)
         self._consumers.append(self.message_consumer)
 
         # Apply concurrency throttling if we need to.
@@ -6,6 +6,7 @@ from twisted.trial.unittest import TestCase
 from smpp.pdu_builder import SubmitSMResp, DeliverSM
 
 from vumi.tests.utils import FakeRedis
+from vumi.utils import OperatorPrefixIndex
 from vumi.message import TransportUserMessage
 from vumi.transports.smpp.clientserver.client import (
         EsmeTransceiver, ESME, KeyValueStore, EsmeCallbacks)
@@ -167,6 +168,18 @@ class FakeRedisRespTestCase(TransportTestCase):
         self.assertEqual(self.transport.r_get_id_for_third_party_id(their_id),
                                                                         None)
 
+    def test_send_smpp_operator_number(self):
+        self.transport.operator_index = OperatorPrefixIndex(
+            {'27': {'2782': 'VODACOM', '2783': 'MTN'}},
+            {'VODACOM': '2782000'}, '27')
+        submitted = []
+        self.esme.submit_sm = lambda **pdu: submitted.append(pdu)
+        send_smpp = SmppTransport.send_smpp
+        send_smpp(self.transport, self.mkmsg_out(to_addr='0821234567'))
+        send_smpp(self.transport, self.mkmsg_out(to_addr='0831234567'))
+        self.assertEqual([pdu['source_addr'] for pdu in submitted],
+                         ['2782000', '9292'])
+
     @inlineCallbacks
     def test_match_resp(self):
         message1 = self.mkmsg_out(
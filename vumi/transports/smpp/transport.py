@@ -6,7 +6,7 @@ import redis
 from twisted.python import log
 from twisted.internet import reactor
 
-from vumi.utils import get_operator_number
+from vumi.utils import OperatorPrefixIndex
 from vumi.transports.base import Transport
 from vumi.transports.smpp.clientserver.client import (EsmeTransceiverFactory,
                                                       EsmeTransmitterFactory,
@@ -78,7 +78,8 @@ class SmppTransport(Transport):
     :type OPERATOR_PREFIX: str, optional
     :param OPERATOR_PREFIX:
         Nested dictionary of prefix to network name mappings. Default {} (set
-        network to 'UNKNOWN'). E.g. { '27': { '27761': 'NETWORK1' }}.
+        network to 'UNKNOWN'). E.g. { '27': { '27761': 'NETWORK1' }}. The
+        network for the longest matching prefix is used.
     :type OPERATOR_NUMBER:
     :param OPERATOR_NUMBER:
         Dictionary of source MSISDN to use for each network listed in
@@ -115,6 +116,8 @@ class SmppTransport(Transport):
         self.r_message_prefix = "%s#message_json" % self.r_prefix
         log.msg("Connected to Redis, prefix: %s" % self.r_prefix)
 
+        self.operator_index = OperatorPrefixIndex.from_config(self.config)
+
         self.esme_callbacks = EsmeCallbacks(
             connect=self.esme_connected,
             disconnect=self.esme_disconnected,
@@ -301,10 +304,8 @@ class SmppTransport(Transport):
         to_addr = message['to_addr']
         from_addr = message['from_addr']
         text = message['content']
-        route = get_operator_number(to_addr,
-                self.config.get('COUNTRY_CODE', ''),
-                self.config.get('OPERATOR_PREFIX', {}),
-                self.config.get('OPERATOR_NUMBER', {})) or from_addr
+        _operator, route = self.operator_index.lookup(to_addr)
+        route = route or from_addr
         sequence_number = self.esme_client.submit_sm(
                 short_message=text.encode('utf-8'),
                 destination_addr=str(to_addr),
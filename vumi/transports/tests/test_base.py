@@ -257,3 +257,26 @@ class BaseTransportTestCase(TransportTestCase):
             ('mw1', 'outbound', self.transport_name),
             ('mw2', 'outbound', self.transport_name),
             ])
+
+    @inlineCallbacks
+    def test_latency_metrics(self):
+        config = dict(self.TEST_MIDDLEWARE_CONFIG, latency_metrics=True)
+        transport = yield self.get_transport(config)
+        mm = transport.latency_recorder.metric_manager
+        self.assertEqual(mm.prefix, 'vumi.latency.carrier_pigeon.')
+        yield self.dispatch(self.mkmsg_out())
+        self.assertEqual(len(mm['middleware.mw1.outbound.consume.count']
+                             .poll()), 1)
+        self.assertEqual(len(mm['middleware.mw2.outbound.consume.latency']
+                             .poll()), 1)
+        # The base transport raises NotImplementedError, which is timed too.
+        self.assertEqual(len(mm['transport.handle_outbound_message.count']
+                             .poll()), 1)
+        self.flushLoggedErrors(NotImplementedError)
+
+    @inlineCallbacks
+    def test_latency_metrics_disabled(self):
+        transport = yield self.get_transport(self.TEST_MIDDLEWARE_CONFIG)
+        self.assertEqual(transport.latency_recorder, None)
+        self.assertEqual(transport.handle_outbound_message.im_func,
+                         Transport.handle_outbound_message.im_func)
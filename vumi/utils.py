@@ -1,7 +1,6 @@
 # -*- test-case-name: vumi.tests.test_utils -*-
 
 import os.path
-import re
 import sys
 import base64
 import pkg_resources
@@ -10,7 +9,7 @@ import redis
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet import reactor, protocol
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, gatherResults, FirstError
 from twisted.web.client import Agent, ResponseDone
 from twisted.web.server import Site
 from twisted.web.http_headers import Headers
@@ -210,17 +209,146 @@ def redis_from_config(redis_config):
 
     * equals 'FAKE_REDIS', a new instance of :class:`FakeRedis` is returned.
     * is an instance of :class:`FakeRedis` that instance is returned
+    * is an instance of :class:`FakeAsyncRedis` the :class:`FakeRedis`
+      holding its data is returned
 
     Otherwise a new real redis client is returned.
     """
-    from vumi.tests.utils import FakeRedis
+    from vumi.tests.utils import FakeRedis, FakeAsyncRedis
     if redis_config == "FAKE_REDIS":
         return FakeRedis()
+    if isinstance(redis_config, FakeAsyncRedis):
+        return redis_config.sync
     if isinstance(redis_config, FakeRedis):
         return redis_config
     return redis.Redis(**redis_config)
 
 
+def async_redis_from_config(redis_config, threadpool=None):
+    """
+    Return a :class:`vumi.persist.async_redis.AsyncRedis` client from a
+    config.
+
+    If redis_config:
+
+    * equals 'FAKE_REDIS', a new instance of :class:`FakeAsyncRedis` is
+      returned.
+    * is an instance of :class:`FakeAsyncRedis` that instance is returned.
+    * is an instance of :class:`FakeRedis` a :class:`FakeAsyncRedis`
+      sharing its data is returned.
+
+    Otherwise a new real client is returned, sending commands from
+    `threadpool` (the reactor's thread pool by default).
+    """
+    from vumi.tests.utils import FakeRedis, FakeAsyncRedis
+    from vumi.persist.async_redis import AsyncRedis
+    if redis_config == "FAKE_REDIS":
+        return FakeAsyncRedis()
+    if isinstance(redis_config, FakeAsyncRedis):
+        return redis_config
+    if isinstance(redis_config, FakeRedis):
+        return FakeAsyncRedis(redis_config)
+    return AsyncRedis(redis.Redis(**redis_config), threadpool=threadpool)
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache that holds at most `max_size` items, discarding
+    the least recently used ones first. A `max_size` of zero disables the
+    cache.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1; cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> cache.get('b') is None
+    True
+    """
+
+    # Items are kept in a circular doubly linked list, least recently used
+    # first, so that they can be moved and removed without a search.
+    # Each link is a [prev, next, key, value] list.
+    PREV, NEXT, KEY, VALUE = range(4)
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = {}  # key -> link
+        self._root = []
+        self.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _unlink(self, link):
+        prev_link, next_link = link[self.PREV], link[self.NEXT]
+        prev_link[self.NEXT] = next_link
+        next_link[self.PREV] = prev_link
+
+    def _append(self, link):
+        root = self._root
+        last = root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, root
+        last[self.NEXT] = root[self.PREV] = link
+
+    def get(self, key, default=None):
+        """Return the value for `key` and mark it as recently used."""
+        link = self._items.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def __setitem__(self, key, value):
+        if self.max_size <= 0:
+            return
+        link = self._items.get(key)
+        if link is None:
+            link = self._items[key] = [None, None, key, value]
+        else:
+            self._unlink(link)
+            link[self.VALUE] = value
+        self._append(link)
+        while len(self._items) > self.max_size:
+            oldest = self._root[self.NEXT]
+            self._unlink(oldest)
+            del self._items[oldest[self.KEY]]
+
+    def pop(self, key, default=None):
+        link = self._items.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[self.VALUE]
+
+    def clear(self):
+        self._items.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+
+def gather_deferred_dict(deferreds):
+    """
+    Wait for all the deferreds in a dict to fire.
+
+    Returns a deferred that fires with a dict mapping the same keys to
+    the results of the deferreds, or fails with the first failure.
+    """
+    keys = deferreds.keys()
+    d = gatherResults([deferreds[key] for key in keys], consumeErrors=True)
+    d.addCallback(lambda results: dict(zip(keys, results)))
+
+    def unwrap_first_error(f):
+        f.trap(FirstError)
+        return f.value.subFailure
+
+    d.addErrback(unwrap_first_error)
+    return d
+
+
 def filter_options_on_prefix(options, prefix, delimiter='-'):
     """
     splits an options dict based on key prefixes
@@ -259,8 +387,9 @@ def get_first_word(content, delimiter=' '):
 
 
 def cleanup_msisdn(number, country_code):
-    number = re.sub('\+', '', number)
-    number = re.sub('^0', country_code, number)
+    number = number.replace('+', '')
+    if number.startswith('0'):
+        number = country_code + number[1:]
     return number
 
 
@@ -280,6 +409,91 @@ def get_operator_number(msisdn, country_code, mapping, numbers):
     return number
 
 
+class OperatorPrefixIndex(object):
+    """
+    Longest-prefix-match index of MSISDN prefixes to operators.
+
+    Unlike :func:`get_operator_name`, the operator for the longest
+    matching prefix is always returned, and the index is built once so
+    that lookups take time proportional to the length of the MSISDN
+    rather than the number of prefixes.
+
+    :param dict mapping:
+        Nested dictionary of prefixes to operator names, in the format
+        of the ``OPERATOR_PREFIX`` config option (see the sample config
+        below). Nested dictionaries are flattened, so the prefixes in
+        them should include their parent prefix.
+    :param dict numbers:
+        Dictionary of operator names to source numbers, in the format of
+        the ``OPERATOR_NUMBER`` config option.
+    :param str country_code:
+        Replaces a leading zero in MSISDNs that are looked up.
+
+    >>> index = OperatorPrefixIndex({'27': {'2782': 'VODACOM'},
+    ...                              '27821': 'OTHER'},
+    ...                             {'VODACOM': '2782000'}, '27')
+    >>> index.lookup('0821234567')
+    ('OTHER', None)
+    >>> index.lookup('+27831234567')
+    ('UNKNOWN', None)
+    >>> index.lookup('27827654321')
+    ('VODACOM', '2782000')
+    """
+
+    UNKNOWN = 'UNKNOWN'
+
+    def __init__(self, mapping=None, numbers=None, country_code=''):
+        self.numbers = numbers or {}
+        self.country_code = country_code
+        self._operators = {}
+        self._lengths = []
+        self.update(mapping or {})
+
+    @classmethod
+    def from_config(cls, config):
+        """Build an index from ``COUNTRY_CODE``, ``OPERATOR_PREFIX`` and
+        ``OPERATOR_NUMBER`` config options."""
+        return cls(config.get('OPERATOR_PREFIX', {}),
+                   config.get('OPERATOR_NUMBER', {}),
+                   config.get('COUNTRY_CODE', ''))
+
+    def __len__(self):
+        return len(self._operators)
+
+    def add(self, prefix, operator):
+        """Route MSISDNs starting with `prefix` to `operator`."""
+        prefix = str(prefix)
+        if len(prefix) not in self._lengths:
+            self._lengths.append(len(prefix))
+            self._lengths.sort(reverse=True)
+        self._operators[prefix] = operator
+
+    def update(self, mapping):
+        """Add all the prefixes in a (possibly nested) `mapping`."""
+        for prefix, value in mapping.iteritems():
+            if isinstance(value, dict):
+                self.update(value)
+            else:
+                self.add(prefix, value)
+
+    def get_operator_name(self, msisdn):
+        """Return the operator for an MSISDN that has already been
+        cleaned up, or ``'UNKNOWN'``."""
+        operators = self._operators
+        for length in self._lengths:
+            operator = operators.get(msisdn[:length])
+            if operator is not None:
+                return operator
+        return self.UNKNOWN
+
+    def lookup(self, msisdn):
+        """Return the operator and the configured source number (or
+        ``None``) for `msisdn`."""
+        operator = self.get_operator_name(
+            cleanup_msisdn(msisdn, self.country_code))
+        return operator, self.numbers.get(operator)
+
+
 def safe_routing_key(routing_key):
     """
     >>> safe_routing_key(u'*32323#')